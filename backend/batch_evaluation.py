@@ -0,0 +1,337 @@
+import json
+import uuid
+import hashlib
+import config
+from concurrent.futures import ThreadPoolExecutor
+
+from backend import redis_setup
+from backend import metrics
+from backend import prompt_templates
+from backend import local_grader
+from backend import evaluation_cache
+from backend import evaluation_service
+from backend import learner_analytics
+from backend.local_grader import normalize_text
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Celery App Import
+try:
+    from celery_app import celery_app
+    logger.info("celery_app has been successfully imported from Celery")
+
+except ImportError as e:
+    logger.exception("An exception has occurred when importing celery_app instance."
+                     f"Ensure celery.py exist in the project root. Error: {e}")
+    raise
+
+# Classroom batch evaluation. Submissions for the same passage, questions and
+# evaluator are collected in Redis for a short window; the first submission of a
+# window schedules one batch task that grades everyone. Objective items are graded
+# locally, and the remaining distinct (question, answer) pairs across the whole
+# class go to the LLM in a single call with the passage sent once.
+
+# Appends a submission and returns the window's batch task ID, opening a new window if none is open
+SUBMIT_SCRIPT = """
+redis.call('RPUSH', KEYS[1], ARGV[1])
+redis.call('EXPIRE', KEYS[1], ARGV[3])
+local owner = redis.call('GET', KEYS[2])
+if owner then
+    return {owner, 0}
+end
+redis.call('SET', KEYS[2], ARGV[2], 'EX', ARGV[3])
+return {ARGV[2], 1}
+"""
+
+# Takes every pending submission and closes the window, so later submissions open a new one
+DRAIN_SCRIPT = """
+local submissions = redis.call('LRANGE', KEYS[1], 0, -1)
+redis.call('DEL', KEYS[1])
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+end
+return submissions
+"""
+
+BATCH_EVALUATION_OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "results": {
+            "type": "array",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "number": {"type": "integer"},
+                    "answer_id": {"type": "string"},
+                    "evaluation": {"type": "string", "enum": ["Correct", "Incorrect"]},
+                    "correct_answer": {"type": "string"},
+                    "explanation": {"type": "string"}
+                },
+                "required": ["number", "answer_id", "evaluation", "correct_answer", "explanation"],
+                "additionalProperties": False
+            }
+        }
+    },
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+# Closes a window whose batch task could not be enqueued, unless another window already replaced it
+ABANDON_WINDOW_SCRIPT = """
+redis.call('LREM', KEYS[1], 1, ARGV[2])
+if redis.call('GET', KEYS[2]) == ARGV[1] then
+    redis.call('DEL', KEYS[2])
+end
+return 1
+"""
+
+submit_script = None
+drain_script = None
+
+def _get_scripts(client):
+    global submit_script, drain_script
+    if not submit_script:
+        submit_script = client.register_script(SUBMIT_SCRIPT)
+        drain_script = client.register_script(DRAIN_SCRIPT)
+    return submit_script, drain_script
+
+def batch_key(passage_content, questions_data, model_choice):
+    questions_digest = hashlib.sha1(json.dumps(questions_data, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    return f"{evaluation_cache.passage_digest(passage_content)}:{questions_digest}:{(model_choice or '').strip()}"
+
+def _pending_key(key):
+    return f"{config.BATCH_EVALUATION_KEY_PREFIX}{key}:pending"
+
+def _window_key(key):
+    return f"{config.BATCH_EVALUATION_KEY_PREFIX}{key}:window"
+
+def _context_key(key):
+    return f"{config.BATCH_EVALUATION_KEY_PREFIX}{key}:context"
+
+# Submission API
+def submit_for_batch_evaluation(model_choice, passage_content, questions_string, user_answers, questions_data,
+                                student_id=None, cohort_id=None):
+    """
+    Queues one student's answers for the current batch window.
+    Returns (task_id, submission_id); the batch task's result holds every student's result under
+    'results'. Without Redis the submission is evaluated on its own and submission_id is None.
+    """
+    client = redis_setup.get_redis_client()
+    if not client:
+        task = evaluation_service.evaluate_answers_task.delay(
+            model_choice=model_choice, passage_content=passage_content, questions_string=questions_string,
+            user_answers=user_answers, questions_data=questions_data, learner_id=student_id, cohort_id=cohort_id
+        )
+        return task.id, None
+
+    key = batch_key(passage_content, questions_data, model_choice)
+    submission_id = str(uuid.uuid4())
+    submission = json.dumps({"submission_id": submission_id, "student_id": student_id, "cohort_id": cohort_id,
+                             "user_answers": user_answers})
+    context = json.dumps({"passage_content": passage_content, "questions_data": questions_data})
+
+    submit, _ = _get_scripts(client)
+    client.set(_context_key(key), context, ex=config.BATCH_EVALUATION_KEY_TTL_SECONDS)
+    task_id, opened = submit(
+        keys=[_pending_key(key), _window_key(key)],
+        args=[submission, str(uuid.uuid4()), config.BATCH_EVALUATION_KEY_TTL_SECONDS]
+    )
+    task_id = task_id.decode('utf-8') if isinstance(task_id, bytes) else task_id
+
+    if int(opened):
+        try:
+            evaluate_batch_task.apply_async(args=[key, model_choice], task_id=task_id,
+                                            countdown=config.BATCH_EVALUATION_WINDOW_SECONDS)
+        except Exception as e:
+            # Without this, every submission for the next BATCH_EVALUATION_KEY_TTL_SECONDS would join a task that never runs
+            logger.error(f"Failed to enqueue batch evaluation {task_id} for {key}: {e}. Closing the window.", exc_info=True)
+            try:
+                client.eval(ABANDON_WINDOW_SCRIPT, 2, _pending_key(key), _window_key(key), task_id, submission)
+            except Exception as cleanup_e:
+                logger.error(f"Failed to close batch evaluation window {task_id}: {cleanup_e}")
+            raise
+        logger.info(f"Opened batch evaluation window {task_id} for {key}.")
+
+    metrics.increment_counter("batch_evaluation.submissions")
+    return task_id, submission_id
+
+# Batch Grading
+def build_answers_block(pending_items):
+    """Lists each question once with its distinct normalized answers. Returns (block, answer IDs by (number, normalized answer))."""
+    answer_ids = {}
+    lines = []
+    for question, answers in pending_items:
+        lines.append(f"Question {question['number']}: ({question.get('type', 'Unknown Type')})\n{question.get('text', '')}\nAnswers to grade:")
+        for normalized, answer in answers.items():
+            answer_id = f"A{len(answer_ids) + 1}"
+            answer_ids[(question["number"], normalized)] = answer_id
+            lines.append(f"- {answer_id}: {answer}")
+        lines.append("")
+    return "\n".join(lines), answer_ids
+
+def parse_batch_evaluation(raw_output):
+    """Returns {answer_id: evaluation row} from the batch evaluator's JSON output."""
+    try:
+        payload = json.loads(raw_output)
+    except (TypeError, ValueError):
+        logger.warning("Batch evaluation output was not valid JSON.")
+        return {}
+
+    items = payload.get("results") if isinstance(payload, dict) else payload
+    rows = {}
+    for item in items if isinstance(items, list) else []:
+        row = evaluation_service.validate_evaluation_item(item)
+        answer_id = item.get("answer_id") if isinstance(item, dict) else None
+        if row is None or not isinstance(answer_id, str):
+            logger.warning(f"Dropping batch evaluation row that fails the schema: {str(item)[:200]!r}")
+            continue
+        rows.setdefault(answer_id.strip(), row)
+    return rows
+
+def chunk_pending_items(pending_items, max_answers):
+    """Splits (question, answers) pairs into groups of at most max_answers answers, splitting a question's answers if needed."""
+    chunks = []
+    current = []
+    current_size = 0
+    for question, answers in pending_items:
+        answer_items = list(answers.items())
+        while answer_items:
+            if current_size == max_answers:
+                chunks.append(current)
+                current, current_size = [], 0
+            take = answer_items[:max_answers - current_size]
+            answer_items = answer_items[len(take):]
+            current.append((question, dict(take)))
+            current_size += len(take)
+    if current:
+        chunks.append(current)
+    return chunks
+
+def grade_pending_items(model_choice, passage_content, pending_items):
+    """
+    Grades every distinct (question, answer) pair left after local grading and the cache, in as few
+    LLM calls as BATCH_EVALUATION_MAX_ANSWERS_PER_CALL allows, so a large class never asks for
+    more output than the model can return.
+    """
+    llm_client = evaluation_service.initialize_llm_clients(model_choice)
+    if not llm_client:
+        raise ValueError("LLM client initialization has failed")
+
+    model_name = evaluation_service.get_evaluation_model_name(model_choice)
+    request_options = {}
+    if model_name == config.OPENAI_MODEL:
+        request_options["response_format"] = {
+            "type": "json_schema",
+            "json_schema": {"name": "ielts_batch_evaluation", "schema": BATCH_EVALUATION_OUTPUT_SCHEMA, "strict": True}
+        }
+
+    def grade_chunk(chunk):
+        answers_block, answer_ids = build_answers_block(chunk)
+        system_prompt, user_prompt = prompt_templates.get_batch_evaluation_prompts(passage_content, answers_block)
+        raw_output = evaluation_service.call_llm_chat(llm_client, model_name, system_prompt, user_prompt, **request_options)
+        rows_by_id = parse_batch_evaluation(raw_output)
+        return {pair: rows_by_id[answer_id] for pair, answer_id in answer_ids.items() if answer_id in rows_by_id}, len(answer_ids)
+
+    chunks = chunk_pending_items(pending_items, config.BATCH_EVALUATION_MAX_ANSWERS_PER_CALL)
+    graded = {}
+    answer_count = 0
+    with ThreadPoolExecutor(max_workers=min(len(chunks), config.BATCH_EVALUATION_MAX_CONCURRENT_CALLS)) as executor:
+        for chunk_graded, chunk_answers in executor.map(grade_chunk, chunks):
+            graded.update(chunk_graded)
+            answer_count += chunk_answers
+
+    metrics.increment_counter("batch_evaluation.llm_calls", len(chunks))
+    logger.info(f"Batch evaluator graded {len(graded)}/{answer_count} distinct answers in {len(chunks)} call(s).")
+    return graded
+
+def evaluate_submissions(model_choice, passage_content, questions_data, submissions):
+    """Grades a class's submissions for one passage. Returns {submission_id: result} shaped like evaluate_answers_task's."""
+    students = []
+    pending = {}
+    for submission in submissions:
+        graded, remaining, answers_by_number = local_grader.grade_locally(questions_data, submission["user_answers"])
+        if not answers_by_number and str(submission["user_answers"] or "").strip():
+            # Answers that cannot be mapped onto questions are graded on their own, as written
+            _, rows = evaluation_service.evaluate_with_llm(model_choice, passage_content,
+                                                           evaluation_service.format_questions_for_prompt(questions_data),
+                                                           submission["user_answers"])
+            students.append((submission, rows, [], answers_by_number))
+            continue
+        cached = evaluation_cache.get_cached_results(passage_content, remaining, answers_by_number, model_choice)
+        uncached = [q for q in remaining if q["number"] not in cached]
+        for question in uncached:
+            answer = answers_by_number.get(question["number"]) or "(no answer)"
+            entry = pending.setdefault(question["number"], (question, {}))
+            entry[1].setdefault(normalize_text(answer), answer)
+        students.append((submission, graded + list(cached.values()), uncached, answers_by_number))
+
+    llm_rows = grade_pending_items(model_choice, passage_content, list(pending.values())) if pending else {}
+
+    results = {}
+    graded_submissions = []
+    for submission, rows, uncached, answers_by_number in students:
+        llm_results = []
+        for question in uncached:
+            answer = answers_by_number.get(question["number"]) or "(no answer)"
+            row = llm_rows.get((question["number"], normalize_text(answer)))
+            if row:
+                llm_results.append({**row, "number": question["number"], "your_answer": answer, "graded_by": "llm"})
+            else:
+                llm_results.append({"number": question["number"], "your_answer": answer, "evaluation": "Not graded",
+                                    "correct_answer": "", "explanation": "The evaluator did not return a grade for this answer."})
+
+        evaluation_cache.store_results(passage_content, uncached, answers_by_number, model_choice, llm_results)
+        evaluation_results = rows + llm_results
+        feedback, struggling_types = evaluation_service.get_feedback(evaluation_results, questions_data)
+        graded_submissions.append((submission, evaluation_results))
+        results[submission["submission_id"]] = {
+            "student_id": submission.get("student_id"),
+            "evaluation": local_grader.format_evaluation_results(evaluation_results),
+            "feedback": feedback,
+            "struggling_types": struggling_types
+        }
+
+    # Recorded only once every submission is graded, so a failure part-way does not count earlier students twice on retry
+    if config.ANALYTICS_ENABLED:
+        for submission, evaluation_results in graded_submissions:
+            learner_analytics.record_evaluation(submission.get("student_id"), evaluation_results, questions_data,
+                                                submission.get("cohort_id"), event_id=submission["submission_id"])
+    return results
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=60, acks_late=True)
+def evaluate_batch_task(self, key, model_choice):
+    task_id = self.request.id
+    logger.info(f"[BATCH EVALUATION TASK START]. Task ID: {task_id}, Batch: {key}")
+
+    client = redis_setup.get_redis_client()
+    if not client:
+        raise self.retry(exc=ConnectionError("Redis unavailable for batch evaluation"))
+
+    # A retry re-reads the submissions it drained on its first attempt
+    drained_key = f"{config.BATCH_EVALUATION_KEY_PREFIX}drained:{task_id}"
+    try:
+        raw_submissions = client.lrange(drained_key, 0, -1)
+        if not raw_submissions:
+            _, drain = _get_scripts(client)
+            raw_submissions = drain(keys=[_pending_key(key), _window_key(key)], args=[task_id])
+            if raw_submissions:
+                client.rpush(drained_key, *raw_submissions)
+                client.expire(drained_key, config.BATCH_EVALUATION_KEY_TTL_SECONDS)
+
+        raw_context = client.get(_context_key(key))
+        if not raw_context:
+            raise ValueError(f"Batch context for {key} has expired")
+        context = json.loads(raw_context)
+        submissions = [json.loads(s) for s in raw_submissions]
+
+        results = evaluate_submissions(model_choice, context["passage_content"], context["questions_data"], submissions) if submissions else {}
+        client.delete(drained_key)
+
+        metrics.increment_counter("batch_evaluation.batches")
+        logger.info(f"[BATCH EVALUATION TASK SUCCESS]. Task ID: {task_id}. Graded {len(results)} submissions.")
+        return {"status": "batch_evaluated", "results": results}
+
+    except Exception as e:
+        logger.error(f"[BATCH EVALUATION TASK FAILED]. Task ID: {task_id}, Error: {e}", exc_info=True)
+        raise self.retry(exc=e, countdown=30)
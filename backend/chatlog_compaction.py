@@ -0,0 +1,324 @@
+import json
+import gzip
+import time
+import uuid
+import hashlib
+import config
+from concurrent.futures import ThreadPoolExecutor
+from celery.schedules import crontab
+
+from backend import chatlog_sinks
+from backend import redis_setup
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Celery App Import
+try:
+    from celery_app import celery_app
+    logger.info("celery_app has been successfully imported from Celery")
+
+except ImportError as e:
+    logger.exception("An exception has occurred when importing celery_app instance."
+                     f"Ensure celery.py exist in the project root. Error: {e}")
+    raise
+
+# Optional columnar/compression libraries; without them parts fall back to gzip NDJSON
+try:
+    import pyarrow
+    import pyarrow.parquet as parquet
+except ImportError:
+    pyarrow = None
+    parquet = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Daily compaction of archived chat logs. Every flush writes a small gzipped batch under
+# chatlogs/<date>/<chat_id>/; this job merges a day's batches into a few large parts
+# under <CHATLOG_ARCHIVE_PREFIX>date=<date>/ (Hive-style, so query engines prune by date)
+# and records them in a per-day manifest kept under _manifests/, which readers skip.
+# Each part has a sidecar listing the batches it holds, so a rerun after a crash never
+# compacts the same batch twice, and sources are only deleted once the manifest lists them.
+# The scheduled run also revisits older days that still hold batches, so flushes that land
+# after a day was compacted, or days a failed run skipped, are picked up later.
+# A day is only compacted under a Redis lock, so overlapping runs (beat and the CLI, or an
+# acks_late redelivery) never interleave manifest updates. A part is written before the
+# manifest lists it; if a run dies in between, the next run deletes the unlisted part and
+# re-compacts its batches, which were never deleted, so no row is served from two parts.
+
+ARCHIVE_COLUMNS = ["day", "chat_id", "timestamp", "user", "message", "source_key"]
+
+def resolve_format():
+    """Returns (format, file extension), falling back when the optional library is missing."""
+    if config.CHATLOG_COMPACTION_FORMAT == "parquet" and parquet is not None:
+        return "parquet", ".parquet"
+    if config.CHATLOG_COMPACTION_FORMAT == "parquet":
+        logger.warning("pyarrow is not installed; compacting chat logs to NDJSON instead of Parquet.")
+    if zstandard is not None:
+        return "ndjson_zstd", ".ndjson.zst"
+    logger.warning("zstandard is not installed; compacting chat logs to gzip NDJSON.")
+    return "ndjson_gzip", ".ndjson.gz"
+
+def encode_part(rows, part_format):
+    """Returns (body, content_type, content_encoding) for one part."""
+    if part_format == "parquet":
+        table = pyarrow.Table.from_pydict({column: [row.get(column) for row in rows] for column in ARCHIVE_COLUMNS})
+        out = pyarrow.BufferOutputStream()
+        parquet.write_table(table, out, compression='zstd')
+        return out.getvalue().to_pybytes(), 'application/vnd.apache.parquet', None
+
+    ndjson = "\n".join(json.dumps(row, ensure_ascii=False) for row in rows).encode('utf-8') + b"\n"
+    if part_format == "ndjson_zstd":
+        return zstandard.ZstdCompressor(level=config.CHATLOG_COMPACTION_ZSTD_LEVEL).compress(ndjson), 'application/x-ndjson', 'zstd'
+    return gzip.compress(ndjson, mtime=0), 'application/x-ndjson', 'gzip'
+
+SOURCE_ROOT = "chatlogs/"
+
+def source_prefix(day):
+    return f"{SOURCE_ROOT}{day}/"
+
+def partition_prefix(day):
+    return f"{config.CHATLOG_ARCHIVE_PREFIX}date={day}/"
+
+def manifest_key(day):
+    return f"{config.CHATLOG_ARCHIVE_PREFIX}_manifests/date={day}/manifest.json"
+
+def sources_prefix(day):
+    return f"{config.CHATLOG_ARCHIVE_PREFIX}_manifests/date={day}/sources/"
+
+def sources_key(day, part_name):
+    return f"{sources_prefix(day)}{part_name}.json.gz"
+
+# Refreshes or releases the lock only while this run still owns it
+REFRESH_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('EXPIRE', KEYS[1], ARGV[2])
+end
+return 0
+"""
+
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+class CompactionLockLost(Exception):
+    pass
+
+class DayLock:
+    """Per-day compaction lock: SET NX with a TTL, refreshed as parts are written."""
+
+    def __init__(self, day):
+        self.key = f"{config.CHATLOG_COMPACTION_LOCK_KEY_PREFIX}{day}"
+        self.token = uuid.uuid4().hex
+        self.client = redis_setup.get_redis_client()
+
+    def acquire(self):
+        if not self.client:
+            # Without the lock, orphan cleanup could delete a concurrent run's part, so nothing runs
+            raise ConnectionError("Redis is unavailable; chat log compaction needs it for the per-day lock")
+        return bool(self.client.set(self.key, self.token, nx=True, ex=config.CHATLOG_COMPACTION_LOCK_SECONDS))
+
+    def refresh(self):
+        if not self.client.eval(REFRESH_LOCK_SCRIPT, 1, self.key, self.token, config.CHATLOG_COMPACTION_LOCK_SECONDS):
+            raise CompactionLockLost(f"Lost compaction lock {self.key}; another run may own the day now")
+
+    def release(self):
+        try:
+            self.client.eval(RELEASE_LOCK_SCRIPT, 1, self.key, self.token)
+        except Exception as e:
+            logger.warning(f"Failed to release compaction lock {self.key}: {e}")
+
+def load_manifest(sink, day):
+    try:
+        return json.loads(sink.get(manifest_key(day)).decode('utf-8'))
+    except FileNotFoundError:
+        return None
+
+def load_compacted_sources(sink, manifest):
+    compacted = set()
+    for part in (manifest or {}).get("parts", []):
+        compacted.update(json.loads(gzip.decompress(sink.get(part["sources_key"])).decode('utf-8')))
+    return compacted
+
+def read_source_rows(sink, day, key):
+    """Decodes one flush batch into archive rows; returns None if the object cannot be read."""
+    try:
+        entries = json.loads(gzip.decompress(sink.get(key)).decode('utf-8'))
+    except Exception as e:
+        logger.error(f"Skipping unreadable chat log batch {key}: {e}", exc_info=True)
+        return None
+
+    # chatlogs/<date>/<chat_id>/batch_<hash>.json.gz
+    chat_id = key.split('/')[2]
+    return [
+        {"day": day, "chat_id": chat_id, "timestamp": str(entry.get("timestamp", "")), "user": str(entry.get("user", "")),
+         "message": str(entry.get("message", "")), "source_key": key}
+        for entry in entries if isinstance(entry, dict)
+    ]
+
+def remove_orphan_parts(sink, day, manifest):
+    """Deletes parts (and their sidecars) that a crashed run wrote but never listed in the manifest."""
+    listed = {part["key"] for part in manifest["parts"]}
+    listed_sources = {part["sources_key"] for part in manifest["parts"]}
+    orphans = [k for k in sink.list_keys(partition_prefix(day)) if k not in listed]
+    orphans += [k for k in sink.list_keys(sources_prefix(day)) if k not in listed_sources]
+    if orphans:
+        logger.warning(f"Deleting {len(orphans)} unlisted compaction objects for {day}: {orphans[:5]}")
+        sink.delete(orphans)
+    return len(orphans)
+
+def write_part(sink, day, manifest, part_format, extension, rows, part_sources):
+    """Writes a part and its sources sidecar, then records it in the manifest."""
+    rows.sort(key=lambda row: (row["chat_id"], row["timestamp"]))
+    # Named after its sources, so a retried run rewrites the same part instead of adding one
+    sources_digest = hashlib.sha256("\n".join(part_sources).encode('utf-8')).hexdigest()[:16]
+    part_name = f"part-{sources_digest}"
+    part_key = f"{partition_prefix(day)}{part_name}{extension}"
+
+    body, content_type, content_encoding = encode_part(rows, part_format)
+    sink.write(part_key, body, content_type=content_type, content_encoding=content_encoding)
+    sink.write(sources_key(day, part_name), gzip.compress(json.dumps(part_sources).encode('utf-8'), mtime=0),
+               content_type='application/json', content_encoding='gzip')
+
+    timestamps = [row["timestamp"] for row in rows if row["timestamp"]]
+    part = {
+        "key": part_key,
+        "format": part_format,
+        "rows": len(rows),
+        "bytes": len(body),
+        "chats": len({row["chat_id"] for row in rows}),
+        "source_objects": len(part_sources),
+        "min_timestamp": min(timestamps) if timestamps else None,
+        "max_timestamp": max(timestamps) if timestamps else None,
+        "sources_key": sources_key(day, part_name),
+    }
+    manifest["parts"] = [p for p in manifest["parts"] if p["key"] != part_key] + [part]
+    manifest["row_count"] = sum(p["rows"] for p in manifest["parts"])
+    manifest["source_object_count"] = sum(p["source_objects"] for p in manifest["parts"])
+    manifest["updated_at"] = time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())
+    sink.write(manifest_key(day), json.dumps(manifest, indent=2).encode('utf-8'), content_type='application/json')
+
+    logger.info(f"Wrote {part_key}: {len(rows)} rows from {len(part_sources)} batches ({len(body)} bytes).")
+    return part
+
+def compact_day(day, sink=None):
+    """
+    Merges the day's small chat log batches into large parts. Safe to re-run; late batches become
+    new parts. Returns a summary, or a 'locked' summary if another run is compacting the day.
+    """
+    sink = sink or chatlog_sinks.get_sink()
+    lock = DayLock(day)
+    if not lock.acquire():
+        logger.info(f"Chat log compaction for {day} is already running elsewhere; skipping.")
+        return {"date": day, "status": "locked"}
+    try:
+        return _compact_day_locked(day, sink, lock)
+    finally:
+        lock.release()
+
+def _compact_day_locked(day, sink, lock):
+    part_format, extension = resolve_format()
+    manifest = load_manifest(sink, day) or {"date": day, "parts": [], "row_count": 0, "source_object_count": 0}
+    remove_orphan_parts(sink, day, manifest)
+
+    compacted = load_compacted_sources(sink, manifest)
+    source_keys = sorted(k for k in sink.list_keys(source_prefix(day)) if k.endswith(".json.gz"))
+    leftovers = [k for k in source_keys if k in compacted]
+    pending = [k for k in source_keys if k not in compacted]
+
+    # Batches already in a part whose deletion was interrupted on an earlier run
+    if leftovers and config.CHATLOG_COMPACTION_DELETE_SOURCES:
+        sink.delete(leftovers)
+
+    new_parts = []
+    rows = []
+    rows_bytes = 0
+    part_sources = []
+    batch_size = config.CHATLOG_COMPACTION_FETCH_BATCH_SIZE
+    with ThreadPoolExecutor(max_workers=config.CHATLOG_SINK_MAX_WORKERS) as executor:
+        for start in range(0, len(pending), batch_size):
+            keys = pending[start:start + batch_size]
+            for key, source_rows in zip(keys, executor.map(lambda k: read_source_rows(sink, day, k), keys)):
+                if source_rows is None:
+                    continue
+                rows.extend(source_rows)
+                rows_bytes += sum(len(row["message"]) + len(row["user"]) + len(row["timestamp"]) + len(row["chat_id"])
+                                  for row in source_rows)
+                part_sources.append(key)
+
+                if (len(rows) >= config.CHATLOG_COMPACTION_ROWS_PER_PART
+                        or rows_bytes >= config.CHATLOG_COMPACTION_PART_MAX_BYTES):
+                    lock.refresh()
+                    new_parts.append(write_part(sink, day, manifest, part_format, extension, rows, part_sources))
+                    if config.CHATLOG_COMPACTION_DELETE_SOURCES:
+                        sink.delete(part_sources)
+                    rows, rows_bytes, part_sources = [], 0, []
+
+    if part_sources:
+        lock.refresh()
+        new_parts.append(write_part(sink, day, manifest, part_format, extension, rows, part_sources))
+        if config.CHATLOG_COMPACTION_DELETE_SOURCES:
+            sink.delete(part_sources)
+
+    summary = {
+        "date": day,
+        "format": part_format,
+        "new_parts": len(new_parts),
+        "rows": sum(p["rows"] for p in new_parts),
+        "source_objects": sum(p["source_objects"] for p in new_parts),
+        "skipped_objects": len(pending) - sum(p["source_objects"] for p in new_parts),
+        "total_parts": len(manifest["parts"]),
+    }
+    logger.info(f"Compacted chat logs for {day}: {summary}")
+    return summary
+
+def default_compaction_day():
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time() - config.CHATLOG_COMPACTION_LAG_DAYS * 86400))
+
+def days_with_sources(sink, through_day):
+    """Days up to through_day that still have uncompacted batches, oldest first."""
+    days = []
+    for prefix in sink.list_prefixes(SOURCE_ROOT):
+        day = prefix[len(SOURCE_ROOT):].rstrip('/')
+        try:
+            time.strptime(day, "%Y-%m-%d")
+        except ValueError:
+            continue
+        if day <= through_day:
+            days.append(day)
+    return sorted(days)
+
+def scheduled_compaction_days(sink):
+    """The scheduled day plus the oldest earlier days with leftover batches, up to CHATLOG_COMPACTION_MAX_DAYS_PER_RUN."""
+    day = default_compaction_day()
+    backlog = [d for d in days_with_sources(sink, day) if d != day]
+    return [day] + backlog[:config.CHATLOG_COMPACTION_MAX_DAYS_PER_RUN - 1]
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=600, acks_late=True)
+def compact_chat_logs_task(self, day=None):
+    sink = chatlog_sinks.get_sink()
+    days = [day] if day else scheduled_compaction_days(sink)
+    logger.info(f"[CHAT LOG COMPACTION START]. Task ID: {self.request.id}, Days: {days}")
+    try:
+        # Days already compacted are skipped on a retry: their batches are in the manifest and gone
+        return [compact_day(d, sink) for d in days]
+
+    except Exception as e:
+        logger.error(f"[CHAT LOG COMPACTION FAILED]. Days: {days}, Error: {e}", exc_info=True)
+        raise self.retry(exc=e)
+
+@celery_app.on_after_finalize.connect
+def setup_compaction_schedule(sender, **kwargs):
+    sender.add_periodic_task(
+        crontab(hour=config.CHATLOG_COMPACTION_CRON_HOUR, minute=config.CHATLOG_COMPACTION_CRON_MINUTE),
+        compact_chat_logs_task.s(),
+        name='compact_chat_logs_daily'
+    )
+    logger.info(f"Scheduled periodic task: compact_chat_logs_daily at "
+                f"{config.CHATLOG_COMPACTION_CRON_HOUR:02d}:{config.CHATLOG_COMPACTION_CRON_MINUTE:02d}")
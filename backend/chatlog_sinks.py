@@ -0,0 +1,191 @@
+import os
+import io
+import uuid
+import config
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# boto3 is only needed by S3Sink; the local sink and its benchmark run without it
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+
+# Storage sinks for archived chat logs. Objects are addressed by '/'-separated keys
+# (chatlogs/<date>/<chat_id>/batch_<hash>.json.gz) on every backend, so the flush
+# tasks and the benchmarks do not care where the bytes land.
+# S3Sink covers AWS and S3-compatible endpoints (MinIO); LocalSink writes under a
+# directory and needs no credentials.
+
+class ChatLogSink:
+    """
+    Base sink. Subclasses implement write, get, list_keys, list_prefixes and delete;
+    get raises FileNotFoundError for a missing key on every backend.
+    """
+
+    def write(self, key, body, content_type='application/json', content_encoding=None):
+        raise NotImplementedError
+
+    def write_many(self, objects, content_type='application/json', content_encoding=None):
+        """
+        Writes (key, body) pairs concurrently. Returns {key: exception} for the writes that
+        failed; an empty dict means every object was stored.
+        """
+        objects = list(objects)
+        if not objects:
+            return {}
+
+        def write_one(item):
+            key, body = item
+            try:
+                self.write(key, body, content_type, content_encoding)
+                return key, None
+            except Exception as e:
+                logger.error(f"Failed to write chat log object {key}: {e}", exc_info=True)
+                return key, e
+
+        with ThreadPoolExecutor(max_workers=min(config.CHATLOG_SINK_MAX_WORKERS, len(objects))) as executor:
+            return {key: error for key, error in executor.map(write_one, objects) if error is not None}
+
+    def get(self, key):
+        raise NotImplementedError
+
+    def list_keys(self, prefix=""):
+        raise NotImplementedError
+
+    def list_prefixes(self, prefix):
+        """Yields the '/'-terminated sub-prefixes one level below prefix, without listing the objects under them."""
+        raise NotImplementedError
+
+    def delete(self, keys):
+        raise NotImplementedError
+
+    def uri(self, key):
+        return key
+
+class S3Sink(ChatLogSink):
+    def __init__(self, bucket, endpoint_url=None):
+        if not bucket:
+            raise ValueError("S3 sink needs a bucket name (AWS_BUCKET_NAME)")
+        if boto3 is None:
+            raise ImportError("boto3 is required for the S3 chat log sink")
+        self.bucket = bucket
+        self.client = boto3.client('s3', endpoint_url=endpoint_url)
+        self.transfer_config = TransferConfig(multipart_threshold=config.CHATLOG_SINK_MULTIPART_THRESHOLD_BYTES,
+                                              multipart_chunksize=config.CHATLOG_SINK_MULTIPART_THRESHOLD_BYTES,
+                                              max_concurrency=config.CHATLOG_SINK_MAX_WORKERS)
+
+    def write(self, key, body, content_type='application/json', content_encoding=None):
+        extra_args = {'ContentType': content_type}
+        if content_encoding:
+            extra_args['ContentEncoding'] = content_encoding
+
+        if len(body) < config.CHATLOG_SINK_MULTIPART_THRESHOLD_BYTES:
+            self.client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra_args)
+        else:
+            # Multipart upload with parts sent concurrently by the transfer manager
+            self.client.upload_fileobj(io.BytesIO(body), self.bucket, key, ExtraArgs=extra_args, Config=self.transfer_config)
+
+    def get(self, key):
+        try:
+            return self.client.get_object(Bucket=self.bucket, Key=key)['Body'].read()
+        except self.client.exceptions.NoSuchKey:
+            raise FileNotFoundError(self.uri(key))
+
+    def list_keys(self, prefix=""):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item['Key']
+
+    def list_prefixes(self, prefix):
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for item in page.get('CommonPrefixes', []):
+                yield item['Prefix']
+
+    def delete(self, keys):
+        keys = list(keys)
+        # DeleteObjects takes at most 1000 keys per request
+        for start in range(0, len(keys), 1000):
+            chunk = keys[start:start + 1000]
+            response = self.client.delete_objects(Bucket=self.bucket,
+                                                  Delete={'Objects': [{'Key': k} for k in chunk], 'Quiet': True})
+            for error in response.get('Errors', []):
+                logger.error(f"Failed to delete s3://{self.bucket}/{error.get('Key')}: {error.get('Message')}")
+
+    def uri(self, key):
+        return f"s3://{self.bucket}/{key}"
+
+class LocalSink(ChatLogSink):
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+
+    def _path(self, key):
+        path = os.path.abspath(os.path.join(self.root, *key.split('/')))
+        if not path.startswith(self.root + os.sep):
+            raise ValueError(f"Key {key!r} resolves outside the sink directory")
+        return path
+
+    def write(self, key, body, content_type='application/json', content_encoding=None):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Written to a temporary name and renamed, so readers never see a partial object
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(body)
+        os.replace(temp_path, path)
+
+    def get(self, key):
+        with open(self._path(key), 'rb') as f:
+            return f.read()
+
+    def list_keys(self, prefix=""):
+        # Walks only the deepest directory the prefix names, not the whole sink
+        directory_key = prefix.rsplit('/', 1)[0] if '/' in prefix else ""
+        start = self._path(directory_key) if directory_key else self.root
+        for directory, _, filenames in os.walk(start):
+            for filename in filenames:
+                if filename.endswith('.tmp'):
+                    continue
+                key = os.path.relpath(os.path.join(directory, filename), self.root).replace(os.sep, '/')
+                if key.startswith(prefix):
+                    yield key
+
+    def list_prefixes(self, prefix):
+        try:
+            entries = sorted(os.scandir(self._path(prefix.rstrip('/'))), key=lambda entry: entry.name)
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_dir():
+                yield f"{prefix}{entry.name}/"
+
+    def delete(self, keys):
+        for key in keys:
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+
+    def uri(self, key):
+        return f"file://{self._path(key)}"
+
+def create_sink(kind=None):
+    kind = (kind or config.CHATLOG_SINK).lower()
+    if kind == "local":
+        return LocalSink(config.CHATLOG_SINK_LOCAL_DIR)
+    if kind == "s3":
+        return S3Sink(config.AWS_BUCKET_NAME, endpoint_url=config.CHATLOG_S3_ENDPOINT_URL)
+    raise ValueError(f"Unknown CHATLOG_SINK {kind!r}; expected 's3' or 'local'")
+
+@lru_cache(maxsize=1)
+def get_sink():
+    """The configured sink, created once per process."""
+    sink = create_sink()
+    logger.info(f"Chat log sink: {type(sink).__name__} ({config.CHATLOG_SINK})")
+    return sink
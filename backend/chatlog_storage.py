@@ -1,7 +1,9 @@
-import boto3
+import os
 import json
+import zlib
 import gzip
 import uuid
+import hashlib
 import config # Your project's config
 import redis
 import io
@@ -10,7 +12,8 @@ import time
 # *** REMOVED all 'datetime' imports ***
 from celery.schedules import crontab # Keep this if needed for celery beat schedules elsewhere
 from botocore.exceptions import ClientError
-from functools import lru_cache
+from backend import chatlog_sinks
+from backend import metrics
 import logging
 
 logger = logging.getLogger(config.APP_NAME)
@@ -24,20 +27,23 @@ except ImportError as e:
     raise
 
 # AWS and Redis config reading
-bucket_name = config.AWS_BUCKET_NAME
 try:
     log_buffer_threshold = int(config.LOG_BUFFER_THRESHOLD)
     log_buffer_ttl_seconds = int(config.LOG_BUFFER_TTL_SECONDS)
+    log_flush_debounce_seconds = int(config.LOG_FLUSH_DEBOUNCE_SECONDS)
 except (TypeError, ValueError):
-    logger.error("Invalid LOG_BUFFER_THRESHOLD or LOG_BUFFER_TTL_SECONDS in config. Using defaults.")
+    logger.error("Invalid LOG_BUFFER_THRESHOLD, LOG_BUFFER_TTL_SECONDS or LOG_FLUSH_DEBOUNCE_SECONDS in config. Using defaults.")
     log_buffer_threshold = 100
     log_buffer_ttl_seconds = 3600
+    log_flush_debounce_seconds = 30
 
 # Redis Initialization
 redis_client = None
 redis_log_prefix = "chatlogs_list:" # Default prefix
+redis_staging_prefix = "chatlogs_staging:"
 try:
     redis_log_prefix = config.REDIS_LOG_LIST_KEY_PREFIX
+    redis_staging_prefix = config.REDIS_LOG_STAGING_KEY_PREFIX
     redis_client = redis.StrictRedis(
         host=config.REDIS_HOST,
         port=config.REDIS_PORT,
@@ -53,14 +59,6 @@ except Exception as e:
 
 
 # Core Functions
-@lru_cache(maxsize=1)
-def get_s3_client():
-    try:
-        return boto3.client('s3')
-    except Exception as e:
-        logger.error(f"Failed to create S3 client: {e}", exc_info=True)
-        return None
-
 # --- TIMESTAMP FUNCTION using only 'time' module ---
 def get_utc_iso_timestamp_from_time():
      """Generates an ISO8601-like UTC timestamp string using only the time module."""
@@ -79,24 +77,22 @@ def get_utc_iso_timestamp_from_time():
         # Fallback to simple epoch time as string
         return str(time.time()) + "_fallback_epoch"
 
-def generate_filename(chat_id):
-    """Generates a unique S3 filename using only the time module."""
+def generate_filename(chat_id, compressed_payload, log_entries):
+    """
+    Generates an S3 key derived from the batch content, so re-uploading the same batch
+    (a retried flush) overwrites the same object instead of creating a duplicate.
+    """
     try:
         safe_chat_id = str(chat_id).replace(":", "_").replace("/", "_").replace("\\", "_").replace("..", "_")
 
-        # Get current time info using 'time'
-        current_unix_time = time.time()
-        utc_struct_time = time.gmtime(current_unix_time) # Get UTC breakdown
-
-        # Create date folder string (YYYY-MM-DD) using strftime
-        date_folder = time.strftime("%Y-%m-%d", utc_struct_time)
+        # Date folder from the first entry's timestamp, so a retry after midnight still maps to the same key
+        first_timestamp = str(log_entries[0].get('timestamp', '')) if log_entries else ''
+        date_folder = first_timestamp[:10] if len(first_timestamp) >= 10 and first_timestamp[4] == '-' \
+            else time.strftime("%Y-%m-%d", time.gmtime())
 
-        # Create file-safe timestamp string (YYYY-MM-DD_HH-MM-SS) using strftime
-        timestamp_for_file = time.strftime("%Y-%m-%d_%H-%M-%S", utc_struct_time)
+        content_hash = hashlib.sha256(compressed_payload).hexdigest()[:16]
 
-        uid = uuid.uuid4().hex[:8]
-
-        s3_key = f"chatlogs/{date_folder}/{safe_chat_id}/batch_{timestamp_for_file}_{uid}.json.gz"
+        s3_key = f"chatlogs/{date_folder}/{safe_chat_id}/batch_{content_hash}.json.gz"
         return s3_key
 
     except Exception as e:
@@ -115,13 +111,140 @@ def compress_json_payload(log_entries):
         json_string = json.dumps(log_entries)
         json_bytes = json_string.encode('utf-8')
         out = io.BytesIO()
-        with gzip.GzipFile(fileobj=out, mode="wb") as f:
+        # mtime=0 keeps the bytes (and so the content-hash S3 key) identical for identical batches
+        with gzip.GzipFile(fileobj=out, mode="wb", mtime=0) as f:
             f.write(json_bytes)
         return out.getvalue()
     except Exception as e:
          logger.error(f"Error during JSON compression: {e}", exc_info=True)
          return None
 
+# Atomic drain: the live buffer is renamed to a staging key owned by this flush task.
+# Producers keep RPUSHing to a fresh list under the original key, nothing is read and
+# deleted separately, and a concurrent flush finds no buffer to take. A retried task
+# (same task ID) finds its staging key still present and re-reads the same batch.
+# Every staging key is indexed in LOG_STAGING_SET_KEY, scored by its last drain, so the
+# periodic flusher finds abandoned ones without scanning the keyspace.
+DRAIN_BUFFER_SCRIPT = """
+if redis.call('EXISTS', KEYS[2]) == 0 then
+    redis.call('ZREM', KEYS[3], ARGV[2])
+    if redis.call('EXISTS', KEYS[1]) == 0 then
+        return {}
+    end
+    redis.call('RENAME', KEYS[1], KEYS[2])
+end
+redis.call('EXPIRE', KEYS[2], ARGV[1])
+redis.call('ZADD', KEYS[4], ARGV[3], KEYS[2])
+return redis.call('LRANGE', KEYS[2], 0, -1)
+"""
+
+drain_buffer_script = None
+
+def drain_chat_log_buffer(chat_id, staging_key):
+    """Moves the chat's buffer to staging_key in one step and returns its entries."""
+    global drain_buffer_script
+    if not drain_buffer_script:
+        drain_buffer_script = redis_client.register_script(DRAIN_BUFFER_SCRIPT)
+    return drain_buffer_script(keys=[f"{redis_log_prefix}{chat_id}", staging_key, config.LOG_DIRTY_SET_KEY,
+                                     config.LOG_STAGING_SET_KEY],
+                               args=[log_buffer_ttl_seconds, str(chat_id), time.time()])
+
+def delete_staged_batch(staging_key):
+    """Drops a staged batch once it is stored, along with its index entry."""
+    pipeline = redis_client.pipeline()
+    pipeline.delete(staging_key)
+    pipeline.zrem(config.LOG_STAGING_SET_KEY, staging_key)
+    pipeline.execute()
+
+# Puts a failed batch back in front of anything buffered since, so the next flush retries it.
+# With ARGV[4] set, a staging key drained after that time (a live retry) is left alone.
+RESTORE_BUFFER_SCRIPT = """
+if ARGV[4] then
+    local drained_at = redis.call('ZSCORE', KEYS[4], KEYS[2])
+    if drained_at and tonumber(drained_at) > tonumber(ARGV[4]) then
+        return -1
+    end
+end
+local staged = redis.call('LRANGE', KEYS[2], 0, -1)
+for i = #staged, 1, -1 do
+    redis.call('LPUSH', KEYS[1], staged[i])
+end
+redis.call('DEL', KEYS[2])
+redis.call('ZREM', KEYS[4], KEYS[2])
+if #staged > 0 then
+    redis.call('EXPIRE', KEYS[1], ARGV[1])
+    redis.call('ZADD', KEYS[3], 'NX', ARGV[3], ARGV[2])
+end
+return #staged
+"""
+
+def restore_staged_buffer(chat_id, staging_key, drained_before=None):
+    args = [log_buffer_ttl_seconds, str(chat_id), time.time()] + ([drained_before] if drained_before is not None else [])
+    try:
+        return redis_client.eval(RESTORE_BUFFER_SCRIPT, 4, f"{redis_log_prefix}{chat_id}", staging_key, config.LOG_DIRTY_SET_KEY,
+                                 config.LOG_STAGING_SET_KEY, *args)
+    except Exception as e:
+        logger.error(f"Failed to restore staged chat logs {staging_key} for chat_id {chat_id}: {e}", exc_info=True)
+        return None
+
+def sweep_stale_staging_keys():
+    """
+    Returns staged batches abandoned by a lost or crashed flush task to their buffers before
+    the staging key expires. A task re-scores its key in the staging index on every attempt,
+    so a key not drained for LOG_STAGING_STALE_SECONDS has no task working on it. Keys that
+    already expired are just dropped from the index.
+    """
+    drained_before = time.time() - config.LOG_STAGING_STALE_SECONDS
+    restored = 0
+    while True:
+        stale_keys = redis_client.zrangebyscore(config.LOG_STAGING_SET_KEY, '-inf', drained_before,
+                                                start=0, num=config.LOG_STAGING_SWEEP_BATCH_SIZE)
+        for staging_key in stale_keys:
+            staging_key = staging_key.decode('utf-8')
+            # chatlogs_staging:<chat_id>:<task_id>
+            chat_id = staging_key[len(redis_staging_prefix):].rsplit(':', 1)[0]
+            count = restore_staged_buffer(chat_id, staging_key, drained_before=drained_before)
+            if count is None:
+                # Restore failed; leave the rest for the next run rather than loop on the same members
+                return restored
+            if count > 0:
+                logger.warning(f"Restored {count} chat log entries from stale staging key {staging_key}.")
+                restored += 1
+        if len(stale_keys) < config.LOG_STAGING_SWEEP_BATCH_SIZE:
+            return restored
+
+def encode_log_batch(chat_id, log_entries):
+    """Returns (key, gzipped payload) for one chat's entries; raises if compression fails."""
+    compressed_payload = compress_json_payload(log_entries)
+    if compressed_payload is None:
+         logger.error(f"Compression failed for chat_id {chat_id}. Logs might be lost.")
+         raise ValueError("Compression failed")
+    return generate_filename(chat_id, compressed_payload, log_entries), compressed_payload
+
+def write_log_batch(chat_id, log_entries):
+    """Compresses one chat's entries and writes them to the configured sink. Returns the key; raises on failure."""
+    filename, compressed_payload = encode_log_batch(chat_id, log_entries)
+    chatlog_sinks.get_sink().write(filename, compressed_payload, content_type='application/json', content_encoding='gzip')
+    return filename
+
+def write_log_batches(batches):
+    """Writes {chat_id: entries} as one object per chat in a single bulk write. Returns the chat IDs that failed."""
+    keys_by_chat = {}
+    objects = []
+    failed_chats = set()
+    for chat_id, log_entries in batches.items():
+        try:
+            filename, compressed_payload = encode_log_batch(chat_id, log_entries)
+        except Exception:
+            failed_chats.add(chat_id)
+            continue
+        keys_by_chat[chat_id] = filename
+        objects.append((filename, compressed_payload))
+
+    errors = chatlog_sinks.get_sink().write_many(objects, content_type='application/json', content_encoding='gzip')
+    failed_chats.update(chat_id for chat_id, filename in keys_by_chat.items() if filename in errors)
+    return failed_chats
+
 # Celery Tasks
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=60, acks_late=True)
 def store_batch_chat_logs_task(self, chat_id):
@@ -130,13 +253,15 @@ def store_batch_chat_logs_task(self, chat_id):
     if not redis_client:
         logger.error(f"Redis client not available. Cannot store logs for chat_id: {chat_id}")
         return {"status": "failed_no_redis", "chat_id": chat_id}
-    redis_key = f"{redis_log_prefix}{chat_id}"
+    redis_key = f"{redis_staging_prefix}{chat_id}:{self.request.id}"
     filename = None
     processed_count = 0
     try:
-        log_entries_bytes = redis_client.lrange(redis_key, 0, -1)
+        log_entries_bytes = drain_chat_log_buffer(chat_id, redis_key)
+        # The live buffer is empty again, so the next threshold crossing may schedule a new flush
+        clear_flush_marker(chat_id)
         if not log_entries_bytes:
-             logger.info(f"No log entries found in Redis for chat_id: {chat_id}. Key: {redis_key}")
+             logger.info(f"No log entries found in Redis for chat_id: {chat_id}. Another flush may have taken them.")
              return {"status": "no_logs_found", "chat_id": chat_id}
         log_entries = []
         for i, entry_bytes in enumerate(log_entries_bytes):
@@ -146,37 +271,50 @@ def store_batch_chat_logs_task(self, chat_id):
                  logger.warning(f"Error decoding/parsing log entry at index {i} for chat_id {chat_id}, key {redis_key}: {decode_e}. Skipping entry.")
         if not log_entries:
             logger.warning(f"No valid log entries decoded for chat_id: {chat_id}. Deleting Redis key {redis_key}.")
-            try: redis_client.delete(redis_key)
+            try: delete_staged_batch(redis_key)
             except Exception as del_e: logger.error(f"Redis error deleting key {redis_key} after decode failure: {del_e}")
             return {"status": "decoding_failed", "chat_id": chat_id}
 
-        compressed_payload = compress_json_payload(log_entries)
-        if compressed_payload is None:
-             logger.error(f"Compression failed for chat_id {chat_id}. Logs might be lost.")
-             raise ValueError("Compression failed")
-
-        filename = generate_filename(chat_id)
-        s3 = get_s3_client()
-        if not s3:
-            logger.error(f"Failed to get S3 client. Cannot store logs for chat_id: {chat_id}")
-            raise ConnectionError("S3 client unavailable.")
-
-        s3.put_object(Bucket=bucket_name, Key=filename, Body=compressed_payload, ContentType='application/json', ContentEncoding='gzip')
+        filename = write_log_batch(chat_id, log_entries)
         processed_count = len(log_entries)
-        logger.info(f"Stored logs for chat_id {chat_id} to s3://{bucket_name}/{filename} ({processed_count} entries).")
+        s3_path = chatlog_sinks.get_sink().uri(filename)
+        logger.info(f"Stored logs for chat_id {chat_id} to {s3_path} ({processed_count} entries).")
 
-        try: redis_client.delete(redis_key)
-        except Exception as del_e: logger.error(f"Redis error deleting key {redis_key} after S3 upload: {del_e}.")
+        # Only the staged batch is removed; entries buffered since the drain stay in the live list
+        try: delete_staged_batch(redis_key)
+        except Exception as del_e: logger.error(f"Redis error deleting staging key {redis_key} after S3 upload: {del_e}.")
 
-        return {"status": "success", "chat_id": chat_id, "s3_path": f"s3://{bucket_name}/{filename}", "count": processed_count}
+        return {"status": "success", "chat_id": chat_id, "s3_path": s3_path, "count": processed_count}
 
     except Exception as e:
          logger.error(f"Error in store_batch_chat_logs_task for {chat_id}: {e}", exc_info=True)
-         try: raise self.retry(exc=e)
-         except self.MaxRetriesExceededError:
-             logger.critical(f"Max retries exceeded for storing logs for chat_id {chat_id}.")
+         # self.retry(exc=e) re-raises e once retries run out, so the last attempt is detected up front
+         if self.request.retries >= self.max_retries:
+             logger.critical(f"Max retries exceeded for storing logs for chat_id {chat_id}. Returning staged entries to the buffer.")
+             restore_staged_buffer(chat_id, redis_key)
              return {"status": "failed_max_retries", "chat_id": chat_id}
+         raise self.retry(exc=e)
+
+
+def flush_marker_key(chat_id):
+    return f"{config.LOG_FLUSH_MARKER_KEY_PREFIX}{chat_id}"
 
+def schedule_flush(chat_id):
+    """
+    Enqueues a flush unless one is already pending for this chat. The marker is set with
+    SET NX EX, so concurrent producers race for it and only the winner enqueues; the expiry
+    re-arms scheduling if a flush task is lost.
+    """
+    if redis_client.set(flush_marker_key(chat_id), b"1", nx=True, ex=log_flush_debounce_seconds):
+        store_batch_chat_logs_task.delay(chat_id)
+        return True
+    return False
+
+def clear_flush_marker(chat_id):
+    try:
+        redis_client.delete(flush_marker_key(chat_id))
+    except Exception as e:
+        logger.warning(f"Failed to clear flush marker for chat_id {chat_id}: {e}")
 
 def buffer_chat_log(chat_id, user, message):
     """Appends a chat log entry to the Redis buffer list using time module."""
@@ -189,6 +327,10 @@ def buffer_chat_log(chat_id, user, message):
     # *** ---------------------------- ***
 
     log_entry = {'timestamp': timestamp_str, 'user': user, 'message': message}
+    if config.CHATLOG_TRANSPORT == "stream":
+        append_to_stream(chat_id, log_entry)
+        return
+
     key = f"{redis_log_prefix}{chat_id}"
 
     try:
@@ -196,14 +338,15 @@ def buffer_chat_log(chat_id, user, message):
         pipeline = redis_client.pipeline()
         pipeline.rpush(key, entry_bytes)
         pipeline.expire(key, log_buffer_ttl_seconds)
+        # NX keeps the score at the first unflushed entry; the drain removes the member
+        pipeline.zadd(config.LOG_DIRTY_SET_KEY, {str(chat_id): time.time()}, nx=True)
         results = pipeline.execute()
         current_length = results[0]
 
         logger.debug(f"Buffered log for chat_id {chat_id}. New buffer length: {current_length}")
 
-        if current_length >= log_buffer_threshold:
+        if current_length >= log_buffer_threshold and schedule_flush(chat_id):
             logger.info(f"Log buffer threshold reached ({current_length}/{log_buffer_threshold}) for chat_id {chat_id}. Triggering S3 storage task.")
-            store_batch_chat_logs_task.delay(chat_id)
 
     except redis.exceptions.RedisError as e:
         logger.error(f"Redis error buffering log for {chat_id} (key: {key}): {e}", exc_info=True)
@@ -211,45 +354,221 @@ def buffer_chat_log(chat_id, user, message):
         logger.error(f"Unexpected error buffering log for {chat_id} (key: {key}): {e}", exc_info=True)
 
 
-# Periodic Task (still needs investigation for the Celery internal error if enabled)
+# Stream Transport
+# With CHATLOG_TRANSPORT = "stream", entries from every chat go to a few sharded Redis
+# Streams instead of one list per chat. A consumer group reads them in large batches
+# that span many chats, so the work per run depends on the entry volume, not on the
+# number of open sessions: no dirty set, no per-chat markers and no task per chat.
+# Entries are acknowledged only after their S3 object is written; entries left pending
+# by a consumer that died are reclaimed with XAUTOCLAIM once they have been idle for
+# CHATLOG_STREAM_CLAIM_IDLE_MS. Delivery is at-least-once.
+def stream_key_for_chat(chat_id):
+    shard = zlib.crc32(str(chat_id).encode('utf-8')) % config.CHATLOG_STREAM_SHARDS
+    return f"{config.CHATLOG_STREAM_KEY_PREFIX}{shard}"
+
+def stream_keys():
+    return [f"{config.CHATLOG_STREAM_KEY_PREFIX}{shard}" for shard in range(config.CHATLOG_STREAM_SHARDS)]
+
+def append_to_stream(chat_id, log_entry):
+    key = stream_key_for_chat(chat_id)
+    try:
+        # No MAXLEN: trimming would drop entries no consumer has written yet. Written entries are XDEL'd instead.
+        redis_client.xadd(key, {b"chat_id": str(chat_id).encode('utf-8'), b"entry": json.dumps(log_entry).encode('utf-8')})
+        logger.debug(f"Appended log for chat_id {chat_id} to {key}.")
+    except redis.exceptions.RedisError as e:
+        logger.error(f"Redis error appending log for {chat_id} to stream {key}: {e}", exc_info=True)
+
+stream_groups_ready = False
+
+def ensure_stream_groups():
+    """Creates the consumer group on every shard (idempotent)."""
+    global stream_groups_ready
+    if stream_groups_ready:
+        return
+    for key in stream_keys():
+        try:
+            redis_client.xgroup_create(key, config.CHATLOG_STREAM_GROUP, id="0", mkstream=True)
+        except redis.exceptions.ResponseError as e:
+            if "BUSYGROUP" not in str(e):
+                raise
+    stream_groups_ready = True
+
+def read_stream_batch(key, consumer_name, count):
+    """Reclaims entries abandoned by dead consumers first, then tops the batch up with new entries."""
+    claimed = redis_client.xautoclaim(key, config.CHATLOG_STREAM_GROUP, consumer_name,
+                                      min_idle_time=config.CHATLOG_STREAM_CLAIM_IDLE_MS, start_id="0-0", count=count)
+    messages = [m for m in claimed[1] if m[1]]
+    if messages:
+        logger.info(f"Reclaimed {len(messages)} pending chat log entries on {key}.")
+
+    if len(messages) < count:
+        response = redis_client.xreadgroup(config.CHATLOG_STREAM_GROUP, consumer_name, {key: ">"}, count=count - len(messages))
+        for _, stream_messages in response or []:
+            messages.extend(stream_messages)
+    return messages
+
+def group_entries_by_chat(messages):
+    """Returns {chat_id: (entries, message IDs)} in stream order. Undecodable entries are acknowledged with their chat."""
+    by_chat = {}
+    for message_id, fields in messages:
+        chat_id = fields.get(b"chat_id", b"unknown").decode('utf-8')
+        entries, ids = by_chat.setdefault(chat_id, ([], []))
+        ids.append(message_id)
+        try:
+            entries.append(json.loads(fields[b"entry"].decode('utf-8')))
+        except Exception as decode_e:
+            logger.warning(f"Error decoding stream entry {message_id} for chat_id {chat_id}: {decode_e}. Skipping entry.")
+    return by_chat
+
+def consume_stream_batches(consumer_name, write_batches=write_log_batches, max_batches=None):
+    """Drains every shard in batches. Returns (entries written, objects written, chats that failed)."""
+    ensure_stream_groups()
+    max_batches = config.CHATLOG_STREAM_MAX_BATCHES_PER_RUN if max_batches is None else max_batches
+    written_entries = 0
+    written_objects = 0
+    failed_chats = set()
+
+    for key in stream_keys():
+        for _ in range(max_batches):
+            messages = read_stream_batch(key, consumer_name, config.CHATLOG_STREAM_BATCH_SIZE)
+            if not messages:
+                break
+
+            by_chat = group_entries_by_chat(messages)
+            # Every chat in the batch goes out in one bulk write
+            batch_failures = write_batches({chat_id: entries for chat_id, (entries, _) in by_chat.items() if entries})
+            failed_chats.update(batch_failures)
+
+            acked = []
+            for chat_id, (entries, ids) in by_chat.items():
+                # Failed chats stay pending: reclaimed and retried once idle past CHATLOG_STREAM_CLAIM_IDLE_MS
+                if chat_id in batch_failures:
+                    continue
+                acked.extend(ids)
+                if entries:
+                    written_objects += 1
+                    written_entries += len(entries)
+
+            if acked:
+                # Acknowledged entries are also deleted, so the stream only holds unwritten ones
+                pipeline = redis_client.pipeline(transaction=False)
+                pipeline.xack(key, config.CHATLOG_STREAM_GROUP, *acked)
+                pipeline.xdel(key, *acked)
+                pipeline.execute()
+
+            if len(messages) < config.CHATLOG_STREAM_BATCH_SIZE:
+                break
+
+    return written_entries, written_objects, failed_chats
+
+def check_stream_backlog():
+    """Logs an alert for shards holding more unwritten entries than CHATLOG_STREAM_BACKLOG_ALERT_ENTRIES."""
+    pipeline = redis_client.pipeline(transaction=False)
+    for key in stream_keys():
+        pipeline.xlen(key)
+    backlog = dict(zip(stream_keys(), pipeline.execute()))
+    for key, length in backlog.items():
+        if length > config.CHATLOG_STREAM_BACKLOG_ALERT_ENTRIES:
+            metrics.increment_counter("chatlog.stream.backlog_alerts")
+            logger.critical(f"Chat log stream {key} holds {length} unwritten entries "
+                            f"(alert threshold {config.CHATLOG_STREAM_BACKLOG_ALERT_ENTRIES}). Are the consumers or the sink failing?")
+    return backlog
+
+@celery_app.task(bind=True, max_retries=3, default_retry_delay=60, acks_late=True)
+def consume_chat_log_stream_task(self):
+    """Periodic batching consumer for the stream transport. Several workers may run it at once."""
+    if not redis_client:
+        logger.error("Redis client not available. Cannot consume the chat log stream.")
+        return {"status": "failed_no_redis"}
+
+    consumer_name = f"{self.request.hostname or 'worker'}:{os.getpid()}"
+    try:
+        written_entries, written_objects, failed_chats = consume_stream_batches(consumer_name)
+        check_stream_backlog()
+        logger.info(f"Stream consumer {consumer_name} wrote {written_entries} entries in {written_objects} objects; "
+                    f"{len(failed_chats)} chat(s) left pending.")
+        return {"status": "success", "count": written_entries, "objects": written_objects, "failed_chats": len(failed_chats)}
+
+    except Exception as e:
+        logger.error(f"Error in consume_chat_log_stream_task: {e}", exc_info=True)
+        raise self.retry(exc=e)
+
+
+# Periodic Task
+# Claims due chat IDs from the dirty set in bulk. Claimed members are not removed but
+# re-scored to now, so a chat whose flush never drains comes due again on a later run.
+POP_DUE_CHATS_SCRIPT = """
+local due = redis.call('ZRANGEBYSCORE', KEYS[1], '-inf', ARGV[1], 'LIMIT', 0, tonumber(ARGV[2]))
+for _, chat_id in ipairs(due) do
+    redis.call('ZADD', KEYS[1], 'XX', ARGV[3], chat_id)
+end
+return due
+"""
+
+pop_due_chats_script = None
+
+def pop_due_chats(now, limit):
+    global pop_due_chats_script
+    if not pop_due_chats_script:
+        pop_due_chats_script = redis_client.register_script(POP_DUE_CHATS_SCRIPT)
+    cutoff = now - config.LOG_FLUSH_MAX_AGE_SECONDS
+    return pop_due_chats_script(keys=[config.LOG_DIRTY_SET_KEY], args=[cutoff, limit, now])
+
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=120, acks_late=True)
 def flush_all_chat_logs(self):
-    """Periodic task to check all chat log buffers in Redis and trigger storage if needed."""
+    """Periodic task that flushes every buffer whose oldest unflushed entry is older than LOG_FLUSH_MAX_AGE_SECONDS."""
     if not redis_client:
         logger.error("Redis client not available for periodic flush.")
         return
 
     flushed_chat_ids_count = 0
-    logger.info("Starting periodic flush of all chat logs (using time module)")
-    match_pattern = f"{redis_log_prefix}*"
+    due_count = 0
+    batch_size = config.LOG_FLUSH_POP_BATCH_SIZE
+    logger.info("Starting periodic flush of due chat logs from the dirty set")
     try:
-        keys_found = 0
-        for key_bytes in redis_client.scan_iter(match=match_pattern):
-            keys_found += 1
-            key_str = key_bytes.decode('utf-8')
-            chat_id = key_str[len(redis_log_prefix):]
-            try:
-                length = redis_client.llen(key_bytes)
-                if length > 0:
-                    logger.info(f"Periodic flush: Found non-empty buffer for chat_id {chat_id} ({length} entries). Triggering task.")
+        while True:
+            due_chat_ids = [c.decode('utf-8') for c in pop_due_chats(time.time(), batch_size)]
+            due_count += len(due_chat_ids)
+
+            # One round trip for all pending-flush markers in the batch
+            pipeline = redis_client.pipeline(transaction=False)
+            for chat_id in due_chat_ids:
+                pipeline.set(flush_marker_key(chat_id), b"1", nx=True, ex=log_flush_debounce_seconds)
+            for chat_id, acquired in zip(due_chat_ids, pipeline.execute() if due_chat_ids else []):
+                if acquired:
                     store_batch_chat_logs_task.delay(chat_id)
                     flushed_chat_ids_count += 1
-            except Exception as e: # Catch errors checking length or delaying task for specific key
-                 logger.error(f"Error processing key {key_str} during periodic flush: {e}", exc_info=True)
-        logger.info(f"Periodic flush checked {keys_found} potential keys. Triggered tasks for {flushed_chat_ids_count} chat ID(s).")
+
+            if len(due_chat_ids) < batch_size:
+                break
+
+        logger.info(f"Periodic flush found {due_count} due chat(s). Triggered tasks for {flushed_chat_ids_count} chat ID(s).")
     except Exception as e:
-        logger.error(f"Unexpected error during periodic flush scan: {e}", exc_info=True)
+        logger.error(f"Unexpected error during periodic flush: {e}", exc_info=True)
+
+    try:
+        restored = sweep_stale_staging_keys()
+        if restored:
+            logger.warning(f"Periodic flush returned {restored} abandoned staging buffer(s) to the dirty set.")
+    except Exception as e:
+        logger.error(f"Unexpected error while sweeping stale staging keys: {e}", exc_info=True)
 
 
 # Schedule periodic tasks using Celery Beat
 @celery_app.on_after_finalize.connect
 def setup_periodic_tasks(sender, **kwargs):
-    logger.warning("Periodic task 'flush_all_chat_logs' is currently DISABLED for debugging.")
-    # Keep this commented out until Celery internal ValueError is resolved
-    # logger.info("Setting up periodic tasks...")
-    # sender.add_periodic_task(
-    #     crontab(minute='*/5'),
-    #     flush_all_chat_logs.s(),
-    #     name='flush_all_chat_logs_every_5_minutes'
-    # )
-    # logger.info("Scheduled periodic task: flush_all_chat_logs_every_5_minutes")
\ No newline at end of file
+    sender.add_periodic_task(
+        float(config.LOG_PERIODIC_FLUSH_INTERVAL_SECONDS),
+        flush_all_chat_logs.s(),
+        name='flush_due_chat_logs'
+    )
+    logger.info(f"Scheduled periodic task: flush_due_chat_logs every {config.LOG_PERIODIC_FLUSH_INTERVAL_SECONDS}s")
+
+    # The list flusher stays scheduled so buffers left from before a transport switch still drain
+    if config.CHATLOG_TRANSPORT == "stream":
+        sender.add_periodic_task(
+            float(config.CHATLOG_STREAM_CONSUME_INTERVAL_SECONDS),
+            consume_chat_log_stream_task.s(),
+            name='consume_chat_log_stream'
+        )
+        logger.info(f"Scheduled periodic task: consume_chat_log_stream every {config.CHATLOG_STREAM_CONSUME_INTERVAL_SECONDS}s")
@@ -1,13 +1,68 @@
+import os
+import asyncio
 import logging
+import threading
+import weakref
 import config
+from functools import lru_cache
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
 from pinecone import Pinecone
 
+# The asyncio client ships with newer Pinecone SDKs; older ones fall back to a worker thread
+try:
+    from pinecone import PineconeAsyncio
+except ImportError:
+    PineconeAsyncio = None
+
+from backend.db_pool_setup import db_connection
+from backend import context_packer
+from backend import reranker
+
 logger = logging.getLogger(config.APP_NAME)
 
 # Set context relevance for Pinecone
 relevance_threshold = 0.85  
 
-def query_pinecone(query: str, pc: Pinecone, index, top_k=3):
+# Vector and lexical searches run side by side
+retrieval_executor = ThreadPoolExecutor(max_workers=config.RETRIEVAL_MAX_WORKERS, thread_name_prefix="retrieval")
+
+# Metadata filters (written by text_embedding.extract_filter_metadata)
+def build_metadata_filter(source_test=None, section=None, difficulty=None):
+    """
+    Builds a Pinecone metadata filter so pruning happens inside the index. Each argument
+    may be a single value or a list of accepted values; None leaves the field unrestricted.
+    """
+    conditions = {}
+    for field, value in (("source_test", source_test), ("section", section), ("difficulty", difficulty)):
+        if value is None:
+            continue
+        if isinstance(value, (list, tuple, set)):
+            conditions[field] = {"$in": list(value)}
+        else:
+            conditions[field] = {"$eq": value}
+
+    return conditions or None
+
+def format_vector_matches(query_responses):
+    return [
+        {
+            "text": match["metadata"]["text"],
+            "score": match["score"],
+            "passage_id": match["metadata"].get("passage_id"),
+            "title": match["metadata"].get("title"),
+            "source": "vector"
+        }
+        for match in query_responses["matches"]
+    ]
+
+def extract_query_embedding(embedding_responses):
+    # Ensure the response structure is valid
+    if not hasattr(embedding_responses, 'data') or not embedding_responses.data or 'values' not in embedding_responses.data[0]:
+         raise ValueError("Failed to get embedding vector from Pinecone response.")
+
+    return embedding_responses.data[0]['values']
+
+def query_pinecone(query: str, pc: Pinecone, index, top_k=3, filters=None):
     """Queries Pinecone and returns results with scores."""
     try:
         embedding_responses = pc.inference.embed(
@@ -16,39 +71,239 @@ def query_pinecone(query: str, pc: Pinecone, index, top_k=3):
             parameters={"input_type": "query"}
         )
         
-        # Ensure the response structure is valid
-        if not hasattr(embedding_responses, 'data') or not embedding_responses.data or 'values' not in embedding_responses.data[0]:
-             raise ValueError("Failed to get embedding vector from Pinecone response.")
-        
-        query_embedding = embedding_responses.data[0]['values']
+        query_embedding = extract_query_embedding(embedding_responses)
 
         query_responses = index.query(
             vector=query_embedding,
             top_k=top_k,
             include_metadata=True,
-            namespace=config.PINECONE_NAMESPACE
+            namespace=config.PINECONE_NAMESPACE,
+            filter=filters
         )
 
-        return [{"text": match["metadata"]["text"], "score": match["score"]} for match in query_responses["matches"]]
+        return format_vector_matches(query_responses)
     
     except Exception as e:
         logger.error("Pinecone query failed: %s", e, exc_info=True)
         return []
 
-def get_context_for_query(query: str, pc: Pinecone, index) -> str:
-    pinecone_results = query_pinecone(query, pc, index)
+# Lexical Search (PostgreSQL full-text)
+def setup_lexical_index():
+    """Adds a generated tsvector column over passages.text and its GIN index (idempotent)."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    ALTER TABLE passages
+                    ADD COLUMN IF NOT EXISTS text_tsv tsvector
+                    GENERATED ALWAYS AS (to_tsvector('english', coalesce(title, '') || ' ' || coalesce(text, ''))) STORED
+                    """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS passages_text_tsv_idx
+                    ON passages USING GIN (text_tsv)
+                    """)
+
+        logger.info("Lexical search column and GIN index are in place on 'passages'.")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to set up lexical search index: {e}", exc_info=True)
+        return False
+
+def query_lexical(query: str, top_k=3):
+    """Full-text search over passages.text; query terms are OR-ed and ranked by cover density."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT passage_id, title, text, ts_rank_cd(text_tsv, q, 32) AS rank
+                    FROM passages,
+                         to_tsquery('english', replace(plainto_tsquery('english', %s)::text, '&', '|')) AS q
+                    WHERE text_tsv @@ q
+                    ORDER BY rank DESC
+                    LIMIT %s
+                    """, (query, top_k))
+                rows = cur.fetchall()
+
+        return [
+            {"text": text, "score": float(rank), "passage_id": str(passage_id), "title": title, "source": "lexical"}
+            for passage_id, title, text, rank in rows
+            if rank >= config.LEXICAL_MIN_RANK
+        ]
+
+    except Exception as e:
+        logger.error("Lexical query failed: %s", e, exc_info=True)
+        return []
+
+def reciprocal_rank_fusion(result_lists, k=None, top_k=3):
+    """Fuses ranked result lists by passage ID: score = sum(1 / (k + rank))."""
+    k = config.RRF_K if k is None else k
+    fused = {}
+
+    for results in result_lists:
+        for rank, result in enumerate(results, start=1):
+            key = result.get("passage_id") or result["text"]
+            entry = fused.setdefault(key, {**result, "rrf_score": 0.0, "sources": []})
+            entry["rrf_score"] += 1.0 / (k + rank)
+            entry["sources"].append(result["source"])
+
+    return sorted(fused.values(), key=lambda r: r["rrf_score"], reverse=True)[:top_k]
+
+def fuse_hybrid_results(vector_results, lexical_results, top_k=3):
+    vector_results = [r for r in vector_results if r["score"] >= relevance_threshold]
+
+    logger.info(f"Hybrid search: {len(vector_results)} relevant vector hits, {len(lexical_results)} lexical hits.")
+    return reciprocal_rank_fusion([vector_results, lexical_results], top_k=top_k)
 
+def hybrid_search(query: str, pc: Pinecone, index, top_k=3):
+    """
+    Runs vector and lexical search concurrently and fuses them. Vector hits below the
+    relevance threshold are dropped; if the vector backend is unavailable or slower than
+    VECTOR_SEARCH_TIMEOUT_SECONDS, the lexical results are used on their own.
+    """
+    candidates = top_k * config.HYBRID_CANDIDATE_MULTIPLIER
+    lexical_future = retrieval_executor.submit(query_lexical, query, candidates)
+
+    vector_results = []
+    if pc and index:
+        vector_future = retrieval_executor.submit(query_pinecone, query, pc, index, candidates)
+        try:
+            vector_results = vector_future.result(timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            logger.warning(f"Vector search exceeded {config.VECTOR_SEARCH_TIMEOUT_SECONDS}s; falling back to lexical results.")
+    else:
+        logger.warning("Vector backend unavailable; using lexical results only.")
+
+    return fuse_hybrid_results(vector_results, lexical_future.result(), top_k=top_k)
+
+def select_vector_results(pinecone_results, query):
     if not pinecone_results:
         logger.warning("No results returned from Pinecone for query: %s", query)
+        return []
+
+    # Each hit is held to the threshold, so weak ones never reach the reranker or the prompt
+    relevant_results = [r for r in pinecone_results if r["score"] >= relevance_threshold]
+
+    if relevant_results:
+        logger.info(f"{len(relevant_results)}/{len(pinecone_results)} results meet threshold {relevance_threshold}. Using retrieved context.")
+    else:
+        logger.warning(f"Top score {pinecone_results[0]['score']:.2f} is below threshold {relevance_threshold}. Discarding context.")
+    return relevant_results
+
+def retrieve_candidates(query: str, pc: Pinecone, index, top_k=3, filters=None):
+    # The lexical index has no metadata columns, so filtered queries stay vector-only
+    if config.HYBRID_RETRIEVAL_ENABLED and not filters:
+        hybrid_results = hybrid_search(query, pc, index, top_k=top_k)
+        if not hybrid_results:
+            logger.warning("No relevant vector or lexical results for query: %s", query)
+        return hybrid_results
+
+    return select_vector_results(query_pinecone(query, pc, index, top_k=top_k, filters=filters), query)
+
+def candidate_count():
+    # With reranking on, over-fetch candidates and keep only the best few for the prompt
+    return config.RERANK_CANDIDATES if config.RERANK_ENABLED else 3
+
+def finalize_context(query, results):
+    if not results:
         return ""
 
-    top_score = pinecone_results[0]["score"]
-    
-    if top_score >= relevance_threshold:
-        logger.info(f"Top score {top_score:.2f} meets threshold. Using retrieved context.")
-        passage_texts = [res["text"] for res in pinecone_results]
-        return " ".join(passage_texts)
-    
+    if config.RERANK_ENABLED:
+        results = reranker.rerank(query, results)
+
+    return context_packer.pack_context(results)
+
+def get_context_for_query(query: str, pc: Pinecone, index, filters=None) -> str:
+    results = retrieve_candidates(query, pc, index, top_k=candidate_count(), filters=filters)
+    return finalize_context(query, results)
+
+# Async Retrieval
+# Async clients hold an HTTP session bound to the event loop that created them, so they are
+# cached per loop; run_async keeps one loop per worker thread alive across tasks, so a worker
+# pays for connection setup and host resolution once rather than on every query.
+async_loop_local = threading.local()
+async_clients = weakref.WeakKeyDictionary()     # event loop -> (PineconeAsyncio, IndexAsyncio)
+async_clients_lock = threading.Lock()
+resolved_index_host = config.PINECONE_INDEX_HOST
+
+def run_async(coroutine):
+    """Runs a coroutine on this thread's long-lived event loop (recreated after a fork or a close)."""
+    loop = getattr(async_loop_local, "loop", None)
+    if loop is None or loop.is_closed() or getattr(async_loop_local, "pid", None) != os.getpid():
+        loop = asyncio.new_event_loop()
+        async_loop_local.loop = loop
+        async_loop_local.pid = os.getpid()
+    return loop.run_until_complete(coroutine)
+
+@lru_cache(maxsize=1)
+def get_sync_pinecone_index():
+    pc = Pinecone(api_key=config.PINECONE_API_KEY)
+    return pc, pc.Index(config.PINECONE_INDEX_NAME)
+
+async def get_async_pinecone():
+    """Returns this event loop's (client, index), creating them and resolving the index host once."""
+    global resolved_index_host
+    loop = asyncio.get_running_loop()
+    with async_clients_lock:
+        cached = async_clients.get(loop)
+    if cached:
+        return cached
+
+    pc = PineconeAsyncio(api_key=config.PINECONE_API_KEY)
+    if not resolved_index_host:
+        resolved_index_host = (await pc.describe_index(config.PINECONE_INDEX_NAME)).host
+    clients = (pc, pc.IndexAsyncio(host=resolved_index_host))
+    with async_clients_lock:
+        async_clients[loop] = clients
+    return clients
+
+async def aquery_pinecone(query: str, top_k=3, filters=None):
+    """
+    Asyncio counterpart of query_pinecone. Uses the SDK's asyncio client when available so
+    the embed and query round-trips do not hold a thread; otherwise runs the sync path in one.
+    """
+    if PineconeAsyncio is None:
+        pc, index = get_sync_pinecone_index()
+        return await asyncio.to_thread(query_pinecone, query, pc, index, top_k, filters)
+
+    try:
+        pc, index = await get_async_pinecone()
+        embedding_responses = await pc.inference.embed(
+            model=config.PINECONE_INDEX_MODEL,
+            inputs=[query],
+            parameters={"input_type": "query"}
+        )
+        query_embedding = extract_query_embedding(embedding_responses)
+
+        query_responses = await index.query(
+            vector=query_embedding,
+            top_k=top_k,
+            include_metadata=True,
+            namespace=config.PINECONE_NAMESPACE,
+            filter=filters
+        )
+        return format_vector_matches(query_responses)
+
+    except Exception as e:
+        logger.error("Async Pinecone query failed: %s", e, exc_info=True)
+        return []
+
+async def aget_context_for_query(query: str, filters=None) -> str:
+    """Async retrieval: vector search (and lexical search, when unfiltered) run concurrently."""
+    top_k = candidate_count()
+
+    if config.HYBRID_RETRIEVAL_ENABLED and not filters:
+        candidates = top_k * config.HYBRID_CANDIDATE_MULTIPLIER
+        lexical_task = asyncio.create_task(asyncio.to_thread(query_lexical, query, candidates))
+        try:
+            vector_results = await asyncio.wait_for(aquery_pinecone(query, candidates),
+                                                    timeout=config.VECTOR_SEARCH_TIMEOUT_SECONDS)
+        except asyncio.TimeoutError:
+            logger.warning(f"Vector search exceeded {config.VECTOR_SEARCH_TIMEOUT_SECONDS}s; falling back to lexical results.")
+            vector_results = []
+
+        results = fuse_hybrid_results(vector_results, await lexical_task, top_k=top_k)
     else:
-        logger.warning(f"Top score {top_score:.2f} is below threshold {relevance_threshold}. Discarding context.")
-        return ""
\ No newline at end of file
+        results = select_vector_results(await aquery_pinecone(query, top_k, filters), query)
+
+    return await asyncio.to_thread(finalize_context, query, results)
@@ -0,0 +1,113 @@
+import re
+import config
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# tiktoken gives exact counts for OpenAI models; the character heuristic is close enough otherwise
+try:
+    import tiktoken
+    token_encoder = tiktoken.get_encoding("cl100k_base")
+except Exception:
+    token_encoder = None
+
+# Chunk titles are written by data_preprocessing as "<source title> (Chunk <n>)"
+CHUNK_TITLE_PATTERN = re.compile(r"^(?P<source>.*) \(Chunk (?P<chunk>\d+)\)$")
+SENTENCE_END_PATTERN = re.compile(r"[.!?][\"')\]]?\s")
+
+def estimate_tokens(text):
+    if not text:
+        return 0
+    if token_encoder:
+        return len(token_encoder.encode(text))
+    return len(text) // 4 + 1
+
+def parse_chunk_title(title):
+    match = CHUNK_TITLE_PATTERN.match(title or "")
+    if not match:
+        return title, None
+    return match.group("source"), int(match.group("chunk"))
+
+def merge_overlapping(left, right, max_overlap=None):
+    """Appends right to left, dropping the longest prefix of right that repeats the end of left."""
+    max_overlap = config.CHUNK_OVERLAP_CHARS * 2 if max_overlap is None else max_overlap
+    for size in range(min(max_overlap, len(left), len(right)), 0, -1):
+        if left.endswith(right[:size]):
+            return left + right[size:]
+    return left + " " + right
+
+def result_score(result):
+    for key in ("rerank_score", "rrf_score", "score"):
+        if result.get(key) is not None:
+            return result[key]
+    return 0.0
+
+def build_spans(results):
+    """Merges consecutive chunks of the same source into contiguous spans scored by their best chunk."""
+    by_source = {}
+    standalone = []
+    seen_texts = set()
+
+    for result in results:
+        if result["text"] in seen_texts:
+            continue
+        seen_texts.add(result["text"])
+
+        source, chunk_number = parse_chunk_title(result.get("title"))
+        if chunk_number is None:
+            standalone.append({"text": result["text"], "score": result_score(result), "chunks": 1})
+        else:
+            by_source.setdefault(source, {})[chunk_number] = result
+
+    spans = standalone
+    for chunks in by_source.values():
+        current = None
+        previous_number = None
+        for chunk_number in sorted(chunks):
+            result = chunks[chunk_number]
+            if current and chunk_number == previous_number + 1:
+                current["text"] = merge_overlapping(current["text"], result["text"])
+                current["score"] = max(current["score"], result_score(result))
+                current["chunks"] += 1
+            else:
+                current = {"text": result["text"], "score": result_score(result), "chunks": 1}
+                spans.append(current)
+            previous_number = chunk_number
+    return spans
+
+def truncate_to_budget(text, token_budget):
+    """Cuts text to roughly token_budget tokens, preferring to end on a sentence boundary."""
+    approx_chars = token_budget * 4
+    cut = text[:approx_chars]
+    while cut and estimate_tokens(cut) > token_budget:
+        cut = cut[:int(len(cut) * 0.9)]
+
+    boundaries = [m.end() for m in SENTENCE_END_PATTERN.finditer(cut)]
+    if boundaries and boundaries[-1] > len(cut) // 2:
+        cut = cut[:boundaries[-1]]
+    return cut.strip()
+
+def pack_context(results, token_budget=None):
+    """
+    Builds the prompt context from retrieved chunks: adjacent chunks are merged without
+    their overlap, then spans are added by descending score until the token budget is used.
+    """
+    token_budget = config.CONTEXT_TOKEN_BUDGET if token_budget is None else token_budget
+    spans = sorted(build_spans(results), key=lambda s: s["score"], reverse=True)
+
+    packed = []
+    used_tokens = 0
+    for span in spans:
+        span_tokens = estimate_tokens(span["text"])
+        if used_tokens + span_tokens <= token_budget:
+            packed.append(span["text"])
+            used_tokens += span_tokens
+        elif not packed:
+            # Even the best span is over budget: keep its leading part rather than nothing
+            truncated = truncate_to_budget(span["text"], token_budget)
+            packed.append(truncated)
+            used_tokens += estimate_tokens(truncated)
+
+    logger.info(f"Packed {len(packed)} of {len(spans)} spans from {len(results)} chunks into ~{used_tokens} tokens "
+                f"(budget {token_budget}).")
+    return "\n\n".join(packed)
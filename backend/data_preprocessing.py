@@ -83,8 +83,8 @@ def load_and_chunk_db_operations(conn, cur, original_passage_id, title, full_tex
 
     # Chunking parameters to limit each chunk under Pinecone's threasehold
     try:
-        chunk_size = 1000
-        overlap = 100
+        chunk_size = config.CHUNK_SIZE_CHARS
+        overlap = config.CHUNK_OVERLAP_CHARS
         chunks_to_insert = []
         start = 0
         text_len = len(full_text)
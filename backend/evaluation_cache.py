@@ -0,0 +1,104 @@
+import json
+import hashlib
+import config
+
+from backend import redis_setup
+from backend import metrics
+from backend.local_grader import normalize_text
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Per-item cache of LLM evaluation rows. An item's grade depends only on the
+# passage, the question, the student's answer and the evaluator, so identical
+# answers to a cached passage (retries, shared passages) skip the LLM call.
+
+def passage_digest(passage_content):
+    return hashlib.sha1(normalize_text(passage_content).encode('utf-8')).hexdigest()
+
+def item_cache_key(digest, question, answer, model_choice):
+    # The question text is hashed in too, since a passage can be re-asked with different questions
+    question_hash = hashlib.sha1(normalize_text(question.get("text")).encode('utf-8')).hexdigest()[:12]
+    answer_hash = hashlib.sha1(normalize_text(answer).encode('utf-8')).hexdigest()[:16]
+    return (f"{config.EVALUATION_CACHE_KEY_PREFIX}{digest}:{question['number']}:{question_hash}:"
+            f"{(model_choice or '').strip()}:{answer_hash}")
+
+def get_cached_results(passage_content, questions, answers_by_number, model_choice):
+    """Returns {question number: cached evaluation row} for the questions whose grade is cached."""
+    # Questions without a parsed answer cannot be keyed by what the student wrote
+    questions = [q for q in questions or [] if answers_by_number.get(q["number"])]
+    if not questions:
+        return {}
+
+    client = redis_setup.get_redis_client()
+    if not client:
+        return {}
+
+    digest = passage_digest(passage_content)
+    keys = [item_cache_key(digest, q, answers_by_number.get(q["number"], ""), model_choice) for q in questions]
+
+    try:
+        cached_values = client.mget(keys)
+    except Exception as e:
+        logger.warning(f"Evaluation cache lookup failed: {e}")
+        return {}
+
+    cached = {}
+    for question, value in zip(questions, cached_values):
+        if value is None:
+            continue
+        try:
+            row = json.loads(value)
+        except ValueError:
+            continue
+        # The cached row carries the answer text of whoever populated it
+        row.update({"number": question["number"], "your_answer": answers_by_number.get(question["number"]) or "(no answer)",
+                    "graded_by": "cache"})
+        cached[question["number"]] = row
+
+    hits = len(cached)
+    metrics.increment_counter("evaluation_cache.hit", hits)
+    metrics.increment_counter("evaluation_cache.miss", len(questions) - hits)
+    logger.info(f"Evaluation cache: {hits}/{len(questions)} items served from cache.")
+    return cached
+
+def store_results(passage_content, questions, answers_by_number, model_choice, results):
+    """Caches the LLM's evaluation rows for the given questions."""
+    client = redis_setup.get_redis_client()
+    if not client or not results:
+        return
+
+    digest = passage_digest(passage_content)
+    questions_by_number = {q["number"]: q for q in questions}
+
+    try:
+        pipeline = client.pipeline()
+        stored = 0
+        skipped = 0
+        for row in results:
+            question = questions_by_number.get(row.get("number"))
+            if not question or row.get("evaluation") not in ("Correct", "Incorrect"):
+                continue
+            # The LLM maps answers to questions itself; a row graded against a different answer than
+            # the locally parsed one would be served to everyone who gives the parsed answer
+            answer = answers_by_number.get(question["number"])
+            if not answer or normalize_text(row.get("your_answer")) != normalize_text(answer):
+                skipped += 1
+                continue
+            key = item_cache_key(digest, question, answer, model_choice)
+            payload = {k: row.get(k) for k in ("evaluation", "correct_answer", "explanation")}
+            pipeline.set(key, json.dumps(payload), ex=config.EVALUATION_CACHE_TTL_SECONDS)
+            stored += 1
+        pipeline.execute()
+        logger.debug(f"Stored {stored} evaluation rows in the cache; skipped {skipped} whose answer did not match.")
+
+    except Exception as e:
+        logger.warning(f"Failed to store evaluation results in the cache: {e}")
+
+def get_hit_rate():
+    """Returns lifetime evaluation cache hits, misses and hit rate from the metrics counters."""
+    counters = metrics.get_counters("evaluation_cache.")
+    hits = counters.get("evaluation_cache.hit", 0)
+    misses = counters.get("evaluation_cache.miss", 0)
+    total = hits + misses
+    return {"hits": hits, "misses": misses, "hit_rate": (hits / total) if total else None}
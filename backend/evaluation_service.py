@@ -5,6 +5,11 @@ from openai import OpenAI
 from collections import Counter
 
 from backend import prompt_templates
+from backend import llm_router
+from backend import local_grader
+from backend import evaluation_cache
+from backend import learner_analytics
+from backend import metrics
 
 import logging
 logger = logging.getLogger(config.APP_NAME)
@@ -49,17 +54,10 @@ def initialize_llm_clients(model_choice):
 
         return None
 
-def call_llm_chat(client, model_name, system_prompt, user_prompt):
+def call_llm_chat(client, model_name, system_prompt, user_prompt, **request_options):
     try:
-        response = client.chat.completions.create(
-            model = model_name,
-            messages = [
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-
-        return response.choices[0].message.content
+        return llm_router.get_router().chat(system_prompt, user_prompt, primary_model=model_name,
+                                            primary_client=client, **request_options)
     
     except Exception as e:
         raise Exception(f"An error has occurred during the {model_name} API call: {e}")
@@ -142,35 +140,168 @@ def parse_evaluation_string(evaluation_string):
 
     return results
 
+# Structured Evaluation Output
+EVALUATION_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "number": {"type": "integer"},
+        "your_answer": {"type": "string"},
+        "evaluation": {"type": "string", "enum": ["Correct", "Incorrect"]},
+        "correct_answer": {"type": "string"},
+        "explanation": {"type": "string"}
+    },
+    "required": ["number", "your_answer", "evaluation", "correct_answer", "explanation"],
+    "additionalProperties": False
+}
+
+EVALUATION_OUTPUT_SCHEMA = {
+    "type": "object",
+    "properties": {"results": {"type": "array", "items": EVALUATION_ITEM_SCHEMA}},
+    "required": ["results"],
+    "additionalProperties": False
+}
+
+EVALUATION_TEXT_FIELDS = ("your_answer", "correct_answer", "explanation")
+
+def validate_evaluation_item(item):
+    """Returns the row normalized to the EVALUATION_ITEM_SCHEMA shape, or None if it does not conform."""
+    if not isinstance(item, dict):
+        return None
+
+    number = item.get("number")
+    if isinstance(number, str) and number.strip().isdigit():
+        number = int(number.strip())
+    if not isinstance(number, int) or isinstance(number, bool):
+        return None
+
+    evaluation = str(item.get("evaluation", "")).strip().capitalize()
+    if evaluation not in ("Correct", "Incorrect"):
+        return None
+
+    row = {"number": number, "evaluation": evaluation}
+    for field in EVALUATION_TEXT_FIELDS:
+        value = item.get(field)
+        if value is not None and not isinstance(value, (str, int, float)):
+            return None
+        row[field] = "" if value is None else str(value).strip()
+    return row
+
+def parse_structured_evaluation(raw_output):
+    """
+    Single-pass parser for JSON evaluation output: one json.loads, then a schema check per row.
+    Accepts {"results": [...]} or a bare array. Returns None when the output is not usable JSON.
+    """
+    try:
+        payload = json.loads(raw_output)
+    except (TypeError, ValueError):
+        return None
+
+    items = payload.get("results") if isinstance(payload, dict) else payload
+    if not isinstance(items, list):
+        return None
+
+    results = []
+    seen_numbers = set()
+    for item in items:
+        row = validate_evaluation_item(item)
+        if row is None:
+            logger.warning(f"Dropping evaluation row that fails the schema: {str(item)[:200]!r}")
+            continue
+        if row["number"] in seen_numbers:
+            continue
+        seen_numbers.add(row["number"])
+        results.append(row)
+
+    return results or None
+
+def format_questions_for_prompt(questions):
+    return "\n\n".join(f"Question {q['number']}: ({q.get('type', 'Unknown Type')})\n{q.get('text', '')}" for q in questions)
+
+def format_answers_for_prompt(questions, answers_by_number):
+    return "\n".join(f"{q['number']}. {answers_by_number.get(q['number'], '(no answer)')}" for q in questions)
+
+def get_evaluation_model_name(model_choice):
+    safe_model_choice = model_choice.strip()
+    if safe_model_choice == config.OPENAI_MODEL_CHOICE.strip():
+        return config.OPENAI_MODEL
+    elif safe_model_choice == config.DEEPSEEK_MODEL_CHOICE.strip():
+        return config.DEEPSEEK_MODEL
+    return ""
+
+def evaluate_with_llm(model_choice, passage_content, questions_string, user_answers):
+    llm_client = initialize_llm_clients(model_choice)
+    if not llm_client:
+        raise ValueError("LLM client initialization has failed")
+    
+    # Determine the specific API model name to use
+    model_name_for_api = get_evaluation_model_name(model_choice)
+    if not model_name_for_api:
+        raise ValueError(f"Could not determine the API model name for the evaluation choice: {model_choice}")
+
+    if config.EVALUATION_OUTPUT_MODE == "json":
+        system_prompt, user_prompt = prompt_templates.get_structured_evaluation_prompts(
+            passage_content, questions_string, user_answers
+        )
+        request_options = {}
+        if model_name_for_api == config.OPENAI_MODEL:
+            request_options["response_format"] = {
+                "type": "json_schema",
+                "json_schema": {"name": "ielts_evaluation", "schema": EVALUATION_OUTPUT_SCHEMA, "strict": True}
+            }
+
+        raw_output = call_llm_chat(llm_client, model_name_for_api, system_prompt, user_prompt, **request_options)
+        evaluation_results = parse_structured_evaluation(raw_output)
+        if evaluation_results is not None:
+            metrics.increment_counter("evaluation.parser.structured")
+            return local_grader.format_evaluation_results(evaluation_results), evaluation_results
+
+        # The model ignored the JSON format; its output may still follow the labelled layout
+        logger.warning("Structured evaluation output was not valid JSON; falling back to the regex parser.")
+        metrics.increment_counter("evaluation.parser.regex_fallback")
+        return raw_output, parse_evaluation_string(raw_output)
+
+    # Get the prompts from our new centralized file
+    system_prompt, user_prompt = prompt_templates.get_evaluation_prompts(
+        passage_content, questions_string, user_answers
+    )
+
+    evaluation = call_llm_chat(llm_client, model_name_for_api, system_prompt, user_prompt)
+    return evaluation, parse_evaluation_string(evaluation)
+
 @celery_app.task(bind=True, max_retries=3, default_retry_delay=60, acks_late=True)
-def evaluate_answers_task(self, model_choice, passage_content, questions_string, user_answers, questions_data):
+def evaluate_answers_task(self, model_choice, passage_content, questions_string, user_answers, questions_data,
+                          learner_id=None, cohort_id=None):
     task_id = self.request.id
     logger.info(f"[EVALUATION TASK START]. Task ID: {task_id}.")
     
     try:
-        llm_client = initialize_llm_clients(model_choice)
-        if not llm_client:
-            raise ValueError("LLM client initialization has failed")
-        
-        # Determine the specific API model name to use
-        model_name_for_api = ""
-        safe_model_choice = model_choice.strip()
-        if safe_model_choice == config.OPENAI_MODEL_CHOICE.strip():
-            model_name_for_api = config.OPENAI_MODEL
-        elif safe_model_choice == config.DEEPSEEK_MODEL_CHOICE.strip():
-            model_name_for_api = config.DEEPSEEK_MODEL
-        
-        if not model_name_for_api:
-            raise ValueError(f"Could not determine the API model name for the evaluation choice: {model_choice}")
+        # Objective items with an answer key are graded locally; only the rest go to the LLM
+        graded_results, remaining_questions, answers_by_number = local_grader.grade_locally(questions_data, user_answers)
+        metrics.increment_counter("evaluation.items.local", len(graded_results))
 
-        # Get the prompts from our new centralized file
-        system_prompt, user_prompt = prompt_templates.get_evaluation_prompts(
-            passage_content, questions_string, user_answers
-        )
+        # Items graded before for the same passage, question, answer and evaluator come from the cache
+        cached_results = evaluation_cache.get_cached_results(passage_content, remaining_questions, answers_by_number, model_choice)
+        uncached_questions = [q for q in remaining_questions if q["number"] not in cached_results]
+        metrics.increment_counter("evaluation.items.llm", len(uncached_questions))
+
+        if not graded_results and not cached_results:
+            evaluation, evaluation_results = evaluate_with_llm(model_choice, passage_content, questions_string, user_answers)
+            evaluation_cache.store_results(passage_content, remaining_questions, answers_by_number, model_choice, evaluation_results)
+        else:
+            llm_results = []
+            if uncached_questions:
+                _, llm_results = evaluate_with_llm(
+                    model_choice, passage_content,
+                    format_questions_for_prompt(uncached_questions),
+                    format_answers_for_prompt(uncached_questions, answers_by_number)
+                )
+                evaluation_cache.store_results(passage_content, uncached_questions, answers_by_number, model_choice, llm_results)
+            evaluation_results = graded_results + list(cached_results.values()) + llm_results
+            evaluation = local_grader.format_evaluation_results(evaluation_results)
 
-        evaluation = call_llm_chat(llm_client, model_name_for_api, system_prompt, user_prompt)
-        evaluation_results = parse_evaluation_string(evaluation)
         feedback, struggling_types = get_feedback(evaluation_results, questions_data)   
+        if config.ANALYTICS_ENABLED:
+            learner_analytics.record_evaluation(learner_id, evaluation_results, questions_data, cohort_id, event_id=task_id)
 
         result = {
             "evaluation": evaluation, 
@@ -0,0 +1,205 @@
+import json
+import config
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Incremental, tolerant parser for the question arrays produced by the LLM.
+# Text is fed as it streams in; every top-level {...} object is extracted as soon
+# as its closing brace arrives, so prose around the array, code fences, or a
+# truncated tail only cost the objects that are actually broken.
+
+KEY_ALIASES = {
+    "question": "text",
+    "question_text": "text",
+    "prompt": "text",
+    "question_type": "type",
+    "kind": "type",
+    "id": "number",
+    "question_number": "number",
+    "correct_answer": "answer",
+    "answer_key": "answer",
+}
+
+SMART_DOUBLE_QUOTES = "“”"
+STRING_END_FOLLOWERS = ":,}]"
+
+def _closes_smart_string(text, index):
+    """Inside a string opened by a smart quote, a quote only ends it when followed by ':', ',', '}' or ']'."""
+    index += 1
+    while index < len(text) and text[index].isspace():
+        index += 1
+    return index == len(text) or text[index] in STRING_END_FOLLOWERS
+
+def _drop_trailing_comma(chars):
+    end = len(chars)
+    while end and chars[end - 1].isspace():
+        end -= 1
+    if end and chars[end - 1] == ",":
+        del chars[end - 1]
+
+def repair_json_object(raw_object):
+    """
+    Fixes common LLM JSON defects: smart quotes used as string delimiters, trailing commas
+    and raw newlines inside strings. Smart quotes inside string values (“the city’s”) are
+    text and are left alone.
+    """
+    chars = []
+    in_string = False
+    smart_string = False
+    escaped = False
+    for index, char in enumerate(raw_object):
+        if not in_string:
+            if char == '"' or char in SMART_DOUBLE_QUOTES:
+                in_string = True
+                smart_string = char != '"'
+                char = '"'
+            elif char in "}]":
+                _drop_trailing_comma(chars)
+        elif escaped:
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif smart_string and (char == '"' or char in SMART_DOUBLE_QUOTES):
+            if _closes_smart_string(raw_object, index):
+                in_string = False
+                char = '"'
+            elif char == '"':
+                char = '\\"'
+        elif char == '"':
+            in_string = False
+        elif char == "\n":
+            char = "\\n"
+        elif char == "\t":
+            char = "\\t"
+        chars.append(char)
+
+    return "".join(chars)
+
+def normalize_question(obj):
+    """Returns the question with valid type/text keys (number may be None), or None if it cannot be salvaged."""
+    if not isinstance(obj, dict):
+        return None
+
+    question = {}
+    for key, value in obj.items():
+        canonical = KEY_ALIASES.get(str(key).strip().lower(), str(key).strip().lower())
+        question.setdefault(canonical, value)
+
+    # close() renumbers every question, so a missing or unusable number is left for it to assign
+    number = question.get("number")
+    if isinstance(number, str) and number.strip().isdigit():
+        number = int(number.strip())
+    if not isinstance(number, int) or isinstance(number, bool):
+        number = None
+
+    q_type = question.get("type")
+    text = question.get("text")
+    if not isinstance(q_type, str) or not q_type.strip() or not isinstance(text, str) or not text.strip():
+        return None
+
+    question.update({"number": number, "type": q_type.strip(), "text": text.strip()})
+    return question
+
+class QuestionStreamParser:
+    def __init__(self):
+        self.questions = []
+        self.rejected = 0
+        self._buffer = []
+        self._depth = 0
+        self._in_string = False
+        self._smart_string = False
+        self._close_pending = False
+        self._escaped = False
+
+    def feed(self, chunk):
+        """
+        Consumes a chunk of streamed text and returns the question objects completed by it.
+        Strings are tracked with the same rules as repair_json_object, so braces inside a
+        smart-quoted value do not move the object boundaries. Whether a quote closes a
+        smart-quoted string depends on the next non-space character, which may arrive in
+        a later chunk, so the decision is held in _close_pending until then.
+        """
+        completed = []
+        for char in chunk or "":
+            if self._depth == 0:
+                # Between objects: skip array brackets, commas, fences and prose
+                if char == "{":
+                    self._depth = 1
+                    self._buffer = [char]
+                continue
+
+            self._buffer.append(char)
+            if self._close_pending:
+                if char.isspace():
+                    continue
+                self._close_pending = False
+                if char in STRING_END_FOLLOWERS:
+                    self._in_string = False
+
+            if self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif self._smart_string and (char == '"' or char in SMART_DOUBLE_QUOTES):
+                    self._close_pending = True
+                elif char == '"' and not self._smart_string:
+                    self._in_string = False
+            elif char == '"' or char in SMART_DOUBLE_QUOTES:
+                self._in_string = True
+                self._smart_string = char != '"'
+            elif char == "{":
+                self._depth += 1
+            elif char == "}":
+                self._depth -= 1
+                if self._depth == 0:
+                    question = self._parse_object("".join(self._buffer))
+                    self._buffer = []
+                    if question:
+                        self.questions.append(question)
+                        completed.append(question)
+        return completed
+
+    def _parse_object(self, raw_object):
+        for candidate in (raw_object, repair_json_object(raw_object)):
+            try:
+                question = normalize_question(json.loads(candidate))
+            except json.JSONDecodeError:
+                continue
+            if question:
+                return question
+            break
+
+        self.rejected += 1
+        logger.warning(f"Discarding malformed question object: {raw_object[:200]!r}")
+        return None
+
+    @property
+    def truncated(self):
+        """True when the stream ended in the middle of an object."""
+        return self._depth > 0
+
+    def close(self):
+        """
+        Returns all parsed questions renumbered 1..N in stream order. A repeated number is
+        renumbered like any other; only an exact repeat of an earlier question is dropped.
+        """
+        if self.truncated:
+            logger.warning("Question stream ended inside an unfinished object; dropping the partial tail.")
+
+        seen_questions = set()
+        unique = []
+        for question in self.questions:
+            identity = (question["type"].lower(), " ".join(question["text"].lower().split()))
+            if identity in seen_questions:
+                continue
+            seen_questions.add(identity)
+            unique.append(question)
+
+        return [{**q, "number": i} for i, q in enumerate(unique, start=1)]
+
+def parse_questions(raw_output):
+    parser = QuestionStreamParser()
+    parser.feed(raw_output)
+    return parser.close()
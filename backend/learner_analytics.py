@@ -0,0 +1,231 @@
+import time
+import config
+from collections import Counter
+from psycopg2 import extras as psycopg_extra
+
+from backend.db_pool_setup import db_connection
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Incremental learner analytics. Every graded submission is folded into per-learner,
+# daily and cohort counters with upserts at write time, so dashboards and practice
+# selection read a handful of primary-key rows instead of re-scanning chat logs.
+# Each submission is recorded under an event id (the task or submission id), so a
+# retried task does not count the same answers twice. Event IDs are pruned after
+# ANALYTICS_EVENT_RETENTION_DAYS, well past any retry.
+
+ANALYTICS_TABLES = {
+    "learner_question_type_stats": "learner_id TEXT NOT NULL, question_type TEXT NOT NULL",
+    "daily_question_type_stats": "day DATE NOT NULL, question_type TEXT NOT NULL",
+    "cohort_question_type_stats": "cohort_id TEXT NOT NULL, question_type TEXT NOT NULL",
+}
+
+ANALYTICS_KEYS = {
+    "learner_question_type_stats": ("learner_id", "question_type"),
+    "daily_question_type_stats": ("day", "question_type"),
+    "cohort_question_type_stats": ("cohort_id", "question_type"),
+}
+
+analytics_tables_ready = False
+analytics_setup_failed_at = None
+events_pruned_at = 0.0
+
+def setup_analytics_tables():
+    """Creates the counter tables and the recorded-event log (idempotent)."""
+    global analytics_tables_ready, analytics_setup_failed_at
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                for table, key_columns in ANALYTICS_TABLES.items():
+                    cur.execute(f"""
+                        CREATE TABLE IF NOT EXISTS {table} (
+                            {key_columns},
+                            attempted INTEGER NOT NULL DEFAULT 0,
+                            correct INTEGER NOT NULL DEFAULT 0,
+                            submissions INTEGER NOT NULL DEFAULT 0,
+                            updated_at TIMESTAMPTZ NOT NULL DEFAULT now(),
+                            PRIMARY KEY ({", ".join(ANALYTICS_KEYS[table])})
+                        )
+                        """)
+                cur.execute("""
+                    CREATE TABLE IF NOT EXISTS analytics_recorded_events (
+                        event_id TEXT PRIMARY KEY,
+                        recorded_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                    )
+                    """)
+                cur.execute("""
+                    CREATE INDEX IF NOT EXISTS analytics_recorded_events_recorded_at_idx
+                    ON analytics_recorded_events (recorded_at)
+                    """)
+
+        analytics_tables_ready = True
+        analytics_setup_failed_at = None
+        logger.info("Learner analytics tables are in place.")
+        return True
+
+    except Exception as e:
+        analytics_setup_failed_at = time.monotonic()
+        logger.error(f"Failed to set up learner analytics tables: {e}", exc_info=True)
+        return False
+
+def ensure_analytics_tables():
+    """Sets the tables up on first use. After a failure, waits ANALYTICS_SETUP_RETRY_SECONDS instead of issuing DDL on every call."""
+    if analytics_tables_ready:
+        return True
+    if analytics_setup_failed_at is not None and time.monotonic() - analytics_setup_failed_at < config.ANALYTICS_SETUP_RETRY_SECONDS:
+        return False
+    return setup_analytics_tables()
+
+def prune_recorded_events(cur):
+    """Deletes event IDs past the retention window, at most once per ANALYTICS_EVENT_PRUNE_INTERVAL_SECONDS per process."""
+    global events_pruned_at
+    now = time.monotonic()
+    if now - events_pruned_at < config.ANALYTICS_EVENT_PRUNE_INTERVAL_SECONDS:
+        return
+    events_pruned_at = now
+    cur.execute("""
+        DELETE FROM analytics_recorded_events
+        WHERE recorded_at < now() - make_interval(days => %s)
+        """, (config.ANALYTICS_EVENT_RETENTION_DAYS,))
+    if cur.rowcount:
+        logger.info(f"Pruned {cur.rowcount} analytics event IDs older than {config.ANALYTICS_EVENT_RETENTION_DAYS} days.")
+
+def canonical_question_type(question_type):
+    """Folds case and spacing variants onto the configured type names so counters are not split."""
+    normalized = " ".join(str(question_type or "").split())
+    for known in config.QUESTION_TYPE_DISTRIBUTION:
+        if normalized.lower() == known.lower():
+            return known
+    return normalized or "Unknown Type"
+
+def count_by_question_type(evaluation_results, questions_data):
+    """Returns {question_type: (attempted, correct)} for graded (Correct/Incorrect) rows."""
+    questions_type_map = {
+        q.get('number'): q.get('type')
+        for q in questions_data or []
+        if isinstance(q, dict) and 'number' in q
+    }
+
+    attempted = Counter()
+    correct = Counter()
+    for result in evaluation_results or []:
+        if not isinstance(result, dict) or result.get('evaluation') not in ("Correct", "Incorrect"):
+            continue
+        q_type = canonical_question_type(questions_type_map.get(result.get('number')))
+        attempted[q_type] += 1
+        if result['evaluation'] == "Correct":
+            correct[q_type] += 1
+
+    return {q_type: (attempted[q_type], correct[q_type]) for q_type in attempted}
+
+def _upsert_counters(cur, table, key_values, counts):
+    key_columns = ANALYTICS_KEYS[table]
+    # Sorted so concurrent upserts lock rows in the same order
+    rows = [(*key_values, q_type, attempted, correct, 1) for q_type, (attempted, correct) in sorted(counts.items())]
+    psycopg_extra.execute_values(cur, f"""
+        INSERT INTO {table} ({", ".join(key_columns)}, attempted, correct, submissions)
+        VALUES %s
+        ON CONFLICT ({", ".join(key_columns)}) DO UPDATE SET
+            attempted = {table}.attempted + EXCLUDED.attempted,
+            correct = {table}.correct + EXCLUDED.correct,
+            submissions = {table}.submissions + EXCLUDED.submissions,
+            updated_at = now()
+        """, rows)
+
+def record_evaluation(learner_id, evaluation_results, questions_data, cohort_id=None, event_id=None):
+    """
+    Folds one graded submission into the daily counters and, when known, the learner and
+    cohort counters, in a single transaction. A repeated event_id is ignored.
+    """
+    counts = count_by_question_type(evaluation_results, questions_data)
+    if not counts:
+        return False
+
+    # Created on first use, so enabling analytics does not depend on running setup_learner_analytics first
+    if not ensure_analytics_tables():
+        return False
+
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                if event_id:
+                    prune_recorded_events(cur)
+                    cur.execute("""
+                        INSERT INTO analytics_recorded_events (event_id) VALUES (%s)
+                        ON CONFLICT (event_id) DO NOTHING
+                        """, (str(event_id),))
+                    if cur.rowcount == 0:
+                        logger.info(f"Analytics for event {event_id} were already recorded; skipping.")
+                        return False
+
+                cur.execute("SELECT CURRENT_DATE")
+                today = cur.fetchone()[0]
+
+                if learner_id:
+                    _upsert_counters(cur, "learner_question_type_stats", (str(learner_id),), counts)
+                _upsert_counters(cur, "daily_question_type_stats", (today,), counts)
+                if cohort_id:
+                    _upsert_counters(cur, "cohort_question_type_stats", (str(cohort_id),), counts)
+
+        logger.debug(f"Recorded analytics for learner {learner_id} across {len(counts)} question types.")
+        return True
+
+    except Exception as e:
+        # Analytics must never fail an evaluation
+        logger.error(f"Failed to record learner analytics for {learner_id}: {e}", exc_info=True)
+        return False
+
+# Readers
+def _rows_to_stats(rows):
+    return [
+        {
+            "question_type": q_type,
+            "attempted": attempted,
+            "correct": correct,
+            "submissions": submissions,
+            "accuracy": (correct / attempted) if attempted else None
+        }
+        for q_type, attempted, correct, submissions in rows
+    ]
+
+def get_learner_stats(learner_id):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT question_type, attempted, correct, submissions
+                FROM learner_question_type_stats
+                WHERE learner_id = %s
+                """, (str(learner_id),))
+            return _rows_to_stats(cur.fetchall())
+
+def get_struggling_types(learner_id, min_attempts=None, limit=None):
+    """Question types ordered by the learner's error rate, for adaptive practice selection."""
+    min_attempts = config.ANALYTICS_MIN_ATTEMPTS if min_attempts is None else min_attempts
+    limit = config.ANALYTICS_STRUGGLING_TYPES_LIMIT if limit is None else limit
+    stats = [s for s in get_learner_stats(learner_id) if s["attempted"] >= min_attempts and s["correct"] < s["attempted"]]
+    stats.sort(key=lambda s: s["accuracy"])
+    return [s["question_type"] for s in stats[:limit]]
+
+def get_daily_rollup(start_day, end_day):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT day, question_type, attempted, correct, submissions
+                FROM daily_question_type_stats
+                WHERE day BETWEEN %s AND %s
+                ORDER BY day, question_type
+                """, (start_day, end_day))
+            rows = cur.fetchall()
+
+    return [{"day": row[0], **stats} for row, stats in zip(rows, _rows_to_stats([row[1:] for row in rows]))]
+
+def get_cohort_stats(cohort_id):
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                SELECT question_type, attempted, correct, submissions
+                FROM cohort_question_type_stats
+                WHERE cohort_id = %s
+                """, (str(cohort_id),))
+            return _rows_to_stats(cur.fetchall())
@@ -0,0 +1,380 @@
+import time
+import threading
+import config
+from enum import Enum
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from openai import OpenAI
+
+from backend import metrics
+from backend import rate_limiter
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Latency-aware router over the configured LLM providers.
+# - Tracks rolling latency and error rate per provider.
+# - Hedges: if the primary has not answered by its p95-based deadline, the same
+#   request is fired at a secondary and the first successful answer wins. A hedge
+#   that is already running cannot be stopped, so its tokens are spent either way;
+#   hedging is capped at LLM_ROUTER_HEDGE_BUDGET_RATIO of recent requests.
+# - Fails over to the next provider when a call fails or a circuit is open.
+# - Client errors (a request the provider rejects, e.g. an unsupported option) fail
+#   over but do not count against the provider's circuit.
+
+class CircuitState(Enum):
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+class AllProvidersFailedError(Exception):
+    pass
+
+# 4xx statuses that say something about the provider's health rather than the request
+PROVIDER_HEALTH_STATUSES = {408, 409, 429}
+
+def is_client_error(error):
+    status_code = getattr(error, "status_code", None)
+    return status_code is not None and 400 <= status_code < 500 and status_code not in PROVIDER_HEALTH_STATUSES
+
+class PartialStreamError(Exception):
+    """A streamed call failed after some output had already been handed to the caller."""
+    pass
+
+class ProviderStats:
+    def __init__(self, window_size):
+        self.latencies = deque(maxlen=window_size)
+        self.outcomes = deque(maxlen=window_size)   # True for success, False for error
+        self.consecutive_failures = 0
+        self.circuit_state = CircuitState.CLOSED
+        self.circuit_opened_at = 0.0
+        self.probe_started_at = None                # Set while the single HALF_OPEN probe is in flight
+        self.lock = threading.Lock()
+
+    def record_success(self, latency):
+        with self.lock:
+            self.latencies.append(latency)
+            self.outcomes.append(True)
+            self.consecutive_failures = 0
+            self.circuit_state = CircuitState.CLOSED
+            self.probe_started_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            self.consecutive_failures += 1
+            if (self.circuit_state == CircuitState.HALF_OPEN
+                    or self.consecutive_failures >= config.LLM_ROUTER_CIRCUIT_FAILURE_THRESHOLD):
+                self.circuit_state = CircuitState.OPEN
+                self.circuit_opened_at = time.monotonic()
+            self.probe_started_at = None
+
+    def release_probe(self):
+        """Frees the probe slot when the probe never reached the provider (e.g. it was rate limited)."""
+        with self.lock:
+            self.probe_started_at = None
+
+    def _probe_available(self, now):
+        if self.circuit_state == CircuitState.OPEN:
+            return now - self.circuit_opened_at >= config.LLM_ROUTER_CIRCUIT_COOLDOWN_SECONDS
+        # HALF_OPEN: only one probe at a time; a probe that never reported back is replaced after the request timeout
+        return self.probe_started_at is None or now - self.probe_started_at >= config.LLM_REQUEST_TIMEOUT_SECONDS
+
+    def allows_request(self):
+        """Whether a request could be sent now. Does not claim the probe slot; begin_request does."""
+        with self.lock:
+            return self.circuit_state == CircuitState.CLOSED or self._probe_available(time.monotonic())
+
+    def begin_request(self):
+        """Claims permission to send a request. Past the cooldown, exactly one caller gets the probe."""
+        with self.lock:
+            if self.circuit_state == CircuitState.CLOSED:
+                return True
+            now = time.monotonic()
+            if not self._probe_available(now):
+                return False
+            self.circuit_state = CircuitState.HALF_OPEN
+            self.probe_started_at = now
+            return True
+
+    def p95_latency(self):
+        with self.lock:
+            if len(self.latencies) < config.LLM_ROUTER_MIN_SAMPLES:
+                return None
+            return metrics.percentile(sorted(self.latencies), 95)
+
+    def error_rate(self):
+        with self.lock:
+            if not self.outcomes:
+                return 0.0
+            return self.outcomes.count(False) / len(self.outcomes)
+
+    def snapshot(self):
+        return {
+            "circuit_state": self.circuit_state.value,
+            "p95_latency": self.p95_latency(),
+            "error_rate": self.error_rate(),
+            "samples": len(self.latencies),
+        }
+
+class Provider:
+    def __init__(self, name, model, api_key, base_url=None):
+        self.name = name
+        self.model = model
+        self.api_key = api_key
+        self.base_url = base_url
+        self.client = None
+        self.stats = ProviderStats(config.LLM_ROUTER_WINDOW_SIZE)
+        self.client_lock = threading.Lock()
+
+    def get_client(self):
+        with self.client_lock:
+            if not self.client:
+                self.client = OpenAI(api_key=self.api_key, base_url=self.base_url) if self.base_url else OpenAI(api_key=self.api_key)
+            return self.client
+
+    def adapt_request_options(self, request_options):
+        """Drops to json_object mode for providers that cannot enforce a json_schema response_format."""
+        response_format = request_options.get("response_format")
+        if (not response_format or response_format.get("type") != "json_schema"
+                or self.model in config.LLM_JSON_SCHEMA_MODELS or not self.api_key):
+            return request_options
+        return {**request_options, "response_format": {"type": "json_object"}}
+
+    def hedge_deadline(self):
+        p95 = self.stats.p95_latency()
+        if p95 is None:
+            return config.LLM_ROUTER_DEFAULT_HEDGE_SECONDS
+        return max(config.LLM_ROUTER_MIN_HEDGE_SECONDS, p95 * config.LLM_ROUTER_HEDGE_P95_MULTIPLIER)
+
+def build_providers():
+    candidates = [
+        (config.OPENAI_MODEL_CHOICE, config.OPENAI_MODEL, config.OPENAI_API_KEY, None),
+        (config.MISTRAL_MODEL_CHOICE, config.MISTRAL_MODEL, config.MISTRAL_API_KEY, "https://api.mistral.ai/v1"),
+        (config.DEEPSEEK_MODEL_CHOICE, config.DEEPSEEK_MODEL, config.DEEPSEEK_API_KEY, config.DEEPSEEK_BASEURL),
+    ]
+    return [Provider(name, model, api_key, base_url) for name, model, api_key, base_url in candidates if api_key]
+
+class LLMRouter:
+    def __init__(self, providers):
+        self.providers = {p.model: p for p in providers}
+        self.providers_lock = threading.Lock()
+        self.executor = ThreadPoolExecutor(max_workers=config.LLM_ROUTER_MAX_WORKERS, thread_name_prefix="llm-router")
+        self.recent_hedges = deque(maxlen=config.LLM_ROUTER_WINDOW_SIZE)   # True for each recent request that hedged
+        self.hedge_lock = threading.Lock()
+
+    def _provider_for(self, primary_model):
+        """
+        The provider for primary_model. An unknown model routed with a caller-supplied client gets a
+        keyless provider, kept so its latency stats build up across calls; it is never a secondary.
+        """
+        with self.providers_lock:
+            if primary_model not in self.providers:
+                self.providers[primary_model] = Provider(primary_model, primary_model, api_key=None)
+            return self.providers[primary_model]
+
+    def _record_request(self, hedged):
+        with self.hedge_lock:
+            self.recent_hedges.append(hedged)
+
+    def _claim_hedge(self):
+        """Whether this request may hedge without exceeding the hedge budget for the recent window."""
+        with self.hedge_lock:
+            budget = config.LLM_ROUTER_HEDGE_BUDGET_RATIO * self.recent_hedges.maxlen
+            return sum(self.recent_hedges) < budget
+
+    def _ordered_candidates(self, primary_model):
+        primary = self.providers.get(primary_model)
+        secondaries = sorted(
+            (p for p in self.providers.values() if p.model != primary_model and p.api_key),
+            key=lambda p: (p.stats.error_rate(), p.stats.p95_latency() or config.LLM_ROUTER_DEFAULT_HEDGE_SECONDS)
+        )
+        ordered = ([primary] if primary else []) + secondaries
+        return [p for p in ordered if p.stats.allows_request()]
+
+    def _create_completion(self, provider, client, system_prompt, user_prompt, request_options, stream_to):
+        messages = [
+            {"role": "system", "content": system_prompt},
+            {"role": "user", "content": user_prompt}
+        ]
+        if not stream_to:
+            response = client.chat.completions.create(
+                model=provider.model,
+                messages=messages,
+                timeout=config.LLM_REQUEST_TIMEOUT_SECONDS,
+                **request_options
+            )
+            return response.choices[0].message.content, getattr(response, "usage", None)
+
+        parts = []
+        try:
+            stream = client.chat.completions.create(
+                model=provider.model,
+                messages=messages,
+                timeout=config.LLM_REQUEST_TIMEOUT_SECONDS,
+                stream=True,
+                **request_options
+            )
+            for chunk in stream:
+                delta = chunk.choices[0].delta.content if chunk.choices else None
+                if delta:
+                    parts.append(delta)
+                    stream_to(delta)
+
+        except Exception as e:
+            if parts:
+                raise PartialStreamError(f"Stream from {provider.model} broke after {len(parts)} chunks: {e}") from e
+            raise
+        return "".join(parts), None
+
+    def _call_provider(self, provider, client, system_prompt, user_prompt, request_options, estimated_tokens, stream_to=None):
+        started = time.perf_counter()
+        try:
+            content, usage = self._create_completion(provider, client, system_prompt, user_prompt, request_options, stream_to)
+
+        except Exception as e:
+            if is_client_error(e):
+                # The provider is up but rejected this request; that is no reason to open its circuit
+                provider.stats.release_probe()
+                metrics.increment_counter(f"llm.{provider.model}.client_errors")
+            else:
+                provider.stats.record_failure()
+                metrics.increment_counter(f"llm.{provider.model}.errors")
+            if getattr(e, "status_code", None) == 429:
+                rate_limiter.penalize(provider.name, provider.model)
+            raise
+
+        actual_tokens = getattr(usage, "total_tokens", None)
+        if actual_tokens is None:
+            # Streamed responses carry no usage; charge the prompt plus what was actually generated
+            actual_tokens = rate_limiter.estimate_tokens(system_prompt, user_prompt, completion_tokens=len(content or "") // 4)
+        rate_limiter.reconcile(provider.name, provider.model, estimated_tokens, actual_tokens)
+
+        latency = time.perf_counter() - started
+        provider.stats.record_success(latency)
+        metrics.record_timing(f"llm.{provider.model}.latency", latency)
+        return content
+
+    def chat(self, system_prompt, user_prompt, primary_model, primary_client=None, stream_to=None, **request_options):
+        """
+        Returns the content of the first successful completion across primary and fallback providers.
+        With stream_to, deltas are passed to the callable as they arrive; streamed calls are not
+        hedged, and they only fail over if nothing had been streamed yet.
+        """
+        if primary_model not in self.providers and primary_client:
+            # Unknown model with a caller-supplied client
+            self._provider_for(primary_model)
+        candidates = self._ordered_candidates(primary_model)
+        if candidates and not candidates[0].api_key and not primary_client:
+            candidates = candidates[1:]
+
+        if not candidates:
+            raise AllProvidersFailedError(f"No LLM provider available for {primary_model} (all circuits open)")
+
+        pending = {}
+        errors = []
+        next_index = 0
+        estimated_tokens = rate_limiter.estimate_tokens(system_prompt, user_prompt,
+                                                        completion_tokens=request_options.get("max_tokens"))
+
+        def launch_next(hedge=False):
+            nonlocal next_index
+            while next_index < len(candidates):
+                provider = candidates[next_index]
+                next_index += 1
+                # Skips providers whose circuit lost the race for the HALF_OPEN probe; they are failed over
+                if not provider.stats.begin_request():
+                    metrics.increment_counter("llm_router.probe_skipped")
+                    continue
+
+                # Rate-limit queueing happens here, before the hedge clock starts. A hedge never queues:
+                # it only goes out if the secondary has budget right now. Shedding moves on to the next
+                # provider without counting against this one's health.
+                try:
+                    rate_limiter.acquire(provider.name, provider.model, estimated_tokens, max_wait=0 if hedge else None)
+                except rate_limiter.RateLimitExceeded as e:
+                    provider.stats.release_probe()
+                    errors.append(f"{provider.model}: {e}")
+                    continue
+
+                client = primary_client if (provider.model == primary_model and primary_client) else provider.get_client()
+                future = self.executor.submit(self._call_provider, provider, client, system_prompt, user_prompt,
+                                              provider.adapt_request_options(request_options), estimated_tokens, stream_to)
+                pending[future] = provider
+                return provider
+            return None
+
+        lead = launch_next()
+        if not lead:
+            raise AllProvidersFailedError(f"No LLM provider available for {primary_model} (circuits open, probing or rate limited): {'; '.join(errors)}")
+        deadline = time.monotonic() + lead.hedge_deadline()
+        hedged = bool(stream_to)
+        hedge_sent = False
+        try:
+            while pending:
+                timeout = None if hedged or next_index >= len(candidates) else max(0.0, deadline - time.monotonic())
+                done, _ = wait(pending, timeout=timeout, return_when=FIRST_COMPLETED)
+
+                if not done:
+                    # Primary is slower than its p95 deadline: hedge against the next provider, budget permitting
+                    hedged = True
+                    if not self._claim_hedge():
+                        metrics.increment_counter("llm_router.hedges_over_budget")
+                        continue
+                    provider = launch_next(hedge=True)
+                    if not provider:
+                        continue
+                    hedge_sent = True
+                    metrics.increment_counter("llm_router.hedges")
+                    logger.info(f"Hedging request to {provider.model}: {lead.model} exceeded {lead.hedge_deadline():.1f}s")
+                    continue
+
+                for future in done:
+                    provider = pending.pop(future)
+                    try:
+                        content = future.result()
+                    except PartialStreamError:
+                        raise
+                    except Exception as e:
+                        errors.append(f"{provider.model}: {e}")
+                        logger.warning(f"LLM call to {provider.model} failed: {e}")
+                        continue
+
+                    # Drop the slower request; one already running cannot be interrupted, its answer is discarded
+                    for other, other_provider in pending.items():
+                        if other.cancel():
+                            other_provider.stats.release_probe()
+                        else:
+                            metrics.increment_counter("llm_router.discarded_calls")
+                    if provider.model != primary_model:
+                        metrics.increment_counter("llm_router.served_by_secondary")
+                    return content
+
+                if not pending and next_index < len(candidates):
+                    failed_model = lead.model
+                    next_lead = launch_next()
+                    if not next_lead:
+                        break
+                    lead = next_lead
+                    metrics.increment_counter("llm_router.failovers")
+                    logger.warning(f"Failing over from {failed_model} to {lead.model}")
+                    deadline = time.monotonic() + lead.hedge_deadline()
+
+            raise AllProvidersFailedError(f"All LLM providers failed for {primary_model}: {'; '.join(errors)}")
+        finally:
+            # Every request counts toward the hedge budget's window, hedged or not
+            self._record_request(hedge_sent)
+
+    def health(self):
+        return {model: p.stats.snapshot() for model, p in self.providers.items()}
+
+llm_router = None
+router_init_lock = threading.Lock()
+
+def get_router():
+    global llm_router
+    with router_init_lock:
+        if not llm_router:
+            llm_router = LLMRouter(build_providers())
+            logger.info(f"LLM router initialized with providers: {list(llm_router.providers)}")
+        return llm_router
@@ -0,0 +1,162 @@
+import re
+import config
+from enum import Enum
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Objective question types have exactly one correct answer, captured as the
+# question's "answer" key at generation time, so they are graded here without
+# an LLM call. Completion items are free text and still go to the evaluator.
+
+class GradingKind(Enum):
+    TRUE_FALSE_NOT_GIVEN = 'tfng'
+    MULTIPLE_CHOICE = 'multiple_choice'
+    MATCHING = 'matching'
+
+TFNG_ALIASES = {
+    "true": "TRUE", "t": "TRUE", "yes": "TRUE", "y": "TRUE",
+    "false": "FALSE", "f": "FALSE", "no": "FALSE", "n": "FALSE",
+    "not given": "NOT GIVEN", "notgiven": "NOT GIVEN", "ng": "NOT GIVEN", "not stated": "NOT GIVEN",
+}
+
+NUMBERED_ANSWER_PATTERN = re.compile(r"^\s*(?:q(?:uestion)?\s*)?(\d+)\s*[.):\-]?\s+(.*?)\s*$", re.IGNORECASE)
+# The whole answer must be the label ('B', '(b)', 'iv.'); 'I think A' is not read as option 'i'
+OPTION_LABEL_PATTERN = re.compile(r"^\(?\s*([a-h]|[ivx]{1,5})\s*[).:]?\s*$", re.IGNORECASE)
+NON_WORD_PATTERN = re.compile(r"[^a-z0-9 ]+")
+
+def grading_kind(question_type):
+    """Maps a generated question type to the local grading rule, or None for free-text types."""
+    normalized = (question_type or "").strip().lower()
+    if "true" in normalized or "not given" in normalized or "yes/no" in normalized:
+        return GradingKind.TRUE_FALSE_NOT_GIVEN
+    if "multiple" in normalized or "choice" in normalized:
+        return GradingKind.MULTIPLE_CHOICE
+    if "matching" in normalized:
+        return GradingKind.MATCHING
+    return None
+
+def normalize_text(value):
+    collapsed = NON_WORD_PATTERN.sub(" ", str(value or "").lower().replace("-", " "))
+    return " ".join(collapsed.split())
+
+def normalize_tfng(value):
+    return TFNG_ALIASES.get(normalize_text(value))
+
+def option_label(value):
+    """Returns the option label when the whole answer is one ('B', '(b)', 'iv.'), else None."""
+    match = OPTION_LABEL_PATTERN.match(str(value or "").strip())
+    return match.group(1).lower() if match else None
+
+def normalize_answer(kind, value):
+    """Returns (normalized answer, is_label). TFNG answers count as labels once recognized."""
+    if kind == GradingKind.TRUE_FALSE_NOT_GIVEN:
+        tfng = normalize_tfng(value)
+        return tfng, tfng is not None
+    label = option_label(value)
+    if label:
+        return label, True
+    return normalize_text(value) or None, False
+
+def parse_user_answers(user_answers, question_numbers):
+    """
+    Maps question numbers to the user's answers. Numbered lines ('3. B', 'Q3: B') are used only
+    when every line is numbered, with unique numbers from the question set; otherwise one
+    line per question is matched in order. Anything else is ambiguous and returns {}, so the
+    answers go to the LLM as written ('3 million' is an answer, not question 3).
+    """
+    lines = [line.strip() for line in str(user_answers or "").splitlines() if line.strip()]
+    if len(lines) == 1 and ";" in lines[0]:
+        lines = [part.strip() for part in lines[0].split(";") if part.strip()]
+
+    numbered = {}
+    for line in lines:
+        match = NUMBERED_ANSWER_PATTERN.match(line)
+        number = int(match.group(1)) if match else None
+        if number not in question_numbers or number in numbered:
+            break
+        numbered[number] = match.group(2)
+    else:
+        if numbered:
+            return numbered
+
+    if len(lines) == len(question_numbers):
+        return dict(zip(question_numbers, lines))
+
+    logger.info(f"Could not map {len(lines)} answer lines onto {len(question_numbers)} questions; deferring to the LLM.")
+    return {}
+
+def grade_item(question, user_answer):
+    """
+    Returns an evaluation row for an objective question with an answer key, or None if it needs
+    the LLM. An answer is only marked Incorrect locally when both it and the key are clean labels
+    (an option letter/numeral or TRUE/FALSE/NOT GIVEN) that differ; anything else is ambiguous.
+    """
+    kind = grading_kind(question.get("type"))
+    answer_key = question.get("answer")
+    if kind is None or answer_key is None or str(answer_key).strip() == "" or not user_answer:
+        return None
+
+    expected, expected_is_label = normalize_answer(kind, answer_key)
+    if expected is None:
+        logger.warning(f"Unrecognized answer key {answer_key!r} for question {question.get('number')}; deferring to the LLM.")
+        return None
+
+    given, given_is_label = normalize_answer(kind, user_answer)
+    correct = given == expected
+    if not correct and not (expected_is_label and given_is_label):
+        return None
+
+    return {
+        "number": question["number"],
+        "your_answer": user_answer,
+        "evaluation": "Correct" if correct else "Incorrect",
+        "correct_answer": str(answer_key).strip(),
+        "explanation": "N/A" if correct else "Graded against the answer key recorded when the question was generated.",
+        "graded_by": "local"
+    }
+
+def grade_locally(questions_data, user_answers):
+    """
+    Grades every objective question that has an answer key and an unambiguous answer.
+    Returns (graded_results, remaining_questions, answers_by_number); remaining questions need the LLM.
+    answers_by_number is empty when the answers could not be mapped onto the questions.
+    """
+    questions = [q for q in questions_data or [] if isinstance(q, dict) and isinstance(q.get("number"), int)]
+    answers_by_number = parse_user_answers(user_answers, [q["number"] for q in questions])
+
+    graded = []
+    remaining = []
+    for question in questions:
+        result = grade_item(question, answers_by_number.get(question["number"]))
+        if result:
+            graded.append(result)
+        else:
+            remaining.append(question)
+
+    logger.info(f"Graded {len(graded)} of {len(questions)} questions locally; {len(remaining)} left for the LLM.")
+    return graded, remaining, answers_by_number
+
+def format_evaluation_results(results):
+    """Renders evaluation rows in the same layout the LLM evaluator is asked to produce."""
+    ordered = sorted(results, key=lambda r: r["number"])
+    correct_count = sum(1 for r in ordered if r.get("evaluation") == "Correct")
+    total = len(ordered)
+    percentage = round(100 * correct_count / total) if total else 0
+
+    lines = ["===DETAILED EVALUATION==="]
+    for result in ordered:
+        lines.extend([
+            f"Question {result['number']}:",
+            f"- Your answer: {result.get('your_answer', '')}",
+            f"- Evaluation: {result.get('evaluation', '')}",
+            f"- Correct answer: {result.get('correct_answer', '')}",
+            f"- Explanation: {result.get('explanation', '')}",
+            ""
+        ])
+    lines.extend([
+        "===FINAL GRADE===",
+        f"Total questions answered correctly: {correct_count} / {total}",
+        f"Score Percentage: {percentage}%"
+    ])
+    return "\n".join(lines)
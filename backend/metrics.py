@@ -0,0 +1,94 @@
+import json
+import time
+import config
+
+from backend import redis_setup
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Metrics sink: every sample is logged, and the most recent samples per metric
+# are kept in a capped Redis list so percentiles can be read without a TSDB.
+
+def _metric_key(metric):
+    return f"{config.METRICS_KEY_PREFIX}{metric}"
+
+def record_timing(metric, seconds, **tags):
+    """Records a duration sample (in seconds) for a metric."""
+    logger.info("METRIC %s=%.4fs %s", metric, seconds, json.dumps(tags) if tags else "")
+
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+
+    try:
+        pipeline = client.pipeline()
+        pipeline.lpush(_metric_key(metric), f"{seconds:.6f}")
+        pipeline.ltrim(_metric_key(metric), 0, config.METRICS_SAMPLE_WINDOW - 1)
+        pipeline.execute()
+
+    except Exception as e:
+        logger.warning(f"Failed to record metric '{metric}': {e}")
+
+def increment_counter(metric, amount=1):
+    """Increments a monotonically growing counter."""
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+
+    try:
+        client.hincrby(config.METRICS_COUNTERS_KEY, metric, amount)
+    except Exception as e:
+        logger.warning(f"Failed to increment counter '{metric}': {e}")
+
+def get_counters(prefix=""):
+    client = redis_setup.get_redis_client()
+    if not client:
+        return {}
+
+    try:
+        raw = client.hgetall(config.METRICS_COUNTERS_KEY)
+    except Exception as e:
+        logger.warning(f"Failed to read counters: {e}")
+        return {}
+
+    counters = {k.decode('utf-8'): int(v) for k, v in raw.items()}
+    return {k: v for k, v in counters.items() if k.startswith(prefix)}
+
+def percentile(sorted_values, pct):
+    if not sorted_values:
+        return None
+
+    rank = (len(sorted_values) - 1) * pct / 100
+    lower = int(rank)
+    upper = min(lower + 1, len(sorted_values) - 1)
+    return sorted_values[lower] + (sorted_values[upper] - sorted_values[lower]) * (rank - lower)
+
+def get_timing_percentiles(metric, percentiles=(50, 95, 99)):
+    """Returns {'count': n, 'p50': ..., 'p95': ...} over the recent sample window."""
+    client = redis_setup.get_redis_client()
+    if not client:
+        return {"count": 0}
+
+    try:
+        samples = sorted(float(v) for v in client.lrange(_metric_key(metric), 0, -1))
+    except Exception as e:
+        logger.warning(f"Failed to read samples for metric '{metric}': {e}")
+        return {"count": 0}
+
+    summary = {"count": len(samples)}
+    for pct in percentiles:
+        summary[f"p{pct}"] = percentile(samples, pct)
+    return summary
+
+class Timer:
+    """Context manager measuring wall-clock time with perf_counter."""
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        self.elapsed = None
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.elapsed = time.perf_counter() - self.started
+        return False
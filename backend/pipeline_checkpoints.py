@@ -0,0 +1,63 @@
+import json
+import random
+import config
+
+from backend import redis_setup
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Stage outputs are stored per Celery task ID. Retries keep the same task ID,
+# so a retried task can pick up where the failed attempt stopped.
+
+def _checkpoint_key(task_id):
+    return f"{config.PIPELINE_CHECKPOINT_KEY_PREFIX}{task_id}"
+
+def load_checkpoint(task_id):
+    client = redis_setup.get_redis_client()
+    if not client or not task_id:
+        return {}
+
+    try:
+        raw = client.hgetall(_checkpoint_key(task_id))
+        checkpoint = {k.decode('utf-8'): json.loads(v) for k, v in raw.items()}
+        if checkpoint:
+            logger.info(f"Loaded checkpoint for task {task_id} with fields: {sorted(checkpoint)}")
+        return checkpoint
+
+    except Exception as e:
+        logger.warning(f"Failed to load checkpoint for task {task_id}: {e}. Starting from scratch.")
+        return {}
+
+def save_checkpoint(task_id, **fields):
+    client = redis_setup.get_redis_client()
+    if not client or not task_id:
+        return False
+
+    try:
+        key = _checkpoint_key(task_id)
+        pipeline = client.pipeline()
+        pipeline.hset(key, mapping={k: json.dumps(v) for k, v in fields.items()})
+        pipeline.expire(key, config.PIPELINE_CHECKPOINT_TTL_SECONDS)
+        pipeline.execute()
+        return True
+
+    except Exception as e:
+        logger.warning(f"Failed to save checkpoint for task {task_id}: {e}")
+        return False
+
+def clear_checkpoint(task_id):
+    client = redis_setup.get_redis_client()
+    if not client or not task_id:
+        return
+
+    try:
+        client.delete(_checkpoint_key(task_id))
+    except Exception as e:
+        logger.warning(f"Failed to clear checkpoint for task {task_id}: {e}")
+
+def jittered_backoff(retries, base=None, cap=None):
+    """Full-jitter exponential backoff in seconds for the given retry count."""
+    base = config.TASK_RETRY_BACKOFF_BASE_SECONDS if base is None else base
+    cap = config.TASK_RETRY_BACKOFF_MAX_SECONDS if cap is None else cap
+    return random.uniform(0, min(cap, base * (2 ** retries)))
@@ -28,7 +28,9 @@ def get_question_generation_prompts(passage: str) -> tuple[str, str]:
     user_prompt = (
         f"""Your task is to output ONLY a valid JSON array of 10 question objects based on the passage below.
         Alternate between question types like Multiple choice, True/False/Not Given, Matching, and Completion.
-        Each object MUST have these keys: "number" (integer), "type" (string), "text" (string).
+        Each object MUST have these keys: "number" (integer), "type" (string), "text" (string), "answer" (string).
+        "answer" is the correct answer: TRUE, FALSE or NOT GIVEN for True/False/Not Given; the option letter for Multiple choice;
+        the option label for Matching; the exact missing word(s) from the passage for Completion.
         CRITICAL: Your entire response must be ONLY the JSON array, starting with '[' and ending with ']'. No markdown, no commentary.
 
         Passage:
@@ -37,6 +39,52 @@ def get_question_generation_prompts(passage: str) -> tuple[str, str]:
     )
     return system_prompt, user_prompt
 
+def get_single_type_question_prompts(passage: str, question_type: str, count: int) -> tuple[str, str]:
+    """
+    Generates the system and user prompts for creating questions of a single IELTS question type.
+    """
+    system_prompt = f"You are an IELTS Reading expert tasked with generating {count} IELTS-style {question_type} questions for the provided passage."
+    user_prompt = (
+        f"""Your task is to output ONLY a valid JSON array of {count} question objects based on the passage below.
+        Every question MUST be of the type "{question_type}".
+        Each object MUST have these keys: "number" (integer), "type" (string), "text" (string), "answer" (string).
+        "answer" is the correct answer: TRUE, FALSE or NOT GIVEN for True/False/Not Given; the option letter for Multiple choice;
+        the option label for Matching; the exact missing word(s) from the passage for Completion.
+        CRITICAL: Your entire response must be ONLY the JSON array, starting with '[' and ending with ']'. No markdown, no commentary.
+
+        Passage:
+        \"\"\"{passage}\"\"\"
+        """
+    )
+    return system_prompt, user_prompt
+
+def get_combined_generation_prompts(context: str, query: str) -> tuple[str, str]:
+    """
+    Generates the system and user prompts for creating a passage and its questions in one JSON response.
+    """
+    system_prompt = "You are an IELTS Reading expert. Your task is to generate an IELTS-style academic reading passage and 10 questions for it."
+
+    if context:
+        prompt_context = context
+    else:
+        prompt_context = f"A comprehensive, 700-800 word IELTS-style academic reading passage about the topic: {query}"
+
+    user_prompt = (
+        f"""Based on the following, generate an IELTS-style academic reading passage and 10 IELTS-style questions about it.
+        The passage should be approximately 700–800 words long, organized into 4–6 paragraphs, with an academic tone and a suitable title.
+        Alternate between question types like Multiple choice, True/False/Not Given, Matching, and Completion.
+        Output ONLY a JSON object with these keys:
+        - "passage" (string): the full passage, including its title.
+        - "questions" (array): 10 objects, each with "number" (integer), "type" (string), "text" (string), "answer" (string).
+        "answer" is the correct answer: TRUE, FALSE or NOT GIVEN for True/False/Not Given; the option letter for Multiple choice;
+        the option label for Matching; the exact missing word(s) from the passage for Completion.
+
+        Context:
+        \"\"\"{prompt_context}\"\"\"
+        """
+    )
+    return system_prompt, user_prompt
+
 def get_evaluation_prompts(passage_content: str, questions_string: str, user_answers: str) -> tuple[str, str]:
     """
     Generates the system and user prompts for evaluating user answers.
@@ -83,4 +131,66 @@ def get_evaluation_prompts(passage_content: str, questions_string: str, user_ans
         Score Percentage: [Calculated Percentage]%
         """
     )
-    return system_prompt, user_prompt
\ No newline at end of file
+    return system_prompt, user_prompt
+
+def get_structured_evaluation_prompts(passage_content: str, questions_string: str, user_answers: str) -> tuple[str, str]:
+    """
+    Generates the system and user prompts for evaluating user answers as structured JSON rows.
+    """
+    system_prompt = (
+        """You are an IELTs Reading Expert. Your task is to evaluate the user's answers based on the provided passage and questions. 
+        You will provide the correct answers and grade the user's submission as JSON.
+        """
+    )
+    user_prompt = (
+        f"""Evaluate every question from the 'Questions' section.
+
+        **CRITICAL INSTRUCTIONS:**
+        1. Evaluate if the user's answer is Correct or Incorrect based ONLY on the Passage.
+        2. State the Correct Answer based ONLY on the Passage.
+        3. Provide a brief explanation ONLY if the user's answer is Incorrect. If the answer is Correct, the explanation MUST be exactly "N/A".
+        4. Output ONLY a JSON object with one key, "results": an array with one object per question, each with
+           "number" (integer), "your_answer" (string), "evaluation" ("Correct" or "Incorrect"),
+           "correct_answer" (string) and "explanation" (string).
+
+        **Passage:**
+        \"\"\"{passage_content}\"\"\"
+
+        **Questions:**
+        \"\"\"{questions_string}\"\"\"
+
+        **User's answers:**
+        \"\"\"{user_answers}\"\"\"
+        """
+    )
+    return system_prompt, user_prompt
+
+
+def get_batch_evaluation_prompts(passage_content: str, answers_block: str) -> tuple[str, str]:
+    """
+    Generates the system and user prompts for grading many students' distinct answers to one passage in one call.
+    """
+    system_prompt = (
+        """You are an IELTs Reading Expert. Your task is to grade a set of answers submitted by a class for the provided passage. 
+        You will provide the correct answers and grade every listed answer as JSON.
+        """
+    )
+    user_prompt = (
+        f"""Each question below is followed by the distinct answers submitted for it, each with an answer ID.
+
+        **CRITICAL INSTRUCTIONS:**
+        1. Grade EVERY listed answer as Correct or Incorrect based ONLY on the Passage.
+        2. State the Correct Answer for the question based ONLY on the Passage.
+        3. Provide a brief explanation ONLY if the answer is Incorrect. If the answer is Correct, the explanation MUST be exactly "N/A".
+        4. Output ONLY a JSON object with one key, "results": an array with one object per listed answer, each with
+           "number" (integer), "answer_id" (string), "evaluation" ("Correct" or "Incorrect"),
+           "correct_answer" (string) and "explanation" (string).
+
+        **Passage:**
+        \"\"\"{passage_content}\"\"\"
+
+        **Questions and answers to grade:**
+        \"\"\"{answers_block}\"\"\"
+        """
+    )
+    return system_prompt, user_prompt
@@ -1,15 +1,26 @@
 import json
-import re
+import uuid
+import asyncio
 import config
 import time
 from pinecone import Pinecone
 from mistralai import Mistral
 from openai import OpenAI
-from tenacity import retry, stop_after_attempt, wait_fixed
 import logging
 
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
 from backend import context_layer
 from backend import prompt_templates
+from backend import metrics
+from backend import task_events
+from backend import pipeline_checkpoints
+from backend import llm_router
+from backend import singleflight
+from backend import json_stream_parser
+from backend import topic_catalog
+from backend import local_grader
 
 logger = logging.getLogger(config.APP_NAME)
 
@@ -36,6 +47,53 @@ def validate_status(status):
         return status.value
     raise ValueError(f"Invalid status: {status}. Must be in accordance to ProcessingStatus")
 
+# --- Pipeline Stages ---
+class PipelineStage(Enum):
+    RETRIEVE_CONTEXT = 'retrieve_context'
+    GENERATE_PASSAGE = 'generate_passage'
+    GENERATE_QUESTIONS = 'generate_questions'
+
+class StageStatus(Enum):
+    RUNNING = 'running'
+    DONE = 'done'
+    FAILED = 'failed'
+
+PROGRESS_STATE = 'PROGRESS'     # Custom Celery state used while the pipeline is mid-flight
+
+def report_stage_progress(task, stage, status, timings):
+    """Stores the stage in the result backend and pushes it to the frontend listener."""
+    meta = {"stage": stage.value, "stage_status": status.value, "timings": dict(timings)}
+    try:
+        task.update_state(state=PROGRESS_STATE, meta=meta)
+    except Exception as e:
+        logger.warning(f"Could not update progress state for task {task.request.id}: {e}")
+
+    task_events.publish_task_event(
+        task.request.id, task_events.TaskEvent.STAGE,
+        stage=stage.value, stage_status=status.value, duration=timings.get(stage.value)
+    )
+
+@contextmanager
+def pipeline_stage(task, stage, timings):
+    report_stage_progress(task, stage, StageStatus.RUNNING, timings)
+    timer = metrics.Timer()
+    try:
+        with timer:
+            yield
+    except Exception:
+        timings[stage.value] = timer.elapsed
+        report_stage_progress(task, stage, StageStatus.FAILED, timings)
+        raise
+
+    timings[stage.value] = timer.elapsed
+    metrics.record_timing(f"query_stage.{stage.value}", timer.elapsed, task_id=task.request.id)
+    report_stage_progress(task, stage, StageStatus.DONE, timings)
+
+def resume_stage(task, stage, timings):
+    """Marks a stage restored from a checkpoint as done without rerunning it."""
+    logger.info(f"Task {task.request.id}: resuming past stage '{stage.value}' from checkpoint.")
+    report_stage_progress(task, stage, StageStatus.DONE, timings)
+
 # --- Core Functions (Simplified) ---
 
 def initialize_pinecone():
@@ -79,17 +137,35 @@ def initialize_selected_llm(model_choice):
         logger.critical("LLM Client initialization failed: %s", e, exc_info=True)
         return None
 
-@retry(stop=stop_after_attempt(3), wait=wait_fixed(2))
-def call_llm_chat(client, model_name, system_prompt, user_prompt):
+async def warm_up_llm_client(model_choice):
+    """Creates the LLM client and opens its HTTPS connection with a cheap models.list() call."""
+    llm_client = await asyncio.to_thread(initialize_selected_llm, model_choice)
+    if llm_client:
+        try:
+            await asyncio.to_thread(llm_client.models.list)
+        except Exception as e:
+            # The client is still usable; only the connection pre-warm was lost
+            logger.warning(f"LLM warm-up request for '{model_choice}' failed: {e}")
+    return llm_client
+
+async def retrieve_with_warm_llm(query, model_choice, filters=None):
+    """Overlaps query embedding and search with LLM client set-up; returns (llm_client, context)."""
+    llm_client, passage_context = await asyncio.gather(
+        warm_up_llm_client(model_choice),
+        context_layer.aget_context_for_query(query, filters=filters)
+    )
+    return llm_client, passage_context
+
+def get_model_name(model_choice):
+    if model_choice == config.MISTRAL_MODEL_CHOICE: return config.MISTRAL_MODEL
+    elif model_choice == config.OPENAI_MODEL_CHOICE: return config.OPENAI_MODEL
+    return ""
+
+def call_llm_chat(client, model_name, system_prompt, user_prompt, **request_options):
+    # The router handles retries: hedging, failover to other providers and circuit breaking
     try:
-        response = client.chat.completions.create(
-            model=model_name,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt}
-            ]
-        )
-        return response.choices[0].message.content
+        return llm_router.get_router().chat(system_prompt, user_prompt, primary_model=model_name,
+                                            primary_client=client, **request_options)
     except Exception as e:
         raise Exception(f"API call to {model_name} failed: {e}")
 
@@ -110,65 +186,333 @@ def generate_reading_passages(model_choice: str, query: str, context: str, llm_c
         logger.error("Passage generation failed: %s", e, exc_info=True)
         return None
 
+# --- Combined Generation Mode ---
+QUESTION_ITEM_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "number": {"type": "integer"},
+        "type": {"type": "string"},
+        "text": {"type": "string"},
+        "answer": {"type": "string"}
+    },
+    "required": ["number", "type", "text", "answer"],
+    "additionalProperties": False
+}
+
+COMBINED_GENERATION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "passage": {"type": "string"},
+        "questions": {"type": "array", "items": QUESTION_ITEM_SCHEMA}
+    },
+    "required": ["passage", "questions"],
+    "additionalProperties": False
+}
+
+def has_answer_key(item):
+    """Objective items need an answer key to be graded locally; free-text types may leave it empty."""
+    if local_grader.grading_kind(item.get("type")) is None:
+        return True
+    answer = item.get("answer")
+    return isinstance(answer, str) and answer.strip() != ""
+
+def count_missing_answers(questions, mode):
+    """Counts objective items generated without an answer key, so drift in the generator shows up in metrics."""
+    missing = [q.get("number") for q in questions or [] if isinstance(q, dict) and not has_answer_key(q)]
+    if missing:
+        metrics.increment_counter("question_generation.missing_answer", len(missing))
+        metrics.increment_counter(f"question_generation.{mode}.missing_answer", len(missing))
+        logger.warning(f"{len(missing)} objective question(s) generated without an answer key ({mode}): {missing}")
+    return len(missing)
+
+def validate_question_item(item):
+    return (
+        isinstance(item, dict)
+        and isinstance(item.get("number"), int) and not isinstance(item.get("number"), bool)
+        and isinstance(item.get("type"), str) and item["type"].strip() != ""
+        and isinstance(item.get("text"), str) and item["text"].strip() != ""
+        and has_answer_key(item)
+    )
+
+def validate_combined_payload(payload):
+    """Checks a parsed combined response against COMBINED_GENERATION_SCHEMA. Returns a list of problems."""
+    if not isinstance(payload, dict):
+        return ["top-level value is not an object"]
+
+    problems = []
+    passage = payload.get("passage")
+    if not isinstance(passage, str) or not passage.strip():
+        problems.append("'passage' is missing or empty")
+
+    questions = payload.get("questions")
+    if not isinstance(questions, list) or not questions:
+        problems.append("'questions' is missing or empty")
+    else:
+        count_missing_answers(questions, "combined")
+        invalid = [i for i, q in enumerate(questions) if not validate_question_item(q)]
+        if invalid:
+            problems.append(f"invalid question objects at positions {invalid}")
+
+    return problems
+
+def generate_passage_and_questions(model_choice, query, context, llm_client):
+    """
+    Single-call mode: asks for the passage and questions in one schema-constrained JSON response.
+    Returns (passage, questions), or None when the output fails validation so callers can fall back.
+    """
+    system_prompt, user_prompt = prompt_templates.get_combined_generation_prompts(context, query)
+    response_format = {
+        "type": "json_schema",
+        "json_schema": {"name": "ielts_passage_with_questions", "schema": COMBINED_GENERATION_SCHEMA, "strict": True}
+    }
+
+    raw_output = None
+    try:
+        raw_output = call_llm_chat(llm_client, get_model_name(model_choice), system_prompt, user_prompt,
+                                   response_format=response_format)
+        payload = json.loads(raw_output)
+
+    except json.JSONDecodeError as json_e:
+        logger.warning("Combined generation returned invalid JSON: %s. Raw output was: %s", json_e, raw_output)
+        metrics.increment_counter("generation_mode.combined.fallback")
+        return None
+
+    except Exception as e:
+        logger.warning("Combined generation call failed: %s", e, exc_info=True)
+        metrics.increment_counter("generation_mode.combined.fallback")
+        return None
+
+    problems = validate_combined_payload(payload)
+    if problems:
+        logger.warning(f"Combined generation failed schema validation: {problems}")
+        metrics.increment_counter("generation_mode.combined.fallback")
+        return None
+
+    metrics.increment_counter("generation_mode.combined.success")
+    return payload["passage"], payload["questions"]
+
+def generate_questions_for_type(model_choice, passage, llm_client, question_type, count):
+    system_prompt, user_prompt = prompt_templates.get_single_type_question_prompts(passage, question_type, count)
+    raw_output = call_llm_chat(llm_client, get_model_name(model_choice), system_prompt, user_prompt)
+    questions = json_stream_parser.parse_questions(raw_output)
+    if not questions:
+        raise ValueError(f"No valid {question_type} questions could be parsed from the LLM output")
+    # Kept either way: items without a key are graded by the LLM evaluator instead
+    count_missing_answers(questions, "fan_out")
+    return questions[:count]
+
+def merge_question_groups(question_groups):
+    """
+    Merges per-type question lists in QUESTION_TYPE_DISTRIBUTION order and renumbers them 1..N,
+    so the result does not depend on which call finished first.
+    """
+    merged = []
+    for question_type in config.QUESTION_TYPE_DISTRIBUTION:
+        for question in question_groups.get(question_type, []):
+            if not isinstance(question, dict):
+                continue
+            merged.append({**question, "number": len(merged) + 1, "type": question_type})
+    return merged
+
+def generate_questions_by_type(model_choice, passage, llm_client):
+    """Fan-out mode: one smaller concurrent call per question type, merged deterministically."""
+    distribution = config.QUESTION_TYPE_DISTRIBUTION
+    question_groups = {}
+
+    with ThreadPoolExecutor(max_workers=len(distribution)) as executor:
+        futures = {
+            executor.submit(generate_questions_for_type, model_choice, passage, llm_client, q_type, count): q_type
+            for q_type, count in distribution.items()
+        }
+        for future in as_completed(futures):
+            q_type = futures[future]
+            try:
+                question_groups[q_type] = future.result()
+            except Exception as e:
+                logger.error("Question generation failed for type '%s': %s", q_type, e, exc_info=True)
+
+    merged = merge_question_groups(question_groups)
+    if not merged:
+        raise ValueError("Fan-out question generation produced no questions for any type")
+
+    missing_types = [q_type for q_type in distribution if q_type not in question_groups]
+    if missing_types:
+        logger.warning(f"Fan-out question generation is missing types {missing_types}; returning {len(merged)} questions.")
+    return merged
+
 def generate_questions(model_choice, passage, llm_client):
+    if config.QUESTION_GENERATION_MODE == "fan_out":
+        return generate_questions_by_type(model_choice, passage, llm_client)
+
     system_prompt, user_prompt = prompt_templates.get_question_generation_prompts(passage)
+    parser = json_stream_parser.QuestionStreamParser()
 
     try:
-        model_name = ""
-        if model_choice == config.MISTRAL_MODEL_CHOICE: model_name = config.MISTRAL_MODEL
-        elif model_choice == config.OPENAI_MODEL_CHOICE: model_name = config.OPENAI_MODEL
+        call_llm_chat(llm_client, get_model_name(model_choice), system_prompt, user_prompt, stream_to=parser.feed)
 
-        raw_output = call_llm_chat(llm_client, model_name, system_prompt, user_prompt)
-        cleaned_json_string = re.sub(r'```json\s*|\s*```', '', raw_output.strip(), flags=re.DOTALL)
-        return json.loads(cleaned_json_string)
-    
-    except json.JSONDecodeError as json_e:
-        logger.error("Failed to parse JSON from LLM: %s. Raw output was: %s", json_e, raw_output, exc_info=True)
-        raise
-    
     except Exception as e:
-        logger.error("Question generation process failed: %s", e, exc_info=True)
-        raise
+        # A broken stream still leaves every question that was completed before it
+        if len(parser.questions) < config.QUESTION_MIN_VALID_COUNT:
+            logger.error("Question generation process failed: %s", e, exc_info=True)
+            raise
+        logger.warning(f"Question stream failed after {len(parser.questions)} valid questions; using them. Error: {e}")
 
-@celery_app.task(bind = True, max_retries = 3, default_retry_delay = 60, acks_late = True)
-def process_query_task(self, query, chosen_LLM):
-    task_id = self.request.id
-    logger.info(f"[PROCESS QUERY TASK STARTS]. Task ID: {task_id}, Query: '{query}', Chosen LLM: {chosen_LLM}")
+    questions = parser.close()
+    if parser.rejected or parser.truncated:
+        metrics.increment_counter("question_parser.repaired_outputs")
+    count_missing_answers(questions, "single")
+
+    if len(questions) < config.QUESTION_MIN_VALID_COUNT:
+        raise ValueError(f"Only {len(questions)} valid questions parsed (rejected: {parser.rejected}, "
+                         f"truncated: {parser.truncated}); at least {config.QUESTION_MIN_VALID_COUNT} required")
+    return questions
+
+def run_query_pipeline(task, query, chosen_LLM, filters=None, topic_id=None):
+    """Runs retrieve -> passage -> questions, resuming from the task's checkpoint if one exists."""
+    task_id = task.request.id
     task_result = {}
 
-    try:
-        pc, index = initialize_pinecone()
+    checkpoint = pipeline_checkpoints.load_checkpoint(task_id)
+    timings = checkpoint.get('timings', {})
+
+    # Catalog topics carry a precomputed context bundle; treat it like a checkpointed retrieval
+    if topic_id is not None and 'context' not in checkpoint:
+        catalog_context = topic_catalog.get_topic_context(topic_id)
+        if catalog_context is not None:
+            checkpoint['context'] = catalog_context
+            timings.setdefault(PipelineStage.RETRIEVE_CONTEXT.value, 0.0)
+            metrics.increment_counter("topic_catalog.context_hit")
+        else:
+            metrics.increment_counter("topic_catalog.context_miss")
+
+    # 1. Get context from the new dedicated builder (async path overlaps it with LLM set-up)
+    passage_context = checkpoint.get('context')
+    if passage_context is None and config.ASYNC_RETRIEVAL_ENABLED:
+        with pipeline_stage(task, PipelineStage.RETRIEVE_CONTEXT, timings):
+            llm_client, passage_context = context_layer.run_async(retrieve_with_warm_llm(query, chosen_LLM, filters))
+        pipeline_checkpoints.save_checkpoint(task_id, context=passage_context, timings=timings)
+    else:
         llm_client = initialize_selected_llm(chosen_LLM)
 
-        if not pc or not index or not llm_client:
-            task_result['status'] = validate_status(ProcessingStatus.MAIN_EXEC_FAILED)
-            task_result['error_message'] = "A required service (Pinecone or LLM) failed to initialize."
+    if not llm_client:
+        task_result['status'] = validate_status(ProcessingStatus.LLM_INIT_FAILED)
+        task_result['error_message'] = "The LLM client failed to initialize."
+        logger.critical(f"Task {task_id} failed: {task_result['error_message']}")
+        return task_result
+
+    if 'context' in checkpoint:
+        resume_stage(task, PipelineStage.RETRIEVE_CONTEXT, timings)
+    elif not config.ASYNC_RETRIEVAL_ENABLED:
+        pc, index = initialize_pinecone()
+        if (not pc or not index) and (filters or not config.HYBRID_RETRIEVAL_ENABLED):
+            task_result['status'] = validate_status(ProcessingStatus.PINECONE_INIT_FAILED)
+            task_result['error_message'] = "A required service (Pinecone) failed to initialize."
             logger.critical(f"Task {task_id} failed: {task_result['error_message']}")
             return task_result
 
-        # 1. Get context from the new dedicated builder
-        passage_context = context_layer.get_context_for_query(query, pc, index)
-        
-        # 2. Generate the passage using the context (which may be empty)
-        generated_passage = generate_reading_passages(chosen_LLM, query, passage_context, llm_client)
+        with pipeline_stage(task, PipelineStage.RETRIEVE_CONTEXT, timings):
+            passage_context = context_layer.get_context_for_query(query, pc, index, filters=filters)
+        pipeline_checkpoints.save_checkpoint(task_id, context=passage_context, timings=timings)
+    
+    # 2. Generate the passage using the context (which may be empty)
+    generated_questions_list = checkpoint.get('questions')
+    if checkpoint.get('passage'):
+        generated_passage = checkpoint['passage']
+        resume_stage(task, PipelineStage.GENERATE_PASSAGE, timings)
+    else:
+        with pipeline_stage(task, PipelineStage.GENERATE_PASSAGE, timings):
+            combined_output = None
+            if config.QUERY_GENERATION_MODE == "combined":
+                combined_output = generate_passage_and_questions(chosen_LLM, query, passage_context, llm_client)
+
+            if combined_output:
+                generated_passage, generated_questions_list = combined_output
+            else:
+                generated_passage = generate_reading_passages(chosen_LLM, query, passage_context, llm_client)
         if not generated_passage:
+            pipeline_checkpoints.clear_checkpoint(task_id)
             task_result['status'] = validate_status(ProcessingStatus.PASSAGE_GEN_FAILED)
             task_result['error_message'] = "The LLM failed to generate a reading passage."
             return task_result
+        pipeline_checkpoints.save_checkpoint(task_id, passage=generated_passage,
+                                             questions=generated_questions_list, timings=timings)
 
-        # 3. Generate questions for the new passage
-        generated_questions_list = generate_questions(chosen_LLM, generated_passage, llm_client)
-        if not generated_questions_list:
-            task_result['status'] = validate_status(ProcessingStatus.QUESTION_GEN_FAILED)
-            task_result['error_message'] = "The LLM failed to generate valid questions."
-            return task_result
-
-        task_result['status'] = validate_status(ProcessingStatus.QUERY_SUCCESS)
-        task_result['passage'] = generated_passage
-        task_result['questions'] = generated_questions_list
-        logger.info(f"[PROCESS QUERY TASK SUCCESSFUL]. Task ID: {task_id}.")
+    # 3. Generate questions for the new passage (already done in combined mode)
+    if generated_questions_list:
+        timings.setdefault(PipelineStage.GENERATE_QUESTIONS.value, 0.0)
+        report_stage_progress(task, PipelineStage.GENERATE_QUESTIONS, StageStatus.DONE, timings)
+    else:
+        with pipeline_stage(task, PipelineStage.GENERATE_QUESTIONS, timings):
+            generated_questions_list = generate_questions(chosen_LLM, generated_passage, llm_client)
+    pipeline_checkpoints.clear_checkpoint(task_id)
+    if not generated_questions_list:
+        task_result['status'] = validate_status(ProcessingStatus.QUESTION_GEN_FAILED)
+        task_result['error_message'] = "The LLM failed to generate valid questions."
         return task_result
+
+    task_result['status'] = validate_status(ProcessingStatus.QUERY_SUCCESS)
+    task_result['passage'] = generated_passage
+    task_result['questions'] = generated_questions_list
+    task_result['timings'] = timings
+    logger.info(f"[PROCESS QUERY TASK SUCCESSFUL]. Task ID: {task_id}. Stage timings: {timings}")
+    return task_result
+
+@celery_app.task(bind = True, max_retries = 3, default_retry_delay = 60, acks_late = True)
+def process_query_task(self, query, chosen_LLM, filters=None, topic_id=None):
+    task_id = self.request.id
+    logger.info(f"[PROCESS QUERY TASK STARTS]. Task ID: {task_id}, Query: '{query}', Chosen LLM: {chosen_LLM}")
+
+    # Identical in-flight queries share one pipeline run. submit_query_task already took the lease under
+    # this task's ID; tasks dispatched any other way coalesce here, with a wait bounded near the pipeline's p95
+    flight_key = singleflight.coalesce_key(query, chosen_LLM, filters)
+    is_leader, leader_id = singleflight.acquire_lease(flight_key, task_id)
+    if not is_leader:
+        logger.info(f"Task {task_id}: identical query already in flight ({leader_id}), waiting for its result.")
+        shared_result = singleflight.wait_for_result(flight_key, leader_id)
+        if shared_result:
+            logger.info(f"[PROCESS QUERY TASK SUCCESSFUL]. Task ID: {task_id}. Result shared from an in-flight duplicate.")
+            return {**shared_result, 'coalesced': True}
+        logger.warning(f"Task {task_id}: no shared result received, running the pipeline itself.")
+
+    try:
+        task_result = run_query_pipeline(self, query, chosen_LLM, filters, topic_id)
     
     except Exception as e:
-        logger.error(f"An unhandled exception occurred in process_query_task {task_id}: {e}", exc_info=True)
-        raise self.retry(exc=e, countdown=30)
\ No newline at end of file
+        # Waiting duplicates stop blocking their workers and run the pipeline themselves
+        singleflight.publish_failure(flight_key, task_id, e)
+        if self.request.retries >= self.max_retries:
+            singleflight.release_lease(flight_key, task_id)
+
+        # Completed stages are checkpointed, so a short jittered backoff is enough here
+        countdown = pipeline_checkpoints.jittered_backoff(self.request.retries)
+        logger.error(f"An unhandled exception occurred in process_query_task {task_id}: {e}. "
+                     f"Retrying in {countdown:.1f}s from the failed stage.", exc_info=True)
+        raise self.retry(exc=e, countdown=countdown)
+
+    if task_result.get('status') == validate_status(ProcessingStatus.QUERY_SUCCESS):
+        singleflight.publish_result(flight_key, task_id, task_result)
+    else:
+        singleflight.release_lease(flight_key, task_id)
+    return task_result
+
+def submit_query_task(query, chosen_LLM, filters=None, topic_id=None):
+    """
+    Dispatches process_query_task, or returns the task ID of an identical run already in flight
+    anywhere in the cluster, so duplicates wait on that task's result without holding a worker.
+    The lease is taken here under the new task's ID, which the task then recognises as its own.
+    """
+    task_id = str(uuid.uuid4())
+    flight_key = singleflight.coalesce_key(query, chosen_LLM, filters)
+    is_leader, leader_id = singleflight.acquire_lease(flight_key, task_id)
+    if not is_leader:
+        metrics.increment_counter("singleflight.coalesced_at_dispatch")
+        logger.info(f"Identical query already in flight as task {leader_id}; joining it instead of dispatching.")
+        return leader_id
+
+    try:
+        process_query_task.apply_async(kwargs={"query": query, "chosen_LLM": chosen_LLM, "filters": filters, "topic_id": topic_id},
+                                       task_id=task_id)
+    except Exception:
+        singleflight.release_lease(flight_key, task_id)
+        raise
+    return task_id
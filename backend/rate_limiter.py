@@ -0,0 +1,175 @@
+import time
+import random
+import config
+
+from backend import redis_setup
+from backend import metrics
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Cluster-wide token buckets for LLM calls, one Redis hash per provider/model.
+# Each hash holds two buckets refilled continuously: one for requests and one for tokens.
+# Every worker goes through the same buckets, so a burst is queued (or shed) centrally
+# instead of each worker hitting the provider and retrying on its own schedule.
+
+class RateLimitExceeded(Exception):
+    pass
+
+TOKEN_BUCKET_SCRIPT = """
+local key = KEYS[1]
+local req_cap = tonumber(ARGV[1])
+local req_rate = tonumber(ARGV[2])
+local tok_cap = tonumber(ARGV[3])
+local tok_rate = tonumber(ARGV[4])
+local want_tok = math.min(tonumber(ARGV[5]), tok_cap)
+local ttl = tonumber(ARGV[6])
+
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+
+local state = redis.call('HMGET', key, 'req', 'tok', 'ts')
+local req = tonumber(state[1]) or req_cap
+local tok = tonumber(state[2]) or tok_cap
+local ts = tonumber(state[3]) or now
+
+local elapsed = math.max(0, now - ts)
+req = math.min(req_cap, req + elapsed * req_rate)
+tok = math.min(tok_cap, tok + elapsed * tok_rate)
+
+local allowed = 0
+local wait = 0
+if req >= 1 and tok >= want_tok then
+    req = req - 1
+    tok = tok - want_tok
+    allowed = 1
+else
+    local req_wait = 0
+    local tok_wait = 0
+    if req < 1 then req_wait = (1 - req) / req_rate end
+    if tok < want_tok then tok_wait = (want_tok - tok) / tok_rate end
+    wait = math.max(req_wait, tok_wait)
+end
+
+redis.call('HSET', key, 'req', req, 'tok', tok, 'ts', now)
+redis.call('EXPIRE', key, ttl)
+return {allowed, tostring(wait), tostring(req), tostring(tok)}
+"""
+
+# Empties both buckets and restarts the refill clock from now, so no budget accrues for the time before the 429
+PENALIZE_SCRIPT = """
+local t = redis.call('TIME')
+local now = tonumber(t[1]) + tonumber(t[2]) / 1000000
+redis.call('HSET', KEYS[1], 'req', 0, 'tok', 0, 'ts', now)
+redis.call('EXPIRE', KEYS[1], ARGV[1])
+return 1
+"""
+
+token_bucket_script = None
+
+def _get_script(client):
+    global token_bucket_script
+    if not token_bucket_script:
+        token_bucket_script = client.register_script(TOKEN_BUCKET_SCRIPT)
+    return token_bucket_script
+
+def bucket_key(provider, model):
+    return f"{config.RATE_LIMIT_KEY_PREFIX}{provider}:{model}"
+
+def get_limits(model):
+    limits = config.LLM_RATE_LIMITS.get(model, config.LLM_RATE_LIMIT_DEFAULT)
+    return limits["requests_per_minute"], limits["tokens_per_minute"]
+
+def estimate_tokens(*texts, completion_tokens=None):
+    """Rough estimate (~4 characters per token) of prompt tokens plus the expected completion."""
+    prompt_tokens = sum(len(t or "") for t in texts) // 4
+    if completion_tokens is None:
+        completion_tokens = config.LLM_RATE_LIMIT_DEFAULT_COMPLETION_TOKENS
+    return prompt_tokens + completion_tokens
+
+def acquire(provider, model, tokens, max_wait=None):
+    """
+    Blocks until both buckets admit the request, or raises RateLimitExceeded when the
+    expected wait is longer than max_wait (load shedding). Fails open if Redis is unavailable.
+    """
+    client = redis_setup.get_redis_client()
+    if not client:
+        return 0.0
+
+    max_wait = config.LLM_RATE_LIMIT_MAX_WAIT_SECONDS if max_wait is None else max_wait
+    requests_per_minute, tokens_per_minute = get_limits(model)
+    key = bucket_key(provider, model)
+    waited = 0.0
+
+    while True:
+        try:
+            allowed, wait_seconds, _, _ = _get_script(client)(
+                keys=[key],
+                args=[requests_per_minute, requests_per_minute / 60, tokens_per_minute, tokens_per_minute / 60,
+                      tokens, config.RATE_LIMIT_KEY_TTL_SECONDS]
+            )
+        except Exception as e:
+            logger.warning(f"Rate limiter unavailable for {key}: {e}. Allowing request.")
+            return waited
+
+        if int(allowed):
+            metrics.increment_counter(f"ratelimit.{provider}:{model}.admitted")
+            if waited:
+                metrics.record_timing(f"ratelimit.{provider}:{model}.wait", waited)
+            return waited
+
+        wait_seconds = float(wait_seconds)
+        if waited + wait_seconds > max_wait:
+            metrics.increment_counter(f"ratelimit.{provider}:{model}.shed")
+            raise RateLimitExceeded(f"Rate limit budget for {provider}/{model} exhausted (needs {wait_seconds:.1f}s more)")
+
+        # Jitter keeps queued callers across workers from waking up in lockstep
+        sleep_for = wait_seconds + random.uniform(0, config.LLM_RATE_LIMIT_JITTER_SECONDS)
+        metrics.increment_counter(f"ratelimit.{provider}:{model}.queued")
+        time.sleep(sleep_for)
+        waited += sleep_for
+
+def reconcile(provider, model, estimated_tokens, actual_tokens):
+    """Refunds (or charges) the difference between the estimated and the actual token usage."""
+    client = redis_setup.get_redis_client()
+    if not client or actual_tokens is None:
+        return
+
+    try:
+        client.hincrbyfloat(bucket_key(provider, model), "tok", estimated_tokens - actual_tokens)
+    except Exception as e:
+        logger.warning(f"Failed to reconcile token usage for {provider}/{model}: {e}")
+
+def penalize(provider, model):
+    """Empties both buckets after a provider 429, so every worker backs off together."""
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+
+    try:
+        client.eval(PENALIZE_SCRIPT, 1, bucket_key(provider, model), config.RATE_LIMIT_KEY_TTL_SECONDS)
+        metrics.increment_counter(f"ratelimit.{provider}:{model}.provider_429")
+    except Exception as e:
+        logger.warning(f"Failed to penalize bucket for {provider}/{model}: {e}")
+
+def get_saturation(provider, model):
+    """Returns how full each bucket's budget is in use (0.0 idle, 1.0 exhausted) plus shed/queue counters."""
+    client = redis_setup.get_redis_client()
+    if not client:
+        return {}
+
+    requests_per_minute, tokens_per_minute = get_limits(model)
+    try:
+        req, tok = client.hmget(bucket_key(provider, model), "req", "tok")
+    except Exception as e:
+        logger.warning(f"Failed to read rate limiter state for {provider}/{model}: {e}")
+        return {}
+
+    req = requests_per_minute if req is None else float(req)
+    tok = tokens_per_minute if tok is None else float(tok)
+    saturation = {
+        "request_saturation": max(0.0, 1 - req / requests_per_minute),
+        "token_saturation": max(0.0, 1 - tok / tokens_per_minute),
+    }
+    saturation.update(metrics.get_counters(prefix=f"ratelimit.{provider}:{model}."))
+    return saturation
@@ -0,0 +1,46 @@
+import redis
+import threading
+import config
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+redis_client = None
+client_init_lock = threading.Lock()
+
+def initialize_client():
+    global redis_client
+
+    with client_init_lock:
+        if redis_client:
+            logger.debug("Redis client already initialized")
+            return redis_client
+
+        logger.info("Initializing shared Redis client")
+
+        try:
+            redis_client = redis.StrictRedis(
+                host=config.REDIS_HOST,
+                port=config.REDIS_PORT,
+                db=config.REDIS_DB,
+                decode_responses=False
+            )
+            redis_client.ping()
+
+            logger.info(f"Shared Redis client connected to {config.REDIS_HOST}:{config.REDIS_PORT}, DB: {config.REDIS_DB}")
+            return redis_client
+
+        except Exception as e:
+            redis_client = None
+            logger.exception("Failed to initialize shared Redis client")
+            raise ConnectionError("Redis client initialization failed") from e
+
+def get_redis_client():
+    """Returns the shared Redis client, or None if Redis is unreachable."""
+    if redis_client:
+        return redis_client
+
+    try:
+        return initialize_client()
+    except ConnectionError:
+        return None
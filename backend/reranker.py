@@ -0,0 +1,159 @@
+import re
+import math
+import time
+import threading
+import config
+from collections import Counter
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Optional dependency: a small local cross-encoder. Without it, a BM25-style
+# lexical-overlap scorer computed over the candidate set is used instead.
+try:
+    from sentence_transformers import CrossEncoder
+except ImportError:
+    CrossEncoder = None
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+STOPWORDS = {
+    "a", "an", "and", "are", "as", "at", "be", "by", "for", "from", "has", "in", "is", "it",
+    "its", "of", "on", "or", "that", "the", "to", "was", "were", "with", "this", "which", "about"
+}
+
+def tokenize(text):
+    return [t for t in TOKEN_PATTERN.findall((text or "").lower()) if t not in STOPWORDS]
+
+class LexicalOverlapScorer:
+    """BM25 over the candidate set itself, so no corpus statistics are needed."""
+    name = "lexical"
+
+    def __init__(self, k1=1.2, b=0.75):
+        self.k1 = k1
+        self.b = b
+
+    def prepare(self, query, texts):
+        self.query_terms = set(tokenize(query))
+        self.doc_terms = [Counter(tokenize(text)) for text in texts]
+        self.avg_length = (sum(sum(d.values()) for d in self.doc_terms) / len(self.doc_terms)) if self.doc_terms else 0
+        doc_count = len(self.doc_terms)
+        self.idf = {
+            term: math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+            for term in self.query_terms
+            for df in [sum(1 for d in self.doc_terms if term in d)]
+        }
+
+    def score_batch(self, indices):
+        scores = []
+        for i in indices:
+            terms = self.doc_terms[i]
+            length = sum(terms.values()) or 1
+            score = 0.0
+            for term in self.query_terms:
+                tf = terms.get(term, 0)
+                if tf:
+                    norm = tf + self.k1 * (1 - self.b + self.b * length / (self.avg_length or 1))
+                    score += self.idf[term] * tf * (self.k1 + 1) / norm
+            scores.append(score)
+        return scores
+
+class CrossEncoderScorer:
+    """Scores with the process-wide model; get_scorer only hands one out once the model is loaded."""
+    name = "cross_encoder"
+    model = None
+    model_lock = threading.Lock()
+    load_started = False
+
+    @classmethod
+    def load_model(cls):
+        with cls.model_lock:
+            if cls.model is None:
+                started = time.perf_counter()
+                logger.info(f"Loading cross-encoder '{config.RERANK_CROSS_ENCODER_MODEL}' on CPU.")
+                cls.model = CrossEncoder(config.RERANK_CROSS_ENCODER_MODEL, device="cpu")
+                logger.info(f"Cross-encoder loaded in {time.perf_counter() - started:.1f}s.")
+        return cls.model
+
+    @classmethod
+    def load_in_background(cls):
+        with cls.model_lock:
+            if cls.load_started:
+                return
+            cls.load_started = True
+
+        def load():
+            try:
+                cls.load_model()
+            except Exception as e:
+                logger.error(f"Failed to load cross-encoder; reranking stays lexical: {e}", exc_info=True)
+
+        threading.Thread(target=load, name="cross-encoder-load", daemon=True).start()
+
+    def prepare(self, query, texts):
+        self.query = query
+        self.texts = texts
+
+    def score_batch(self, indices):
+        pairs = [(self.query, self.texts[i]) for i in indices]
+        return [float(s) for s in CrossEncoderScorer.model.predict(pairs, batch_size=len(pairs))]
+
+def get_scorer(kind=None):
+    kind = kind or config.RERANK_SCORER
+    if kind == "cross_encoder":
+        if CrossEncoder is None:
+            logger.warning("sentence-transformers is not installed; using the lexical reranker.")
+        elif CrossEncoderScorer.model is not None:
+            return CrossEncoderScorer()
+        else:
+            # Loading takes seconds, far past the rerank budget: this request reranks lexically meanwhile
+            CrossEncoderScorer.load_in_background()
+            logger.info("Cross-encoder is not loaded yet; using the lexical reranker for this request.")
+    return LexicalOverlapScorer()
+
+def warm_up():
+    """Loads the cross-encoder up front (Celery worker_process_init) when it is the configured scorer."""
+    if not config.RERANK_ENABLED or config.RERANK_SCORER != "cross_encoder" or CrossEncoder is None:
+        return
+    with CrossEncoderScorer.model_lock:
+        CrossEncoderScorer.load_started = True
+    try:
+        CrossEncoderScorer.load_model()
+    except Exception as e:
+        logger.error(f"Failed to load cross-encoder at startup; reranking stays lexical: {e}", exc_info=True)
+
+def rerank(query, candidates, top_n=None, budget_seconds=None, scorer=None):
+    """
+    Reorders retrieved candidates by relevance to the query and returns the best top_n.
+    Scoring runs in batches; once the latency budget is spent, the remaining candidates keep
+    their retrieval order behind the scored ones.
+    """
+    top_n = config.RERANK_TOP_N if top_n is None else top_n
+    budget_seconds = config.RERANK_BUDGET_SECONDS if budget_seconds is None else budget_seconds
+    if not candidates:
+        return []
+
+    scorer = scorer or get_scorer()
+    started = time.perf_counter()
+    scorer.prepare(query, [c["text"] for c in candidates])
+
+    scores = {}
+    batch_size = config.RERANK_BATCH_SIZE
+    for start in range(0, len(candidates), batch_size):
+        if time.perf_counter() - started > budget_seconds:
+            logger.warning(f"Rerank budget of {budget_seconds}s spent after scoring {len(scores)}/{len(candidates)} candidates.")
+            break
+        indices = list(range(start, min(start + batch_size, len(candidates))))
+        scores.update(zip(indices, scorer.score_batch(indices)))
+
+    scored = sorted(scores, key=lambda i: scores[i], reverse=True)
+    reranked = [{**candidates[i], "rerank_score": scores[i]} for i in scored]
+
+    # Unscored candidates rank below every scored one, in retrieval order
+    floor = min(scores.values()) if scores else None
+    unscored = [i for i in range(len(candidates)) if i not in scores]
+    for position, i in enumerate(unscored, start=1):
+        reranked.append({**candidates[i], "rerank_score": None if floor is None else floor - position})
+
+    elapsed = time.perf_counter() - started
+    logger.info(f"Reranked {len(candidates)} candidates with {scorer.name} scorer in {elapsed * 1000:.1f}ms; keeping {top_n}.")
+    return reranked[:top_n]
@@ -0,0 +1,166 @@
+import re
+import json
+import time
+import hashlib
+import config
+
+from backend import redis_setup
+from backend import metrics
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# Request coalescing across Celery workers. The first task for a key takes a
+# Redis lease and does the work; concurrent duplicates wait for its result on a
+# pub/sub channel instead of running the same pipeline again.
+
+def normalize_query(query):
+    normalized = re.sub(r"[^\w\s]", " ", (query or "").lower())
+    return " ".join(normalized.split())
+
+def coalesce_key(query, chosen_llm, filters=None):
+    # Filtered and unfiltered runs of the same query retrieve different context
+    filter_part = json.dumps(filters, sort_keys=True) if filters else ""
+    digest = hashlib.sha1(f"{normalize_query(query)}|{(chosen_llm or '').strip()}|{filter_part}".encode('utf-8')).hexdigest()
+    return digest
+
+def _lease_key(key):
+    return f"{config.SINGLEFLIGHT_KEY_PREFIX}lease:{key}"
+
+def _result_key(key, leader_id):
+    # Scoped to the leader's run: only duplicates that joined that run can read it, and a
+    # later request for the same topic starts a fresh run instead of reusing the passage
+    return f"{config.SINGLEFLIGHT_KEY_PREFIX}result:{key}:{leader_id}"
+
+def _channel(key):
+    return f"{config.SINGLEFLIGHT_KEY_PREFIX}done:{key}"
+
+# Takes the lease if it is free and returns its owner either way, in one round trip
+ACQUIRE_LEASE_SCRIPT = """
+if redis.call('SET', KEYS[1], ARGV[1], 'NX', 'EX', ARGV[2]) then
+    return ARGV[1]
+end
+return redis.call('GET', KEYS[1])
+"""
+
+def acquire_lease(key, task_id):
+    """
+    Returns (is_leader, leader_id). A retried leader keeps its Celery task ID, so it is
+    recognised as the lease owner again. Fails open (leader) if Redis is unavailable.
+    """
+    client = redis_setup.get_redis_client()
+    if not client:
+        return True, task_id
+
+    try:
+        owner = client.eval(ACQUIRE_LEASE_SCRIPT, 1, _lease_key(key), task_id, config.SINGLEFLIGHT_LEASE_SECONDS)
+        owner = owner.decode('utf-8') if isinstance(owner, bytes) else owner
+        if owner is None:
+            # Released between SET NX and GET; run without coalescing rather than wait on nobody
+            return True, task_id
+        return owner == task_id, owner
+
+    except Exception as e:
+        logger.warning(f"Singleflight lease check failed for {key}: {e}. Running without coalescing.")
+        return True, task_id
+
+def _lease_owner(client, key):
+    owner = client.get(_lease_key(key))
+    return owner.decode('utf-8') if owner is not None else None
+
+def release_lease(key, task_id):
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+
+    try:
+        if _lease_owner(client, key) == task_id:
+            client.delete(_lease_key(key))
+    except Exception as e:
+        logger.warning(f"Failed to release singleflight lease {key}: {e}")
+
+def _publish(key, message):
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+    try:
+        client.publish(_channel(key), json.dumps(message))
+    except Exception as e:
+        logger.warning(f"Failed to publish singleflight message for {key}: {e}")
+
+def publish_result(key, task_id, result):
+    """Shares the leader's result with the duplicates waiting on this run and releases the lease."""
+    client = redis_setup.get_redis_client()
+    if not client:
+        return
+
+    try:
+        message = json.dumps({"leader_id": task_id, "status": "done", "result": result})
+        pipeline = client.pipeline()
+        # Short-lived copy for a duplicate that subscribes between the publish and its first read
+        pipeline.set(_result_key(key, task_id), message, ex=config.SINGLEFLIGHT_RESULT_TTL_SECONDS)
+        pipeline.publish(_channel(key), message)
+        pipeline.execute()
+    except Exception as e:
+        logger.warning(f"Failed to publish singleflight result for {key}: {e}")
+
+    release_lease(key, task_id)
+
+def publish_failure(key, task_id, error):
+    """Tells waiting duplicates the leader's attempt failed, so they stop waiting and run the work themselves."""
+    _publish(key, {"leader_id": task_id, "status": "failed", "error": str(error)})
+
+def wait_for_result(key, leader_id, timeout=None):
+    """
+    Waits for the given leader's result. Returns None as soon as the leader fails, releases
+    the lease without a result or loses it to another task, or when the timeout passes,
+    so the caller can do the work itself.
+    """
+    client = redis_setup.get_redis_client()
+    if not client:
+        return None
+
+    timeout = config.SINGLEFLIGHT_WAIT_SECONDS if timeout is None else timeout
+    deadline = time.monotonic() + timeout
+    pubsub = client.pubsub(ignore_subscribe_messages=True)
+
+    def read_result():
+        cached = client.get(_result_key(key, leader_id))
+        return json.loads(cached)["result"] if cached else None
+
+    try:
+        # Subscribe before reading the result key so a publish in between is not missed
+        pubsub.subscribe(_channel(key))
+        while time.monotonic() < deadline:
+            result = read_result()
+            if result:
+                metrics.increment_counter("singleflight.coalesced")
+                return result
+
+            message = pubsub.get_message(timeout=1.0)
+            if message and message.get("type") == "message":
+                payload = json.loads(message["data"])
+                if payload.get("leader_id") == leader_id:
+                    if payload.get("status") == "done":
+                        metrics.increment_counter("singleflight.coalesced")
+                        return payload.get("result")
+                    metrics.increment_counter("singleflight.leader_failed")
+                    logger.info(f"Singleflight leader {leader_id} for {key} failed: {payload.get('error')}")
+                    return None
+
+            if _lease_owner(client, key) != leader_id:
+                # The leader released the lease (or it expired) without a result reaching us: re-check once
+                return read_result()
+
+        logger.warning(f"Timed out after {timeout}s waiting for singleflight leader of {key}")
+        return None
+
+    except Exception as e:
+        logger.warning(f"Error while waiting for singleflight result {key}: {e}")
+        return None
+
+    finally:
+        try:
+            pubsub.close()
+        except Exception:
+            pass
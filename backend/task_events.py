@@ -0,0 +1,117 @@
+import json
+import asyncio
+import config
+import redis.asyncio as redis_async
+from enum import Enum
+
+from backend import redis_setup
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+class TaskEvent(Enum):
+    STAGE = 'stage'
+    SUCCESS = 'success'
+    FAILURE = 'failure'
+
+TERMINAL_EVENTS = {TaskEvent.SUCCESS.value, TaskEvent.FAILURE.value}
+
+# Publisher side (Celery workers)
+def publish_task_event(task_id, event, **payload):
+    """Publishes a task event on the shared channel. Never raises, since it runs inside Celery signals."""
+    if not task_id:
+        return False
+
+    client = redis_setup.get_redis_client()
+    if not client:
+        logger.warning(f"Redis client not available. Cannot publish '{event}' event for task {task_id}")
+        return False
+
+    event_value = event.value if isinstance(event, Enum) else str(event)
+    message = {"task_id": task_id, "event": event_value, **payload}
+
+    try:
+        client.publish(config.TASK_EVENTS_CHANNEL, json.dumps(message))
+        logger.debug(f"Published '{event_value}' event for task {task_id}")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to publish '{event_value}' event for task {task_id}: {e}", exc_info=True)
+        return False
+
+# Subscriber side (frontend process)
+class TaskEventListener:
+    """
+    Holds one Redis pub/sub subscription per process and fans events out to
+    every coroutine waiting on the same task ID.
+    """
+
+    def __init__(self, channel=None):
+        self.channel = channel or config.TASK_EVENTS_CHANNEL
+        self._subscribers = {}
+        self._listener_task = None
+
+    async def start(self):
+        if self._listener_task and not self._listener_task.done():
+            return
+
+        self._listener_task = asyncio.create_task(self._listen())
+        logger.info(f"Task event listener started on channel '{self.channel}'")
+
+    def subscribe(self, task_id):
+        queue = asyncio.Queue()
+        self._subscribers.setdefault(task_id, set()).add(queue)
+        return queue
+
+    def unsubscribe(self, task_id, queue):
+        queues = self._subscribers.get(task_id)
+        if not queues:
+            return
+
+        queues.discard(queue)
+        if not queues:
+            del self._subscribers[task_id]
+
+    def _dispatch(self, raw_message):
+        try:
+            event = json.loads(raw_message)
+        except (TypeError, ValueError) as e:
+            logger.warning(f"Ignoring malformed task event: {e}")
+            return
+
+        for queue in list(self._subscribers.get(event.get("task_id"), ())):
+            queue.put_nowait(event)
+
+    async def _listen(self):
+        while True:
+            client = None
+            try:
+                client = redis_async.Redis(host=config.REDIS_HOST, port=config.REDIS_PORT, db=config.REDIS_DB)
+                pubsub = client.pubsub(ignore_subscribe_messages=True)
+                await pubsub.subscribe(self.channel)
+
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._dispatch(message["data"])
+
+            except asyncio.CancelledError:
+                raise
+
+            except Exception as e:
+                logger.error(f"Task event listener lost its subscription: {e}. Reconnecting.", exc_info=True)
+                await asyncio.sleep(1)
+
+            finally:
+                if client:
+                    try:
+                        await client.aclose()
+                    except Exception:
+                        pass
+
+task_event_listener = None
+
+def get_task_event_listener():
+    global task_event_listener
+    if not task_event_listener:
+        task_event_listener = TaskEventListener()
+    return task_event_listener
@@ -1,3 +1,4 @@
+import re
 import psycopg2
 import config
 from pinecone import Pinecone, ServerlessSpec
@@ -178,6 +179,60 @@ def update_passages_status_in_DB(passage_ids, new_status):
         
         return False
     
+# Filterable metadata (source test, section, difficulty) derived once per source document,
+# from its title or, failing that, the opening of its first chunk, and shared by all its
+# chunks. Searching each chunk's own text would leave mid-passage chunks unlabelled and
+# give a chunk that runs into the next "Reading Passage N" heading that later section.
+SOURCE_TEST_PATTERN = re.compile(r"Practice Test\s+(\d+)", re.IGNORECASE)
+SECTION_PATTERN = re.compile(r"(?:Reading\s+)?(?:Passage|Section)\s+(\d)\b", re.IGNORECASE)
+CHUNK_TITLE_SUFFIX = re.compile(r"\s*\(Chunk (\d+)\)$")     # Appended by data_preprocessing when a document is split
+
+def document_title(title):
+    return CHUNK_TITLE_SUFFIX.sub("", str(title or ""))
+
+def is_first_chunk(title):
+    chunk_match = CHUNK_TITLE_SUFFIX.search(str(title or ""))
+    return not chunk_match or chunk_match.group(1) == "1"
+
+def fetch_first_chunk_texts(document_titles):
+    """Returns {document title: text of its first chunk} for documents whose first chunk is not in hand."""
+    if not document_titles:
+        return {}
+
+    first_chunk_titles = [f"{title} (Chunk 1)" for title in document_titles]
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("""
+                    SELECT title, text
+                    FROM passages
+                    WHERE title = ANY(%s)
+                    """, (first_chunk_titles,)
+                    )
+                return {document_title(title): text for title, text in cur.fetchall()}
+
+    except Exception as e:
+        logger.error(f"Failed to fetch first chunks for {len(document_titles)} documents; their chunks get no section metadata: {e}",
+                     exc_info=True)
+        return {}
+
+def extract_filter_metadata(title, first_chunk_text=None):
+    """Metadata for a source document, from its title or the opening of its first chunk."""
+    metadata = {}
+
+    source_match = SOURCE_TEST_PATTERN.search(str(title or ""))
+    if source_match:
+        metadata["source_test"] = int(source_match.group(1))
+
+    section_match = SECTION_PATTERN.search(str(title or "")) or SECTION_PATTERN.search(str(first_chunk_text or ""))
+    if section_match:
+        section = int(section_match.group(1))
+        metadata["section"] = section
+        if section in config.SECTION_DIFFICULTY:
+            metadata["difficulty"] = config.SECTION_DIFFICULTY[section]
+
+    return metadata
+
 # Vectorization preparation
 def prepare_vectors_for_Pinecone(passages):
     logger.debug(f"Preparing {len(passages)} passages for Pinecone upserting")
@@ -185,6 +240,14 @@ def prepare_vectors_for_Pinecone(passages):
     vectors_to_upsert = []
     skipped_ids = []
 
+    # One metadata dict per source document, shared by every chunk of it in the batch
+    first_chunk_texts = {document_title(p.get('title')): p.get('text') for p in passages if is_first_chunk(p.get('title'))}
+    missing_first_chunks = {document_title(p.get('title')) for p in passages} - set(first_chunk_texts)
+    first_chunk_texts.update(fetch_first_chunk_texts(
+        [doc for doc in missing_first_chunks if not SECTION_PATTERN.search(doc)]
+    ))
+    document_metadata = {}
+
     for passage in passages:
         passage_id = passage.get('passage_id')
         title = passage.get('title')
@@ -204,6 +267,10 @@ def prepare_vectors_for_Pinecone(passages):
             "title": str(title),
             "text": str(text) 
         }
+        doc_title = document_title(title)
+        if doc_title not in document_metadata:
+            document_metadata[doc_title] = extract_filter_metadata(doc_title, first_chunk_texts.get(doc_title))
+        metadata.update(document_metadata[doc_title])
 
         vectors_to_upsert.append({
             "id": vector_id,
@@ -0,0 +1,205 @@
+import json
+import math
+import random
+import config
+from collections import Counter
+
+from backend.db_pool_setup import db_connection
+from backend import context_packer
+from backend.reranker import tokenize
+
+import logging
+logger = logging.getLogger(config.APP_NAME)
+
+# The catalog is an offline artifact: numpy is only needed by the build job
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Fetching Stored Embeddings
+def fetch_stored_vectors(index, namespace=None):
+    """Pages through every vector ID in the namespace and fetches values and metadata."""
+    namespace = namespace or config.PINECONE_NAMESPACE
+    vectors = []
+
+    for id_page in index.list(namespace=namespace):
+        ids = list(id_page)
+        for start in range(0, len(ids), config.TOPIC_CATALOG_FETCH_BATCH_SIZE):
+            batch_ids = ids[start:start + config.TOPIC_CATALOG_FETCH_BATCH_SIZE]
+            response = index.fetch(ids=batch_ids, namespace=namespace)
+            for vector_id, vector in response.vectors.items():
+                metadata = vector.metadata or {}
+                if not metadata.get("text"):
+                    continue
+                vectors.append({
+                    "id": vector_id,
+                    "values": vector.values,
+                    "passage_id": metadata.get("passage_id"),
+                    "title": metadata.get("title"),
+                    "text": metadata["text"]
+                })
+
+    logger.info(f"Fetched {len(vectors)} stored chunk vectors from namespace '{namespace}'.")
+    return vectors
+
+# Clustering
+def spherical_kmeans(matrix, k, iterations=None, seed=0):
+    """k-means on unit vectors (cosine similarity) with k-means++ seeding. Returns (labels, centroids)."""
+    iterations = config.TOPIC_CATALOG_KMEANS_ITERATIONS if iterations is None else iterations
+    rng = np.random.default_rng(seed)
+    points = matrix / np.linalg.norm(matrix, axis=1, keepdims=True).clip(min=1e-12)
+
+    centroids = [points[rng.integers(len(points))]]
+    for _ in range(1, k):
+        distances = 1 - np.max(points @ np.array(centroids).T, axis=1)
+        distances = distances.clip(min=0)
+        total = distances.sum()
+        probabilities = distances / total if total > 0 else None
+        centroids.append(points[rng.choice(len(points), p=probabilities)])
+    centroids = np.array(centroids)
+
+    labels = np.full(len(points), -1)
+    for _ in range(iterations):
+        new_labels = np.argmax(points @ centroids.T, axis=1)
+        if np.array_equal(new_labels, labels):
+            break
+        labels = new_labels
+        for cluster in range(k):
+            members = points[labels == cluster]
+            if len(members):
+                centroid = members.sum(axis=0)
+                centroids[cluster] = centroid / max(np.linalg.norm(centroid), 1e-12)
+
+    return labels, centroids
+
+def label_clusters(cluster_texts, term_count=None):
+    """Labels each cluster with its most distinctive terms (class-based TF-IDF against the other clusters)."""
+    term_count = config.TOPIC_CATALOG_LABEL_TERMS if term_count is None else term_count
+    cluster_terms = {cluster: Counter(t for text in texts for t in tokenize(text) if len(t) > 3 and not t.isdigit())
+                     for cluster, texts in cluster_texts.items()}
+    document_frequency = Counter(term for terms in cluster_terms.values() for term in terms)
+    cluster_count = len(cluster_terms)
+
+    labels = {}
+    for cluster, terms in cluster_terms.items():
+        total = sum(terms.values()) or 1
+        weighted = {
+            term: (count / total) * math.log(1 + cluster_count / document_frequency[term])
+            for term, count in terms.items()
+        }
+        keywords = sorted(weighted, key=weighted.get, reverse=True)[:term_count]
+        labels[cluster] = keywords
+    return labels
+
+def build_context_bundle(members, similarities):
+    """Packs the chunks nearest the cluster centroid, scored by their similarity to it."""
+    nearest = sorted(zip(members, similarities), key=lambda pair: pair[1], reverse=True)
+    results = [{**chunk, "score": float(similarity)} for chunk, similarity in nearest[:config.TOPIC_CATALOG_CONTEXT_CHUNKS]]
+    return context_packer.pack_context(results)
+
+def cluster_topics(vectors, k=None):
+    """Clusters chunk vectors into topics with a label, keywords and a precomputed context bundle each."""
+    k = min(config.TOPIC_CATALOG_CLUSTERS if k is None else k, len(vectors))
+    points = np.array([v["values"] for v in vectors], dtype=float)
+    points = points / np.linalg.norm(points, axis=1, keepdims=True).clip(min=1e-12)
+    labels, centroids = spherical_kmeans(points, k)
+
+    cluster_members = {}
+    for vector, cluster in zip(vectors, labels):
+        cluster_members.setdefault(int(cluster), []).append(vector)
+    cluster_members = {c: m for c, m in cluster_members.items() if len(m) >= config.TOPIC_CATALOG_MIN_CLUSTER_SIZE}
+
+    keywords_by_cluster = label_clusters({c: [m["text"] for m in members] for c, members in cluster_members.items()})
+
+    topics = []
+    for cluster, members in cluster_members.items():
+        member_indices = [i for i, c in enumerate(labels) if c == cluster]
+        similarities = points[member_indices] @ centroids[cluster]
+        keywords = keywords_by_cluster[cluster]
+        label = " ".join(keywords) or context_packer.parse_chunk_title(members[0].get("title"))[0]
+        if not label:
+            continue
+        topics.append({
+            "label": label,
+            "keywords": keywords,
+            "context": build_context_bundle(members, similarities),
+            "chunk_count": len(members)
+        })
+
+    logger.info(f"Clustered {len(vectors)} chunks into {len(topics)} catalog topics (k={k}).")
+    return topics
+
+# Catalog Storage (PostgreSQL)
+def save_catalog(topics):
+    """Replaces the catalog in one transaction so readers never see a partial build."""
+    with db_connection() as conn:
+        with conn.cursor() as cur:
+            cur.execute("""
+                CREATE TABLE IF NOT EXISTS topic_catalog (
+                    topic_id SERIAL PRIMARY KEY,
+                    label TEXT NOT NULL,
+                    keywords JSONB NOT NULL,
+                    context TEXT NOT NULL,
+                    chunk_count INTEGER NOT NULL,
+                    built_at TIMESTAMPTZ NOT NULL DEFAULT now()
+                )
+                """)
+            cur.execute("DELETE FROM topic_catalog")
+            for topic in topics:
+                cur.execute("""
+                    INSERT INTO topic_catalog (label, keywords, context, chunk_count)
+                    VALUES (%s, %s, %s, %s)
+                    """, (topic["label"], json.dumps(topic["keywords"]), topic["context"], topic["chunk_count"]))
+        conn.commit()
+
+def build_topic_catalog(index):
+    if np is None:
+        logger.error("numpy is required to build the topic catalog. Install it and re-run.")
+        return False
+
+    try:
+        vectors = fetch_stored_vectors(index)
+        if len(vectors) < config.TOPIC_CATALOG_MIN_CLUSTER_SIZE:
+            logger.error(f"Only {len(vectors)} stored chunks found; not enough to build a topic catalog.")
+            return False
+
+        topics = cluster_topics(vectors)
+        save_catalog(topics)
+        logger.info(f"Topic catalog rebuilt with {len(topics)} topics.")
+        return True
+
+    except Exception as e:
+        logger.error(f"Failed to build the topic catalog: {e}", exc_info=True)
+        return False
+
+def pick_random_topic():
+    """Returns a random catalog topic as {'topic_id', 'label', 'keywords'}, or None if the catalog is unavailable."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT topic_id, label, keywords FROM topic_catalog")
+                rows = cur.fetchall()
+
+    except Exception as e:
+        logger.warning(f"Topic catalog unavailable: {e}")
+        return None
+
+    if not rows:
+        return None
+
+    topic_id, label, keywords = random.choice(rows)
+    return {"topic_id": topic_id, "label": label, "keywords": keywords}
+
+def get_topic_context(topic_id):
+    """Returns the precomputed context bundle for a catalog topic, or None if it no longer exists."""
+    try:
+        with db_connection() as conn:
+            with conn.cursor() as cur:
+                cur.execute("SELECT context FROM topic_catalog WHERE topic_id = %s", (topic_id,))
+                row = cur.fetchone()
+        return row[0] if row else None
+
+    except Exception as e:
+        logger.warning(f"Failed to load context for catalog topic {topic_id}: {e}")
+        return None
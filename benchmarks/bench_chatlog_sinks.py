@@ -0,0 +1,83 @@
+"""
+Throughput benchmark for the chat log sinks.
+
+Builds gzipped chat log batches shaped like the flush tasks' objects and writes
+them one at a time (write) and in one bulk call (write_many), reporting entries/sec
+and bytes/sec. By default it uses a LocalSink in a temporary directory, so it needs
+no AWS credentials or network. Pass --endpoint-url and --bucket to run the same
+workload against an S3-compatible server such as a local MinIO.
+
+Usage:
+    python benchmarks/bench_chatlog_sinks.py --chats 2000 --entries 50
+    python benchmarks/bench_chatlog_sinks.py --endpoint-url http://localhost:9000 --bucket chatlogs-bench
+"""
+import os
+import sys
+import gzip
+import json
+import time
+import hashlib
+import argparse
+import tempfile
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from backend import chatlog_sinks
+
+def build_objects(chats, entries, run):
+    objects = []
+    for chat in range(chats):
+        log_entries = [
+            {"timestamp": f"2025-01-01T00:{n // 60 % 60:02d}:{n % 60:02d}.000000Z",
+             "user": "user" if n % 2 else "assistant",
+             "message": f"Message {n} of chat {chat}: what does paragraph C say about coral reef recovery?"}
+            for n in range(entries)
+        ]
+        body = gzip.compress(json.dumps(log_entries).encode('utf-8'), mtime=0)
+        key = f"chatlogs/2025-01-01/bench-{run}-{chat}/batch_{hashlib.sha256(body).hexdigest()[:16]}.json.gz"
+        objects.append((key, body))
+    return objects
+
+def report(label, elapsed, entry_count, byte_count):
+    print(f"{label:>10} {elapsed:>9.3f} {entry_count / elapsed:>12.0f} {byte_count / elapsed / 1e6:>10.2f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Chat log sink throughput")
+    parser.add_argument("--chats", type=int, default=2000, help="Objects written per mode, one per chat")
+    parser.add_argument("--entries", type=int, default=50, help="Log entries per object")
+    parser.add_argument("--endpoint-url", help="S3-compatible endpoint; omit to use a local directory")
+    parser.add_argument("--bucket", help="Bucket for --endpoint-url")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as root:
+        sink = chatlog_sinks.S3Sink(args.bucket, endpoint_url=args.endpoint_url) if args.endpoint_url \
+            else chatlog_sinks.LocalSink(root)
+        print(f"sink: {type(sink).__name__}, {args.chats} objects x {args.entries} entries per mode")
+        print(f"{'mode':>10} {'seconds':>9} {'entries/s':>12} {'MB/s':>10}")
+
+        written_keys = []
+        for mode in ("write", "write_many"):
+            objects = build_objects(args.chats, args.entries, mode)
+            byte_count = sum(len(body) for _, body in objects)
+
+            started = time.perf_counter()
+            if mode == "write":
+                for key, body in objects:
+                    sink.write(key, body, content_encoding='gzip')
+            else:
+                errors = sink.write_many(objects, content_encoding='gzip')
+                if errors:
+                    print(f"  warning: {len(errors)} bulk writes failed")
+            report(mode, time.perf_counter() - started, args.chats * args.entries, byte_count)
+            written_keys.extend(key for key, _ in objects)
+
+        expected_keys = set(written_keys)
+        started = time.perf_counter()
+        listed = sum(1 for key in sink.list_keys("chatlogs/2025-01-01/bench-") if key in expected_keys)
+        print(f"listed {listed} objects in {time.perf_counter() - started:.3f}s")
+        sink.delete(written_keys)
+
+if __name__ == "__main__":
+    main()
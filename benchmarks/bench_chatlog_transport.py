@@ -0,0 +1,104 @@
+"""
+Benchmark for the chat log transports against a live Redis.
+
+Simulates many concurrent sessions writing interleaved messages, then drains
+everything the way the flush jobs do, with the S3 upload replaced by a no-op:
+
+  list    per-chat buffers; drained one chat at a time (dirty-set claim, pending
+          marker, atomic rename, staging delete), as the flush tasks would
+  stream  sharded Redis Streams; drained by consume_stream_batches, which reads
+          batches spanning many chats and acknowledges them in bulk
+
+Keys are namespaced under "bench:" and removed afterwards, but run it against a
+non-production Redis database all the same.
+
+Usage:
+    python benchmarks/bench_chatlog_transport.py --sessions 1000 5000 --messages 10
+"""
+import os
+import sys
+import time
+import argparse
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import config
+from backend import chatlog_storage
+from backend import metrics
+
+def use_bench_keys():
+    config.LOG_DIRTY_SET_KEY = "bench:chatlogs_dirty"
+    config.LOG_FLUSH_MARKER_KEY_PREFIX = "bench:chatlogs_flush_pending:"
+    config.LOG_STAGING_SET_KEY = "bench:chatlogs_staging_index"
+    config.CHATLOG_STREAM_KEY_PREFIX = "bench:chatlogs_stream:"
+    chatlog_storage.redis_log_prefix = "bench:chatlogs_list:"
+    chatlog_storage.redis_staging_prefix = "bench:chatlogs_staging:"
+    # Producers never reach the threshold, so no Celery task is enqueued while producing
+    chatlog_storage.log_buffer_threshold = sys.maxsize
+
+def clear_bench_keys():
+    client = chatlog_storage.redis_client
+    for key in client.scan_iter(match="bench:*", count=1000):
+        client.delete(key)
+    chatlog_storage.stream_groups_ready = False
+
+def produce(sessions, messages):
+    samples = []
+    for n in range(messages):
+        for session in range(sessions):
+            started = time.perf_counter()
+            chatlog_storage.buffer_chat_log(f"session-{session}", "user", f"message {n} from session {session}")
+            samples.append(time.perf_counter() - started)
+    samples.sort()
+    return samples
+
+def drain_lists():
+    client = chatlog_storage.redis_client
+    drained = 0
+    while True:
+        due = [c.decode('utf-8') for c in chatlog_storage.pop_due_chats(time.time() + config.LOG_FLUSH_MAX_AGE_SECONDS,
+                                                                        config.LOG_FLUSH_POP_BATCH_SIZE)]
+        for chat_id in due:
+            client.set(chatlog_storage.flush_marker_key(chat_id), b"1", nx=True, ex=60)
+            staging_key = f"{chatlog_storage.redis_staging_prefix}{chat_id}:bench"
+            drained += len(chatlog_storage.drain_chat_log_buffer(chat_id, staging_key))
+            chatlog_storage.clear_flush_marker(chat_id)
+            chatlog_storage.delete_staged_batch(staging_key)
+        if len(due) < config.LOG_FLUSH_POP_BATCH_SIZE:
+            return drained
+
+def drain_stream():
+    drained, _, _ = chatlog_storage.consume_stream_batches("bench-consumer", write_batches=lambda batches: set(),
+                                                           max_batches=sys.maxsize)
+    return drained
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-chat list vs Redis Streams chat log transport")
+    parser.add_argument("--sessions", type=int, nargs="*", default=[100, 1000, 5000], help="Concurrent chat sessions")
+    parser.add_argument("--messages", type=int, default=10, help="Messages per session")
+    args = parser.parse_args()
+
+    if not chatlog_storage.redis_client:
+        sys.exit("Redis is not reachable with the configured REDIS_HOST/REDIS_PORT/REDIS_DB.")
+
+    use_bench_keys()
+    print(f"{'sessions':>8} {'transport':>9} {'append p50 us':>14} {'append p95 us':>14} {'drain s':>9} {'drained/s':>11}")
+    for sessions in args.sessions:
+        for transport, drain in (("list", drain_lists), ("stream", drain_stream)):
+            config.CHATLOG_TRANSPORT = transport
+            clear_bench_keys()
+            samples = produce(sessions, args.messages)
+
+            started = time.perf_counter()
+            drained = drain()
+            elapsed = time.perf_counter() - started
+            print(f"{sessions:>8} {transport:>9} {metrics.percentile(samples, 50) * 1e6:>14.1f} "
+                  f"{metrics.percentile(samples, 95) * 1e6:>14.1f} {elapsed:>9.3f} {drained / elapsed if elapsed else 0:>11.0f}")
+            if drained != sessions * args.messages:
+                print(f"  warning: drained {drained} of {sessions * args.messages} entries")
+    clear_bench_keys()
+
+if __name__ == "__main__":
+    main()
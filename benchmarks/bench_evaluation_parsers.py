@@ -0,0 +1,87 @@
+"""
+Micro-benchmark for the evaluation output parsers.
+
+Builds synthetic evaluator outputs of increasing size in both layouts and times
+parse_evaluation_string (labelled prose, regex) against parse_structured_evaluation
+(JSON, single pass). With --drift, a share of the prose questions get the small
+formatting slips seen in real outputs, and the number of rows each parser recovers
+is reported alongside the timings.
+
+Usage:
+    python benchmarks/bench_evaluation_parsers.py --sizes 10 40 200 --repeat 200
+    python benchmarks/bench_evaluation_parsers.py --drift 0.2
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+from backend import evaluation_service
+from backend import metrics
+
+# Slips that the regex parser does not tolerate: bold headers, a missing dash, CRLF line ends
+DRIFTS = [
+    lambda block: block.replace("Question ", "**Question ", 1).replace(":\n", ":**\n", 1),
+    lambda block: block.replace("- Evaluation:", "Evaluation:"),
+    lambda block: block.replace("\n", "\r\n"),
+]
+
+def build_rows(size, rng):
+    return [
+        {
+            "number": n,
+            "your_answer": rng.choice(["TRUE", "B", "iv", "coral reefs"]),
+            "evaluation": rng.choice(["Correct", "Incorrect"]),
+            "correct_answer": rng.choice(["FALSE", "C", "ii", "coral reefs"]),
+            "explanation": "The second paragraph states the opposite of the claim." if n % 2 else "N/A"
+        }
+        for n in range(1, size + 1)
+    ]
+
+def render_text(rows, drift, rng):
+    blocks = []
+    for row in rows:
+        block = (f"Question {row['number']}:\n- Your answer: {row['your_answer']}\n- Evaluation: {row['evaluation']}\n"
+                 f"- Correct answer: {row['correct_answer']}\n- Explanation: {row['explanation']}\n")
+        if rng.random() < drift:
+            block = rng.choice(DRIFTS)(block)
+        blocks.append(block)
+    return "===DETAILED EVALUATION===\n" + "\n".join(blocks) + "\n===FINAL GRADE===\n"
+
+def time_parser(parse, raw_output, repeat):
+    samples = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        parsed = parse(raw_output)
+        samples.append(time.perf_counter() - started)
+    samples.sort()
+    return samples, len(parsed or [])
+
+def main():
+    parser = argparse.ArgumentParser(description="Regex vs structured evaluation parser")
+    parser.add_argument("--sizes", type=int, nargs="*", default=[10, 40, 200, 1000], help="Questions per output")
+    parser.add_argument("--repeat", type=int, default=200)
+    parser.add_argument("--drift", type=float, default=0.0, help="Share of prose questions with a formatting slip")
+    args = parser.parse_args()
+
+    rng = random.Random(42)
+    print(f"{'size':>6} {'parser':>10} {'p50 us':>10} {'p95 us':>10} {'rows':>8}")
+    for size in args.sizes:
+        rows = build_rows(size, rng)
+        outputs = {
+            "regex": (evaluation_service.parse_evaluation_string, render_text(rows, args.drift, rng)),
+            "structured": (evaluation_service.parse_structured_evaluation, json.dumps({"results": rows})),
+        }
+        for name, (parse, raw_output) in outputs.items():
+            samples, recovered = time_parser(parse, raw_output, args.repeat)
+            print(f"{size:>6} {name:>10} {metrics.percentile(samples, 50) * 1e6:>10.1f} "
+                  f"{metrics.percentile(samples, 95) * 1e6:>10.1f} {recovered:>4}/{size:<4}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,112 @@
+"""
+A/B benchmark for the query generation modes.
+
+Runs the same topics through the two-call path (passage, then questions) and the
+combined single-call path, and reports latency, prompt/completion tokens and
+failure rate for each. Combined runs that fail validation fall back to the
+two-call path exactly as process_query_task does, so their latency includes it.
+
+Usage:
+    python benchmarks/bench_generation_modes.py --llm "GPT 4.1" --runs 3
+"""
+import os
+import sys
+import time
+import argparse
+from types import SimpleNamespace
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import config
+from backend import query_service
+from backend import metrics
+
+DEFAULT_TOPICS = ["history of artificial intelligence", "marine biology", "climate change effects"]
+
+class UsageRecordingClient:
+    """Wraps an OpenAI-compatible client and records token usage of every chat completion."""
+
+    def __init__(self, client):
+        self._client = client
+        self.calls = []
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, **kwargs):
+        response = self._client.chat.completions.create(**kwargs)
+        usage = getattr(response, "usage", None)
+        self.calls.append({
+            "prompt_tokens": getattr(usage, "prompt_tokens", 0) or 0,
+            "completion_tokens": getattr(usage, "completion_tokens", 0) or 0,
+        })
+        return response
+
+def run_two_call(llm_choice, topic, client):
+    passage = query_service.generate_reading_passages(llm_choice, topic, "", client)
+    if not passage:
+        return False, False
+    questions = query_service.generate_questions(llm_choice, passage, client)
+    return bool(questions), False
+
+def run_combined(llm_choice, topic, client):
+    output = query_service.generate_passage_and_questions(llm_choice, topic, "", client)
+    if output:
+        return True, False
+    succeeded, _ = run_two_call(llm_choice, topic, client)
+    return succeeded, True
+
+MODES = {"two_call": run_two_call, "combined": run_combined}
+
+def summarize(samples):
+    latencies = sorted(s["latency"] for s in samples)
+    count = len(samples)
+    return {
+        "runs": count,
+        "p50_s": metrics.percentile(latencies, 50),
+        "p95_s": metrics.percentile(latencies, 95),
+        "avg_prompt_tokens": sum(s["prompt_tokens"] for s in samples) / count,
+        "avg_completion_tokens": sum(s["completion_tokens"] for s in samples) / count,
+        "failure_rate": sum(not s["succeeded"] for s in samples) / count,
+        "fallback_rate": sum(s["fell_back"] for s in samples) / count,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="A/B benchmark of two-call vs combined generation")
+    parser.add_argument("--llm", default=config.OPENAI_MODEL_CHOICE, help="Model choice as shown in the UI")
+    parser.add_argument("--runs", type=int, default=3, help="Runs per topic and mode")
+    parser.add_argument("--topics", nargs="*", default=DEFAULT_TOPICS)
+    args = parser.parse_args()
+
+    base_client = query_service.initialize_selected_llm(args.llm)
+    if not base_client:
+        sys.exit(f"Could not initialize LLM client for '{args.llm}'")
+
+    samples = {mode: [] for mode in MODES}
+    for _ in range(args.runs):
+        for topic in args.topics:
+            # Alternate mode order so neither mode always runs on a warm connection
+            for mode, runner in (MODES.items() if len(samples["two_call"]) % 2 == 0 else reversed(list(MODES.items()))):
+                client = UsageRecordingClient(base_client)
+                started = time.perf_counter()
+                try:
+                    succeeded, fell_back = runner(args.llm, topic, client)
+                except Exception as e:
+                    print(f"[{mode}] '{topic}' raised: {e}")
+                    succeeded, fell_back = False, False
+                samples[mode].append({
+                    "latency": time.perf_counter() - started,
+                    "prompt_tokens": sum(c["prompt_tokens"] for c in client.calls),
+                    "completion_tokens": sum(c["completion_tokens"] for c in client.calls),
+                    "succeeded": succeeded,
+                    "fell_back": fell_back,
+                })
+
+    print(f"{'mode':<10} {'runs':>5} {'p50_s':>8} {'p95_s':>8} {'prompt_tok':>11} {'compl_tok':>10} {'fail':>6} {'fallback':>9}")
+    for mode, mode_samples in samples.items():
+        s = summarize(mode_samples)
+        print(f"{mode:<10} {s['runs']:>5} {s['p50_s']:>8.2f} {s['p95_s']:>8.2f} {s['avg_prompt_tokens']:>11.0f} "
+              f"{s['avg_completion_tokens']:>10.0f} {s['failure_rate']:>6.1%} {s['fallback_rate']:>9.1%}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""
+Benchmark for the rerank stage: rerank latency against the prompt tokens it saves.
+
+For every query a candidate pool of RERANK_CANDIDATES chunks is built, then:
+  - baseline: the first 3 candidates in retrieval order are packed (the old top_k=3 path)
+  - reranked: the pool is reranked and the best RERANK_TOP_N are packed
+Candidates come from live retrieval with --live, otherwise from chunking the PDFs in
+data/ locally (first-stage order is then a shuffle, so only latency/tokens are meaningful).
+
+Usage:
+    python benchmarks/bench_reranker.py --scorer lexical --repeat 20
+    python benchmarks/bench_reranker.py --live
+"""
+import os
+import sys
+import glob
+import time
+import random
+import argparse
+
+project_root = os.path.abspath(os.path.join(os.path.dirname(__file__), '..'))
+if project_root not in sys.path:
+    sys.path.insert(0, project_root)
+
+import config
+from backend import reranker
+from backend import context_packer
+from backend import metrics
+
+DEFAULT_QUERIES = ["history of artificial intelligence", "marine biology", "climate change effects",
+                   "urban transport", "ancient civilisations"]
+
+def load_local_chunks(data_dir):
+    import pymupdf
+    chunks = []
+    step = config.CHUNK_SIZE_CHARS - config.CHUNK_OVERLAP_CHARS
+    for path in sorted(glob.glob(os.path.join(data_dir, "*.pdf"))):
+        with pymupdf.open(path) as pdf_document:
+            lines = [l.strip() for l in " ".join(p.get_text() for p in pdf_document).splitlines() if l.strip()]
+        if len(lines) < 2:
+            continue
+        title, text = lines[0], " ".join(lines[1:])
+        for n, start in enumerate(range(0, len(text), step), start=1):
+            chunks.append({"text": text[start:start + config.CHUNK_SIZE_CHARS], "title": f"{title} (Chunk {n})", "score": 0.0})
+    return chunks
+
+def local_candidates(chunks, pool_size, rng):
+    pool = rng.sample(chunks, min(pool_size, len(chunks)))
+    return [{**c, "score": 1.0 - i / len(pool)} for i, c in enumerate(pool)]
+
+def live_candidates(query, pool_size):
+    from backend import context_layer, query_service
+    pc, index = query_service.initialize_pinecone()
+    return context_layer.retrieve_candidates(query, pc, index, top_k=pool_size)
+
+def main():
+    parser = argparse.ArgumentParser(description="Rerank latency vs prompt tokens saved")
+    parser.add_argument("--scorer", default=config.RERANK_SCORER, choices=["lexical", "cross_encoder"])
+    parser.add_argument("--repeat", type=int, default=10, help="Candidate pools per query (local mode)")
+    parser.add_argument("--live", action="store_true", help="Use live retrieval for candidates")
+    parser.add_argument("--data-dir", default=os.path.join(project_root, "data"))
+    parser.add_argument("--queries", nargs="*", default=DEFAULT_QUERIES)
+    args = parser.parse_args()
+
+    scorer = reranker.get_scorer(args.scorer)
+    rng = random.Random(42)
+    chunks = None if args.live else load_local_chunks(args.data_dir)
+
+    latencies, baseline_tokens, reranked_tokens = [], [], []
+    for query in args.queries:
+        for _ in range(1 if args.live else args.repeat):
+            pool = live_candidates(query, config.RERANK_CANDIDATES) if args.live else local_candidates(chunks, config.RERANK_CANDIDATES, rng)
+            if not pool:
+                continue
+
+            baseline_tokens.append(context_packer.estimate_tokens(context_packer.pack_context(pool[:3])))
+
+            started = time.perf_counter()
+            top = reranker.rerank(query, pool, scorer=scorer)
+            latencies.append(time.perf_counter() - started)
+            reranked_tokens.append(context_packer.estimate_tokens(context_packer.pack_context(top)))
+
+    if not latencies:
+        sys.exit("No candidates available to benchmark.")
+
+    latencies.sort()
+    avg_baseline = sum(baseline_tokens) / len(baseline_tokens)
+    avg_reranked = sum(reranked_tokens) / len(reranked_tokens)
+    print(f"scorer={scorer.name} pools={len(latencies)} candidates={config.RERANK_CANDIDATES} top_n={config.RERANK_TOP_N}")
+    print(f"rerank latency   p50={metrics.percentile(latencies, 50) * 1000:.2f}ms  p95={metrics.percentile(latencies, 95) * 1000:.2f}ms")
+    print(f"prompt tokens    baseline={avg_baseline:.0f}  reranked={avg_reranked:.0f}  saved={avg_baseline - avg_reranked:.0f} "
+          f"({(avg_baseline - avg_reranked) / avg_baseline:.1%})")
+
+if __name__ == "__main__":
+    main()
@@ -1,6 +1,8 @@
 import config
 from celery import Celery, signals
 from backend import db_pool_setup
+from backend import reranker
+from backend import task_events
 
 if not config.CELERY_BROKER_URL:
     raise ValueError("An error has occured. CELERY_BROKER_URL not found in config")
@@ -13,7 +15,9 @@ celery_app = Celery(
                'backend.text_embedding',
                'backend.query_service',
                'backend.evaluation_service',
-               'backend.chatlog_storage']
+               'backend.batch_evaluation',
+               'backend.chatlog_storage',
+               'backend.chatlog_compaction']
 )
 
 celery_app.conf.update(
@@ -29,8 +33,11 @@ celery_app.conf.update(
         'backend.text_embedding.upsert_vectors_task': {'queue': 'embedding'},   
         'backend.query_service.process_query_task': {'queue': 'query'},
         'backend.evaluation_service.evaluate_answers_task': {'queue': 'evaluation'},
+        'backend.batch_evaluation.evaluate_batch_task': {'queue': 'evaluation'},
         'backend.chatlog_storage.store_batch_chat_logs_task': {'queue': 'logging'},
-        'backend.chatlog_storage.flush_all_chat_logs': {'queue': 'periodic_tasks'} 
+        'backend.chatlog_storage.consume_chat_log_stream_task': {'queue': 'logging'},
+        'backend.chatlog_storage.flush_all_chat_logs': {'queue': 'periodic_tasks'},
+        'backend.chatlog_compaction.compact_chat_logs_task': {'queue': 'logging'} 
     },
 
     task_acks_late = True,
@@ -51,6 +58,9 @@ def initialize_worker_process(**kwargs):
     except Exception as e:
         logger.error(f"Error initializing database pool in worker: {e}", exc_info=True)
 
+    # Loaded here rather than on the first query, where it would blow the rerank latency budget
+    reranker.warm_up()
+
 @signals.worker_process_shutdown.connect 
 def shutdown_worker_process(**kwargs):
     logger.info("Shutting down Celery worker process")
@@ -60,4 +70,18 @@ def shutdown_worker_process(**kwargs):
         logger.info("Database pool closed for worker process.")
     except Exception as e:
 
-        logger.error(f"Error closing database pool in worker: {e}", exc_info=True)
\ No newline at end of file
+        logger.error(f"Error closing database pool in worker: {e}", exc_info=True)
+
+# Beat and logging tasks run every few seconds and nobody waits on them, so they publish nothing
+@signals.task_success.connect
+def publish_task_success(sender=None, **kwargs):
+    if sender.name not in config.TASK_EVENTS_TASK_NAMES:
+        return
+    # The result is already stored in the backend when this signal fires
+    task_events.publish_task_event(sender.request.id, task_events.TaskEvent.SUCCESS)
+
+@signals.task_failure.connect
+def publish_task_failure(sender=None, task_id=None, exception=None, **kwargs):
+    if getattr(sender, "name", None) not in config.TASK_EVENTS_TASK_NAMES:
+        return
+    task_events.publish_task_event(task_id, task_events.TaskEvent.FAILURE, error=str(exception))
@@ -27,6 +27,53 @@ REDIS_HOST = os.getenv("REDIS_HOST")
 REDIS_PORT = os.getenv("REDIS_PORT")
 REDIS_DB = os.getenv("REDIS_DB")
 REDIS_LOG_LIST_KEY_PREFIX = "chatlogs_list:"
+REDIS_LOG_STAGING_KEY_PREFIX = "chatlogs_staging:"    # Buffers being flushed; kept apart so scans of the list prefix skip them
+
+# Task Completion Events
+TASK_EVENTS_CHANNEL = "task_events"
+TASK_EVENTS_TASK_NAMES = {                # Only tasks the frontend awaits publish completion events
+    "backend.query_service.process_query_task",
+    "backend.evaluation_service.evaluate_answers_task",
+    "backend.batch_evaluation.evaluate_batch_task",
+}
+TASK_RESULT_FALLBACK_POLL_SECONDS = 15    # Safety-net backend check in case a pub/sub message is missed
+
+# Metrics Sink
+METRICS_KEY_PREFIX = "metrics:timings:"
+METRICS_COUNTERS_KEY = "metrics:counters"
+METRICS_SAMPLE_WINDOW = 1000              # Recent samples kept per metric for percentile reads
+
+# Query Pipeline Checkpoints & Retries
+PIPELINE_CHECKPOINT_KEY_PREFIX = "query_checkpoint:"
+PIPELINE_CHECKPOINT_TTL_SECONDS = 3600
+TASK_RETRY_BACKOFF_BASE_SECONDS = 1
+TASK_RETRY_BACKOFF_MAX_SECONDS = 8
+
+# Query Coalescing (single-flight)
+SINGLEFLIGHT_KEY_PREFIX = "singleflight:"
+SINGLEFLIGHT_LEASE_SECONDS = 300           # Upper bound on one pipeline run; a crashed leader's lease expires
+SINGLEFLIGHT_RESULT_TTL_SECONDS = 10       # Only covers duplicates of that run subscribing just as it finishes
+SINGLEFLIGHT_WAIT_SECONDS = 45           # Worker-side wait, about the pipeline's p95; most duplicates are joined at dispatch instead
+
+# Evaluation Cache (per-item LLM grades)
+EVALUATION_CACHE_KEY_PREFIX = "evalcache:"
+EVALUATION_CACHE_TTL_SECONDS = 7 * 24 * 3600
+
+# Classroom Batch Evaluation (submissions for one passage graded together)
+BATCH_EVALUATION_ENABLED = os.getenv("BATCH_EVALUATION_ENABLED", "false").lower() == "true"
+BATCH_EVALUATION_KEY_PREFIX = "batcheval:"
+BATCH_EVALUATION_WINDOW_SECONDS = 10      # Submissions arriving within this window share one LLM call
+BATCH_EVALUATION_KEY_TTL_SECONDS = 600
+BATCH_EVALUATION_MAX_ANSWERS_PER_CALL = 60  # Distinct answers per grading prompt, so the JSON reply stays within the output limit
+BATCH_EVALUATION_MAX_CONCURRENT_CALLS = 4
+
+# Learner Analytics (incremental per-learner / daily / cohort counters in PostgreSQL)
+ANALYTICS_ENABLED = os.getenv("ANALYTICS_ENABLED", "true").lower() == "true"
+ANALYTICS_MIN_ATTEMPTS = 5                # Fewer attempts than this are too noisy to call a type "struggling"
+ANALYTICS_STRUGGLING_TYPES_LIMIT = 2
+ANALYTICS_EVENT_RETENTION_DAYS = 3        # Recorded event IDs only need to outlive the task retry window
+ANALYTICS_EVENT_PRUNE_INTERVAL_SECONDS = 3600
+ANALYTICS_SETUP_RETRY_SECONDS = 60        # After a failed table setup, analytics are skipped this long before trying again
 
 # PostgreSQL Configuration
 POSTGRES_DB_MIN_CONN = os.getenv("POSTGRES_DB_MIN_CONN")
@@ -40,6 +87,28 @@ POSTGRES_PORT = os.getenv("POSTGRES_PORT")
 # AWS S3 Configuration
 AWS_BUCKET_NAME = os.getenv("AWS_BUCKET_NAME")
 
+# Chat Log Sink
+CHATLOG_SINK = os.getenv("CHATLOG_SINK", "s3").lower()      # 's3' (AWS or an S3-compatible endpoint) or 'local'
+CHATLOG_S3_ENDPOINT_URL = os.getenv("CHATLOG_S3_ENDPOINT_URL")     # e.g. http://localhost:9000 for MinIO; unset for AWS
+CHATLOG_SINK_LOCAL_DIR = os.getenv("CHATLOG_SINK_LOCAL_DIR", os.path.join(os.path.dirname(__file__), 'chatlog_archive'))
+CHATLOG_SINK_MULTIPART_THRESHOLD_BYTES = 8 * 1024 * 1024    # Larger bodies are uploaded in parts
+CHATLOG_SINK_MAX_WORKERS = 8                                # Concurrent uploads for bulk writes and multipart parts
+
+# Chat Log Compaction
+CHATLOG_ARCHIVE_PREFIX = "chatlogs_archive/"                # Compacted parts land under <prefix>date=YYYY-MM-DD/
+CHATLOG_COMPACTION_FORMAT = os.getenv("CHATLOG_COMPACTION_FORMAT", "parquet").lower()     # 'parquet' or 'ndjson' (zstd)
+CHATLOG_COMPACTION_ROWS_PER_PART = 100000
+CHATLOG_COMPACTION_PART_MAX_BYTES = 64 * 1024 * 1024       # Raw text held for one part before it is written; bounds memory
+CHATLOG_COMPACTION_FETCH_BATCH_SIZE = 500                   # Source objects read concurrently per round
+CHATLOG_COMPACTION_ZSTD_LEVEL = 10
+CHATLOG_COMPACTION_DELETE_SOURCES = True                    # Remove the small batches once the manifest lists them
+CHATLOG_COMPACTION_LAG_DAYS = 1                             # Compact the UTC day this many days back, after late flushes land
+CHATLOG_COMPACTION_MAX_DAYS_PER_RUN = 7                     # Older days that still hold batches are caught up, oldest first
+CHATLOG_COMPACTION_LOCK_KEY_PREFIX = "chatlog_compaction_lock:"
+CHATLOG_COMPACTION_LOCK_SECONDS = 900                       # Refreshed after every part, so only a stalled run loses it
+CHATLOG_COMPACTION_CRON_HOUR = 3                            # Daily run, in the Celery timezone
+CHATLOG_COMPACTION_CRON_MINUTE = 30
+
 # Pinecone Configuration
 PINECONE_API_KEY = os.getenv("PINECONE_API_KEY")
 PINECONE_INDEX_NAME = "ielts-rag"
@@ -49,11 +118,44 @@ PINECONE_INDEX_METRIC = "cosine"
 PINECONE_INDEX_CLOUD = "aws"
 PINECONE_INDEX_REGION = "us-east-1"
 PINECONE_INDEX_MODEL = "multilingual-e5-large"
+PINECONE_INDEX_HOST = os.getenv("PINECONE_INDEX_HOST")    # Optional; otherwise resolved once per worker with describe_index
+SECTION_DIFFICULTY = {1: "easy", 2: "medium", 3: "hard"}   # IELTS reading passages get harder by section
 
 PINECONE_UPSERT_BATCH_SIZE = 100
 TASK_FETCH_BATCH_SIZE = 1000
 TASK_PROCESS_BATCH_SIZE = 100
 
+# Chunking Configuration
+CHUNK_SIZE_CHARS = 1000
+CHUNK_OVERLAP_CHARS = 100
+
+# Retrieval Configuration
+HYBRID_RETRIEVAL_ENABLED = os.getenv("HYBRID_RETRIEVAL_ENABLED", "false").lower() == "true"    # Needs `main.py setup_lexical_index` first
+HYBRID_CANDIDATE_MULTIPLIER = 3          # Each retriever returns top_k * this before fusion
+RRF_K = 60                               # Reciprocal-rank fusion constant
+LEXICAL_MIN_RANK = 0.01                  # ts_rank_cd floor for lexical hits
+VECTOR_SEARCH_TIMEOUT_SECONDS = 3
+ASYNC_RETRIEVAL_ENABLED = os.getenv("ASYNC_RETRIEVAL_ENABLED", "false").lower() == "true"
+RETRIEVAL_MAX_WORKERS = 8
+CONTEXT_TOKEN_BUDGET = 1200              # Max tokens of retrieved context sent into the passage prompt
+
+# Reranking (local CPU stage between retrieval and context packing)
+RERANK_ENABLED = os.getenv("RERANK_ENABLED", "false").lower() == "true"
+RERANK_SCORER = os.getenv("RERANK_SCORER", "lexical")       # 'lexical' or 'cross_encoder'
+RERANK_CROSS_ENCODER_MODEL = "cross-encoder/ms-marco-MiniLM-L-6-v2"
+RERANK_CANDIDATES = 20                   # Candidates over-fetched from retrieval
+RERANK_TOP_N = 2                         # Candidates kept for the prompt
+RERANK_BATCH_SIZE = 8
+RERANK_BUDGET_SECONDS = 0.3
+
+# Topic Catalog (offline clustering of stored chunk embeddings)
+TOPIC_CATALOG_CLUSTERS = 24
+TOPIC_CATALOG_KMEANS_ITERATIONS = 50
+TOPIC_CATALOG_MIN_CLUSTER_SIZE = 3       # Smaller clusters are left out of the catalog
+TOPIC_CATALOG_LABEL_TERMS = 3            # Distinctive terms joined into a cluster's label
+TOPIC_CATALOG_CONTEXT_CHUNKS = 4         # Chunks nearest the centroid packed into the context bundle
+TOPIC_CATALOG_FETCH_BATCH_SIZE = 100
+
 #LLM Models Information
 MISTRAL_MODEL_CHOICE = 'Mistral'
 MISTRAL_MODEL = 'mistral-small-latest'
@@ -63,11 +165,53 @@ DEEPSEEK_MODEL_CHOICE = 'DeepSeekR1'
 DEEPSEEK_MODEL = 'deepseek/deepseek-r1:free'
 DEEPSEEK_BASEURL = os.getenv("DEEPSEEK_BASEURL")
 
+# Query Generation Mode: 'two_call' (passage, then questions) or 'combined' (one structured JSON call)
+QUERY_GENERATION_MODE = os.getenv("QUERY_GENERATION_MODE", "two_call")
+
+# Question Generation Mode: 'single' (one call for all questions) or 'fan_out' (one concurrent call per type)
+QUESTION_GENERATION_MODE = os.getenv("QUESTION_GENERATION_MODE", "single")
+QUESTION_MIN_VALID_COUNT = 6              # Fewer valid questions than this triggers a regeneration
+QUESTION_TYPE_DISTRIBUTION = {          # Order here is the order questions are numbered in
+    "Multiple choice": 3,
+    "True/False/Not Given": 3,
+    "Matching": 2,
+    "Completion": 2,
+}
+
+# Evaluation Output Mode: 'text' (labelled prose, regex-parsed) or 'json' (structured rows, schema-validated)
+EVALUATION_OUTPUT_MODE = os.getenv("EVALUATION_OUTPUT_MODE", "text")
+
 # LLM API Keys
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MISTRAL_API_KEY = os.getenv("MISTRAL_API_KEY")
 DEEPSEEK_API_KEY = os.getenv("DEEPSEEK_API_KEY") 
 
+# LLM Router (hedging & failover across the providers above)
+LLM_REQUEST_TIMEOUT_SECONDS = 120
+LLM_ROUTER_MAX_WORKERS = 16
+LLM_ROUTER_WINDOW_SIZE = 100                  # Rolling samples kept per provider
+LLM_ROUTER_MIN_SAMPLES = 5                    # Below this, the default hedge deadline is used
+LLM_ROUTER_DEFAULT_HEDGE_SECONDS = 45
+LLM_ROUTER_MIN_HEDGE_SECONDS = 5
+LLM_ROUTER_HEDGE_P95_MULTIPLIER = 1.2
+LLM_ROUTER_CIRCUIT_FAILURE_THRESHOLD = 3      # Consecutive failures before a circuit opens
+LLM_ROUTER_CIRCUIT_COOLDOWN_SECONDS = 30
+LLM_ROUTER_HEDGE_BUDGET_RATIO = 0.1          # At most this share of the last LLM_ROUTER_WINDOW_SIZE requests may hedge
+LLM_JSON_SCHEMA_MODELS = {OPENAI_MODEL}       # Others get a json_schema response_format downgraded to json_object
+
+# LLM Rate Limiting (cluster-wide token buckets in Redis, per provider and model)
+RATE_LIMIT_KEY_PREFIX = "ratelimit:"
+RATE_LIMIT_KEY_TTL_SECONDS = 3600
+LLM_RATE_LIMITS = {
+    OPENAI_MODEL: {"requests_per_minute": 500, "tokens_per_minute": 200000},
+    MISTRAL_MODEL: {"requests_per_minute": 60, "tokens_per_minute": 500000},
+    DEEPSEEK_MODEL: {"requests_per_minute": 20, "tokens_per_minute": 100000},
+}
+LLM_RATE_LIMIT_DEFAULT = {"requests_per_minute": 60, "tokens_per_minute": 100000}
+LLM_RATE_LIMIT_DEFAULT_COMPLETION_TOKENS = 1500
+LLM_RATE_LIMIT_MAX_WAIT_SECONDS = 30        # Queue callers up to this long, then shed
+LLM_RATE_LIMIT_JITTER_SECONDS = 0.5
+
 # Logging Configuration
 LOG_DIR = os.path.join(os.path.dirname(__file__), '..', 'logs')
 LOG_FILENAME = os.path.join(LOG_DIR, 'ielts_app.log')
@@ -78,6 +222,24 @@ LOG_MAX_BYTES = 5 * 1024 * 1024  # 5 MB
 LOG_BACKUP_COUNT = 3
 LOG_BUFFER_THRESHOLD = 100
 LOG_BUFFER_TTL_SECONDS = 3600           # Time-to-time live for Redis log buffer
+LOG_FLUSH_MARKER_KEY_PREFIX = "chatlogs_flush_pending:"
+LOG_FLUSH_DEBOUNCE_SECONDS = 30         # At most one flush enqueued per chat per window (cleared early once the flush drains)
+LOG_DIRTY_SET_KEY = "chatlogs_dirty"    # ZSET of chat IDs with unflushed entries, scored by first-unflushed time
+LOG_FLUSH_MAX_AGE_SECONDS = 300         # Periodic flusher picks up buffers whose oldest entry is at least this old
+LOG_FLUSH_POP_BATCH_SIZE = 500
+LOG_STAGING_SET_KEY = "chatlogs_staging_index"    # ZSET of staging keys scored by their last drain time
+LOG_STAGING_STALE_SECONDS = 900         # Staging keys untouched this long lost their flush task; the periodic flusher restores them
+LOG_STAGING_SWEEP_BATCH_SIZE = 500
+LOG_PERIODIC_FLUSH_INTERVAL_SECONDS = 60
+CHATLOG_TRANSPORT = os.getenv("CHATLOG_TRANSPORT", "list").lower()   # "list" (per-chat buffers) or "stream" (Redis Streams)
+CHATLOG_STREAM_KEY_PREFIX = "chatlogs_stream:"
+CHATLOG_STREAM_SHARDS = 4               # Chats are hashed onto this many streams; a chat always lands on the same one
+CHATLOG_STREAM_GROUP = "chatlog_writers"
+CHATLOG_STREAM_BACKLOG_ALERT_ENTRIES = 1000000     # Alert (never trim) when a shard holds more unwritten entries
+CHATLOG_STREAM_BATCH_SIZE = 1000        # Entries read per XREADGROUP, across every chat on the stream
+CHATLOG_STREAM_MAX_BATCHES_PER_RUN = 20
+CHATLOG_STREAM_CLAIM_IDLE_MS = 120000   # Pending entries idle this long belong to a dead consumer and are reclaimed
+CHATLOG_STREAM_CONSUME_INTERVAL_SECONDS = 5
 
 # Logging Setup Function
 def setup_logging():
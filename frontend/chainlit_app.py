@@ -4,6 +4,7 @@ import logging
 import random
 import time
 import json
+import asyncio
 
 import chainlit as cl
 from chainlit.element import TaskList, Task
@@ -37,9 +38,13 @@ except Exception as e:
 # Import Celery
 try:
     from celery_app import celery_app
-    from backend.query_service import process_query_task
+    from backend.query_service import process_query_task, submit_query_task
     from backend.evaluation_service import evaluate_answers_task
+    from backend.batch_evaluation import submit_for_batch_evaluation
     from backend.chatlog_storage import buffer_chat_log
+    from backend.task_events import get_task_event_listener, TERMINAL_EVENTS
+    from backend.singleflight import coalesce_key
+    from backend.topic_catalog import pick_random_topic
     logger.info("Successfully imported application modules (Celery, backend).")
 except ImportError as e:
     logger.error("ImportError while loading application modules.", exc_info=True)
@@ -64,21 +69,68 @@ INITIAL_ACTIONS_LIST = [
     cl.Action(name="generate_custom_passage", value="custom_passage", payload={'value': "custom_passage"}, label="✏️ Enter a topic for a new passage"),
     cl.Action(name="change_llm", value="change_llm", payload={'value': "change_llm"}, label="⚙️ Change LLM Model")
 ]
+# Pipeline stages shown live in the TaskList for passage generation
+QUERY_STAGE_TITLES = {
+    "retrieve_context": "Retrieving context",
+    "generate_passage": "Generating passage",
+    "generate_questions": "Generating questions",
+}
+
+STAGE_STATUS_MAP = {
+    "running": cl.TaskStatus.RUNNING,
+    "done": cl.TaskStatus.DONE,
+    "failed": cl.TaskStatus.FAILED,
+}
+
+async def apply_stage_event(event: dict, task_list_ui: TaskList, stage_tasks: dict):
+    stage_task = stage_tasks.get(event.get("stage"))
+    if not stage_task:
+        return
+
+    stage_task.status = STAGE_STATUS_MAP.get(event.get("stage_status"), cl.TaskStatus.RUNNING)
+    duration = event.get("duration")
+    if duration is not None and event.get("stage_status") == "done":
+        stage_task.title = f"{QUERY_STAGE_TITLES[event['stage']]} ({duration:.1f}s)"
+    await task_list_ui.send()
+
 # Automatic result display
-async def await_task_result(task_id: str, task_list_ui: TaskList):
+async def await_task_result(task_id: str, task_list_ui: TaskList, stage_tasks: dict = None):
     """
-    Polls a Celery task until it's ready and returns the result.
-    Updates the UI with the task status.
+    Waits for a Celery task to finish and returns the result.
+    Completion is pushed through the task event listener; the result backend is
+    only re-checked on a slow fallback interval in case a notification was missed.
+    Updates the UI with the task status, including per-stage progress when given.
     """
     result_obj = AsyncResult(task_id, app=celery_app)
+    listener = get_task_event_listener()
+    events_queue = None
     try:
+        await listener.start()
+        events_queue = listener.subscribe(task_id)
+
+        # Subscribing before this check closes the gap where the task finishes first
         while not result_obj.ready():
-            await cl.sleep(2)
+            try:
+                event = await asyncio.wait_for(events_queue.get(), timeout=config.TASK_RESULT_FALLBACK_POLL_SECONDS)
+            except asyncio.TimeoutError:
+                continue
+
+            if event.get("event") in TERMINAL_EVENTS:
+                break
+
+            if stage_tasks and event.get("event") == "stage":
+                await apply_stage_event(event, task_list_ui, stage_tasks)
         
-        task_list_ui.tasks[0].status = cl.TaskStatus.DONE
+        # Stages are only closed out as done on success; on failure, whatever had not finished failed with the task
+        succeeded = result_obj.successful()
+        for task_ui in task_list_ui.tasks:
+            if succeeded and task_ui.status != cl.TaskStatus.FAILED:
+                task_ui.status = cl.TaskStatus.DONE
+            elif not succeeded and task_ui.status in (cl.TaskStatus.RUNNING, cl.TaskStatus.READY):
+                task_ui.status = cl.TaskStatus.FAILED
         await task_list_ui.send()
 
-        if result_obj.successful():
+        if succeeded:
             return result_obj.get()
         else:
             logger.error(f"Task {task_id} failed with traceback: {result_obj.traceback}")
@@ -86,19 +138,68 @@ async def await_task_result(task_id: str, task_list_ui: TaskList):
     except Exception as e:
         logger.error(f"Error while awaiting task {task_id}: {e}", exc_info=True)
         return {"status": "TASK_FAILED", "error_message": "An unexpected error occurred while monitoring the task."}
+    finally:
+        if events_queue:
+            listener.unsubscribe(task_id, events_queue)
+
+# Passage generation tasks in flight in this process, keyed by (normalized query, LLM choice)
+inflight_passage_tasks = {}
+
+def dispatch_task(task_type: str, task_callable, **kwargs):
+    """Dispatches a Celery task, joining an identical in-flight passage request instead of sending a duplicate."""
+    flight_key = None
+    if task_type == "Passage Generation":
+        flight_key = coalesce_key(kwargs.get("query"), kwargs.get("chosen_LLM"), kwargs.get("filters"))
+        existing_task_id = inflight_passage_tasks.get(flight_key)
+        if existing_task_id:
+            logger.info(f"Joining in-flight passage task {existing_task_id} for an identical query.")
+            return existing_task_id, flight_key
+
+    if task_type == "Passage Generation":
+        # Joins an identical run started by another frontend process, if there is one
+        task_id = submit_query_task(**kwargs)
+    else:
+        task = task_callable.delay(**kwargs)
+        task_id = task.id if task else None
+    if not task_id:
+        raise ConnectionError("Failed to dispatch task to Celery.")
+
+    if flight_key:
+        inflight_passage_tasks[flight_key] = task_id
+    return task_id, flight_key
 
 async def run_and_display_task(task_type: str, task_callable, **kwargs):
-    task_list = TaskList(tasks=[
-        Task(title=f"Running {task_type} task...", status=cl.TaskStatus.RUNNING)
-    ])
+    stage_tasks = None
+    if task_type == "Passage Generation":
+        stage_tasks = {
+            stage: Task(title=title, status=cl.TaskStatus.READY)
+            for stage, title in QUERY_STAGE_TITLES.items()
+        }
+        task_list = TaskList(tasks=list(stage_tasks.values()))
+    else:
+        task_list = TaskList(tasks=[
+            Task(title=f"Running {task_type} task...", status=cl.TaskStatus.RUNNING)
+        ])
     await task_list.send()
 
     try:
-        task = task_callable.delay(**kwargs)
-        if not task or not task.id:
-            raise ConnectionError("Failed to dispatch task to Celery.")
-
-        result = await await_task_result(task.id, task_list)
+        if task_type == "Batch Evaluation":
+            # The batch task grades the whole window; this student's result is keyed by submission ID
+            task_id, submission_id = await asyncio.to_thread(task_callable, **kwargs)
+            result = await await_task_result(task_id, task_list, stage_tasks)
+            # A failed batch task already carries its own error; only a finished batch is searched for this submission
+            if submission_id and (result or {}).get("status") != "TASK_FAILED":
+                result = (result or {}).get("results", {}).get(submission_id) or {
+                    "error_message": "Your submission was not found in the graded batch."
+                }
+            task_type = "Evaluation"
+        else:
+            task_id, flight_key = dispatch_task(task_type, task_callable, **kwargs)
+            try:
+                result = await await_task_result(task_id, task_list, stage_tasks)
+            finally:
+                if flight_key and inflight_passage_tasks.get(flight_key) == task_id:
+                    del inflight_passage_tasks[flight_key]
         
         # Process the result based on task type
         if task_type == "Passage Generation":
@@ -168,6 +269,12 @@ async def start_chat():
     cl.user_session.set("chat_id", chat_id_val)
     cl.user_session.set("state", "INITIAL")
 
+    # Analytics follow the signed-in user across chats; anonymous chats only feed the daily rollup
+    user = cl.user_session.get("user")
+    if user:
+        cl.user_session.set("learner_id", user.identifier)
+        cl.user_session.set("cohort_id", (user.metadata or {}).get("cohort_id"))
+
     llm_model_choice = getattr(config, 'OPENAI_MODEL_CHOICE', 'GPT 4.1')
     cl.user_session.set("llm_choice", llm_model_choice)
     logger.info(f"Chat started. Session ID: {chat_id_val}, LLM: {llm_model_choice}")
@@ -177,13 +284,22 @@ async def start_chat():
 
 @cl.action_callback("generate_new_passage")
 async def on_new_passage(action: cl.Action):
-    random_topic = random.choice(["history of artificial intelligence", "marine biology", "climate change effects"])
+    # Catalog topics come with their context precomputed, so the task skips retrieval
+    catalog_topic = await asyncio.to_thread(pick_random_topic)
+    if catalog_topic:
+        random_topic = catalog_topic["label"]
+        topic_kwargs = {"topic_id": catalog_topic["topic_id"]}
+    else:
+        random_topic = random.choice(["history of artificial intelligence", "marine biology", "climate change effects"])
+        topic_kwargs = {}
+
     await cl.Message(content=f"Alright! Generating a passage about '{random_topic}'...").send()
     await run_and_display_task(
         task_type="Passage Generation",
         task_callable=process_query_task,
         query=random_topic,
-        chosen_LLM=cl.user_session.get("llm_choice")
+        chosen_LLM=cl.user_session.get("llm_choice"),
+        **topic_kwargs
     )
 
 @cl.action_callback("generate_custom_passage")
@@ -212,15 +328,26 @@ async def on_eval_model_selected(action: cl.Action):
     eval_model_choice = action.payload.get("value")
     await cl.Message(content=f"Okay, evaluating with **{eval_model_choice}**...").send()
     
-    await run_and_display_task(
-        task_type="Evaluation",
-        task_callable=evaluate_answers_task,
-        model_choice=eval_model_choice,
-        passage_content=cl.user_session.get("current_passage"),
-        questions_string=cl.user_session.get("current_questions_str"),
-        user_answers=cl.user_session.get("user_answers"),
-        questions_data=cl.user_session.get("current_questions_data")
-    )
+    evaluation_kwargs = {
+        "model_choice": eval_model_choice,
+        "passage_content": cl.user_session.get("current_passage"),
+        "questions_string": cl.user_session.get("current_questions_str"),
+        "user_answers": cl.user_session.get("user_answers"),
+        "questions_data": cl.user_session.get("current_questions_data"),
+        "cohort_id": cl.user_session.get("cohort_id")
+    }
+
+    # In class sessions, students answering the same passage are graded together
+    if config.BATCH_EVALUATION_ENABLED:
+        await run_and_display_task(
+            task_type="Batch Evaluation",
+            task_callable=submit_for_batch_evaluation,
+            student_id=cl.user_session.get("learner_id"),
+            **evaluation_kwargs
+        )
+    else:
+        await run_and_display_task(task_type="Evaluation", task_callable=evaluate_answers_task,
+                                   learner_id=cl.user_session.get("learner_id"), **evaluation_kwargs)
 
 @cl.on_message
 async def main_logic(message: Message):
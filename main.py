@@ -8,6 +8,12 @@ try:
     import config # Your main configuration file
     from backend import data_preprocessing
     from backend import text_embedding
+    from backend import context_layer
+    from backend import topic_catalog
+    from backend import evaluation_cache
+    from backend import learner_analytics
+    from backend import chatlog_compaction
+    from backend import chatlog_sinks
     from backend import db_pool_setup # For initializing/closing the pool if main.py interacts with DB directly
     # from backend.celery_app import celery_app # If you need to inspect tasks, etc.
 except ImportError as e:
@@ -53,13 +59,64 @@ def run_embedding_generation():
     # finally:
         # db_pool_setup.close_pool() # Close if initialized here
 
+def run_lexical_index_setup():
+    """Creates the full-text search column and GIN index used by hybrid retrieval."""
+    logger.info("Setting up lexical search index on passages...")
+    if context_layer.setup_lexical_index():
+        logger.info("Lexical search index is ready.")
+    else:
+        logger.error("Lexical search index setup failed. See logs for details.")
+
+def run_topic_catalog_build():
+    """Clusters the stored chunk embeddings into the topic catalog used for random passages."""
+    logger.info("Building topic catalog from stored embeddings...")
+    index = text_embedding.get_pinecone_index()
+    if not index:
+        logger.error("Pinecone index unavailable. Cannot build topic catalog.")
+        return
+
+    if topic_catalog.build_topic_catalog(index):
+        logger.info("Topic catalog is ready.")
+    else:
+        logger.error("Topic catalog build failed. See logs for details.")
+
+def run_evaluation_cache_report():
+    """Logs the lifetime hit rate of the per-item evaluation cache."""
+    stats = evaluation_cache.get_hit_rate()
+    if stats["hit_rate"] is None:
+        logger.info("Evaluation cache has not served any lookups yet.")
+    else:
+        logger.info(f"Evaluation cache: {stats['hits']} hits, {stats['misses']} misses "
+                    f"(hit rate {stats['hit_rate']:.1%}).")
+
+def run_learner_analytics_setup():
+    """Creates the per-learner, daily and cohort counter tables."""
+    logger.info("Setting up learner analytics tables...")
+    if learner_analytics.setup_analytics_tables():
+        logger.info("Learner analytics tables are ready.")
+    else:
+        logger.error("Learner analytics setup failed. See logs for details.")
+
+def run_chat_log_compaction(day=None):
+    """Compacts chat log batches in this process (default: the days the scheduled job would pick)."""
+    try:
+        sink = chatlog_sinks.get_sink()
+        days = [day] if day else chatlog_compaction.scheduled_compaction_days(sink)
+        logger.info(f"Compacting chat logs for {days}...")
+        for d in days:
+            summary = chatlog_compaction.compact_day(d, sink)
+            logger.info(f"Chat log compaction finished: {summary}")
+    except Exception as e:
+        logger.error(f"Chat log compaction failed: {e}", exc_info=True)
+
 def main():
     parser = argparse.ArgumentParser(description="IELTS Assistant Admin CLI")
     parser.add_argument(
         "action",
-        choices=["process_pdfs", "generate_embeddings", "all"],
+        choices=["process_pdfs", "generate_embeddings", "setup_lexical_index", "build_topic_catalog", "evaluation_cache_stats", "setup_learner_analytics", "compact_chat_logs", "all"],
         help="The administrative action to perform."
     )
+    parser.add_argument("--day", help="UTC day (YYYY-MM-DD) for compact_chat_logs; defaults to the days the scheduled job would pick.")
 
     args = parser.parse_args()
 
@@ -73,6 +130,16 @@ def main():
         run_pdf_processing()
     elif args.action == "generate_embeddings":
         run_embedding_generation()
+    elif args.action == "setup_lexical_index":
+        run_lexical_index_setup()
+    elif args.action == "build_topic_catalog":
+        run_topic_catalog_build()
+    elif args.action == "evaluation_cache_stats":
+        run_evaluation_cache_report()
+    elif args.action == "setup_learner_analytics":
+        run_learner_analytics_setup()
+    elif args.action == "compact_chat_logs":
+        run_chat_log_compaction(args.day)
     elif args.action == "all":
         logger.info("Running all administrative tasks...")
         run_pdf_processing()